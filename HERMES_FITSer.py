@@ -3,6 +3,24 @@ import astropy.io.fits as pyfits
 from astropy.time import Time
 import struct
 import os
+import glob
+import json
+import logging
+import collections
+import threading
+import tracemalloc
+import gzip
+import lzma
+import bz2
+import tarfile
+import sqlite3
+import hashlib
+import io
+import re
+import concurrent.futures
+import itertools
+import mmap
+from multiprocessing import shared_memory
 
 """
 Converter from PDHU binary buffer files to LV0 FITS
@@ -15,6 +33,92 @@ Based on FITS LV0 and LV0.5 file structure specification 2023-11-17
 """
 
 
+# Messages go through the "HERMES_FITSer" logger: per-record details are
+# emitted at DEBUG level only, and repeated warnings are counted
+# and reported once per buffer.
+logger = logging.getLogger("HERMES_FITSer")
+
+
+# Voltage/current HKs, in the order of bytes 48:63 of the BEE HK chunk
+HK_RAW_FIELDS = ["3V3D", "3V3A", "3V3-BEE", "2V0", "5V0-FEE_I", "5V0-FEE", "2V0_I", "5V0-BEE_I",
+                 "3V3-BEE_I", "HV", "12V0_I", "12V0", "5V0-BEE", "3V3D_I", "3V3A_I"]
+
+# Conversion factors for voltage and current HKs
+gain_3V3D        = 1.561797753
+gain_3V3A        = 1.561797753
+gain_3V3_BEE     = 1.561797753
+gain_2V0         = 1.0
+gain_5V0_FEE     = 2.395348837
+gain_HV          = 101
+gain_12V0        = 5.4
+gain_5V0_BEE     = 2.395348837
+
+offset_3V3D      = 6
+offset_3V3A      = 6
+offset_3V3_BEE   = 6
+offset_2V0       = 0
+offset_5V0_FEE   = 6
+offset_HV        = 0
+offset_12V0      = 6
+offset_5V0_BEE   = 6
+
+gain_current = 20
+offset_current = 0
+
+rsense_3V3D      = 0.5
+rsense_3V3A      = 0.5
+rsense_3V3_BEE   = 0.01
+rsense_2V0       = 0.5	
+rsense_5V0_FEE   = 0.33	
+rsense_12V0      = 0.33	
+rsense_5V0_BEE   = 0.33	        
+
+lsb_adc = 0.009765625
+
+
+def convert_HK(BEE_HK):
+    """
+    Converts the raw voltage/current HKs (keys "<name>_raw") into physical units.
+    Works both on scalars (Header objects) and on numpy arrays (header scans).
+    """
+    BEE_HK["3V3D"]      = (BEE_HK["3V3D_raw"]      + offset_3V3D) * gain_3V3D * lsb_adc
+    BEE_HK["3V3A"]      = (BEE_HK["3V3A_raw"]      + offset_3V3A) * gain_3V3A * lsb_adc
+    BEE_HK["3V3-BEE"]   = (BEE_HK["3V3-BEE_raw"]   + offset_3V3_BEE) * gain_3V3_BEE * lsb_adc
+    BEE_HK["2V0"]       = (BEE_HK["2V0_raw"]       + offset_2V0) * gain_2V0 * lsb_adc
+    BEE_HK["5V0-FEE_I"] = (BEE_HK["5V0-FEE_I_raw"] + offset_current) * lsb_adc/(gain_current * rsense_5V0_FEE) * 1000
+    BEE_HK["5V0-FEE"]   = (BEE_HK["5V0-FEE_raw"]   + offset_5V0_BEE) * gain_5V0_BEE * lsb_adc
+    BEE_HK["2V0_I"]     = (BEE_HK["2V0_I_raw"]     + offset_current) * lsb_adc/(gain_current * rsense_2V0) * 1000
+    BEE_HK["5V0-BEE_I"] = (BEE_HK["5V0-BEE_I_raw"] + offset_current) * lsb_adc/(gain_current * rsense_5V0_BEE) * 1000
+    BEE_HK["3V3-BEE_I"] = (BEE_HK["3V3-BEE_I_raw"] + offset_current) * lsb_adc/(gain_current * rsense_3V3_BEE) * 1000
+    BEE_HK["HV"]        = (BEE_HK["HV_raw"]        + offset_HV) * gain_HV * lsb_adc
+    BEE_HK["12V0_I"]    = (BEE_HK["12V0_I_raw"]    + offset_current) * lsb_adc/(gain_current * rsense_12V0) * 1000
+    BEE_HK["12V0"]      = (BEE_HK["12V0_raw"]      + offset_12V0) * gain_12V0 * lsb_adc
+    BEE_HK["5V0-BEE"]   = (BEE_HK["5V0-BEE_raw"]   + offset_5V0_BEE) * gain_5V0_BEE * lsb_adc
+    BEE_HK["3V3D_I"]    = (BEE_HK["3V3D_I_raw"]    + offset_current)* lsb_adc/(gain_current * rsense_3V3D) * 1000
+    BEE_HK["3V3A_I"]    = (BEE_HK["3V3A_I_raw"]    + offset_current)* lsb_adc/(gain_current * rsense_3V3A) * 1000
+    return BEE_HK
+
+
+# Layout of the 128 bytes header, as a numpy structured type
+# (native byte order, as for the struct unpacking in Header)
+HEADER_DTYPE = np.dtype({"names":   ["GPSOffset", "UTCOffset", "WeekSeconds", "Week", "GPSStatus",
+                                     "ABT_OBT", "ABT_CNT",
+                                     "TriggerCounter", "RejectedCounter", "EventCounter", "OverflowCounter",
+                                     "QuadrantStatus", "HK_raw", "Det_Temp",
+                                     "CSACStatus", "LaserI", "HeatP", "Temp", "recordCounters"],
+                         "formats": ["f8", "f8", "f4", "i2", "u1",
+                                     "u4", "u4",
+                                     ("i2", 4), ("i2", 4), ("i2", 4), ("i2", 4),
+                                     ("u1", 5), ("u1", 15), ("i2", 7),
+                                     "u1", "u2", "u2", "u2", ("u4", 4)],
+                         "offsets": [0, 8, 16, 20, 22,
+                                     24, 28,
+                                     32, 40, 48, 56,
+                                     64, 72, 88,
+                                     104, 105, 107, 109, 111],
+                         "itemsize": 128})
+
+
 class Header(object):
     """
     Class for an HEADER object
@@ -28,7 +132,16 @@ class Header(object):
         self.recordCounter1 = 0
         self.recordCounter2 = 0
         self.recordCounter3 = 0
+        # Parsed records of each quadrant, filled by ingest_buffer (see compute_DQ)
+        self.parsedCounters = None
+        # PIXEL records of each (quadrant, channel), time spanned by each quadrant
+        # and noisy channels bitmask, filled by ingest_buffer (see ChannelMonitor)
+        self.channelCounts = None
+        self.channelSpan = None
+        self.noisyChannels = None
         assert len(header_bytes) == 128
+        # Raw bytes, to rebuild the header in another process (see share_readout)
+        self.headerBytes = bytes(header_bytes)
         self.string_breakdown(header_bytes)
             
     def printGPSTime(self):
@@ -180,70 +293,10 @@ class Header(object):
         self.BEE_HK["QuadrantStatus"] = status0+status1+status2+status3+status4
         
         
-        # Conversion factors for voltage and current HKs
-        gain_3V3D        = 1.561797753
-        gain_3V3A        = 1.561797753
-        gain_3V3_BEE     = 1.561797753
-        gain_2V0         = 1.0
-        gain_5V0_FEE     = 2.395348837
-        gain_HV          = 101
-        gain_12V0        = 5.4
-        gain_5V0_BEE     = 2.395348837
-        
-        offset_3V3D      = 6
-        offset_3V3A      = 6
-        offset_3V3_BEE   = 6
-        offset_2V0       = 0
-        offset_5V0_FEE   = 6
-        offset_HV        = 0
-        offset_12V0      = 6
-        offset_5V0_BEE   = 6
-        
-        gain_current = 20
-        offset_current = 0
-        
-        rsense_3V3D      = 0.5
-        rsense_3V3A      = 0.5
-        rsense_3V3_BEE   = 0.01
-        rsense_2V0       = 0.5	
-        rsense_5V0_FEE   = 0.33	
-        rsense_12V0      = 0.33	
-        rsense_5V0_BEE   = 0.33	        
-        
-        lsb_adc = 0.009765625
-        
-        self.BEE_HK["3V3D_raw"]         = int(hk_string[48:49].hex(), base=16)
-        self.BEE_HK["3V3A_raw"]         = int(hk_string[49:50].hex(), base=16)
-        self.BEE_HK["3V3-BEE_raw"]      = int(hk_string[50:51].hex(), base=16)
-        self.BEE_HK["2V0_raw"]          = int(hk_string[51:52].hex(), base=16)
-        self.BEE_HK["5V0-FEE_I_raw"]    = int(hk_string[52:53].hex(), base=16)
-        self.BEE_HK["5V0-FEE_raw"]      = int(hk_string[53:54].hex(), base=16)
-        self.BEE_HK["2V0_I_raw"]        = int(hk_string[54:55].hex(), base=16)
-        self.BEE_HK["5V0-BEE_I_raw"]    = int(hk_string[55:56].hex(), base=16)
-        self.BEE_HK["3V3-BEE_I_raw"]    = int(hk_string[56:57].hex(), base=16)
-        self.BEE_HK["HV_raw"]           = int(hk_string[57:58].hex(), base=16)
-        self.BEE_HK["12V0_I_raw"]       = int(hk_string[58:59].hex(), base=16)
-        self.BEE_HK["12V0_raw"]         = int(hk_string[59:60].hex(), base=16)
-        self.BEE_HK["5V0-BEE_raw"]      = int(hk_string[60:61].hex(), base=16)
-        self.BEE_HK["3V3D_I_raw"]       = int(hk_string[61:62].hex(), base=16)
-        self.BEE_HK["3V3A_I_raw"]       = int(hk_string[62:63].hex(), base=16)
+        for n, name in enumerate(HK_RAW_FIELDS):
+            self.BEE_HK[name + "_raw"] = hk_string[48+n]
         
-                    
-        self.BEE_HK["3V3D"]      = (self.BEE_HK["3V3D_raw"]      + offset_3V3D) * gain_3V3D * lsb_adc
-        self.BEE_HK["3V3A"]      = (self.BEE_HK["3V3A_raw"]      + offset_3V3A) * gain_3V3A * lsb_adc
-        self.BEE_HK["3V3-BEE"]   = (self.BEE_HK["3V3-BEE_raw"]   + offset_3V3_BEE) * gain_3V3_BEE * lsb_adc
-        self.BEE_HK["2V0"]       = (self.BEE_HK["2V0_raw"]       + offset_2V0) * gain_2V0 * lsb_adc
-        self.BEE_HK["5V0-FEE_I"] = (self.BEE_HK["5V0-FEE_I_raw"] + offset_current) * lsb_adc/(gain_current * rsense_5V0_FEE) * 1000
-        self.BEE_HK["5V0-FEE"]   = (self.BEE_HK["5V0-FEE_raw"]   + offset_5V0_BEE) * gain_5V0_BEE * lsb_adc
-        self.BEE_HK["2V0_I"]     = (self.BEE_HK["2V0_I_raw"]     + offset_current) * lsb_adc/(gain_current * rsense_2V0) * 1000
-        self.BEE_HK["5V0-BEE_I"] = (self.BEE_HK["5V0-BEE_I_raw"] + offset_current) * lsb_adc/(gain_current * rsense_5V0_BEE) * 1000
-        self.BEE_HK["3V3-BEE_I"] = (self.BEE_HK["3V3-BEE_I_raw"] + offset_current) * lsb_adc/(gain_current * rsense_3V3_BEE) * 1000
-        self.BEE_HK["HV"]        = (self.BEE_HK["HV_raw"]        + offset_HV) * gain_HV * lsb_adc
-        self.BEE_HK["12V0_I"]    = (self.BEE_HK["12V0_I_raw"]    + offset_current) * lsb_adc/(gain_current * rsense_12V0) * 1000
-        self.BEE_HK["12V0"]      = (self.BEE_HK["12V0_raw"]      + offset_12V0) * gain_12V0 * lsb_adc
-        self.BEE_HK["5V0-BEE"]   = (self.BEE_HK["5V0-BEE_raw"]   + offset_5V0_BEE) * gain_5V0_BEE * lsb_adc
-        self.BEE_HK["3V3D_I"]    = (self.BEE_HK["3V3D_I_raw"]    + offset_current)* lsb_adc/(gain_current * rsense_3V3D) * 1000
-        self.BEE_HK["3V3A_I"]    = (self.BEE_HK["3V3A_I_raw"]    + offset_current)* lsb_adc/(gain_current * rsense_3V3A) * 1000
+        convert_HK(self.BEE_HK)
         
         
         """
@@ -307,7 +360,7 @@ class Event(object):
             if pixelevent.evtype == 0:
                 output_str += "ABT event. OBT seconds {:d}, OBT nanoseconds: {:d}\n".format(pixelevent.obt_s, pixelevent.obt_ns)
         if self.rejectedMap is not None:
-                output_str += "REJECTED event. Rejected map: {:s}\n".format(self.rejectedMap)
+                output_str += "REJECTED event. Rejected map: {:032b}\n".format(self.rejectedMap)
         return output_str
         
     def addPixelEvent(self, pixel):
@@ -327,11 +380,15 @@ class PixelEvent(object):
         self.obt_ns = obt_ns
  
  
-def parseRecordData(buf, verbose=False):
+def parseRecordData(buf, verbose=False, warnings=None, tolerant=False):
     """
     Parses the buffer data (record list) and identify Event types.
     Input:
         buf = buffer of bytes
+        verbose = log every record (at DEBUG level)
+        warnings = optional collections.Counter where repeated warnings
+                   are accumulated instead of being logged one by one
+        tolerant = if True, a trailing incomplete record is dropped instead of exiting
     Output:
         eventBuffer, (timeCounter, pixelCounter, abtCounter, rejCounter)
         where:
@@ -348,18 +405,28 @@ def parseRecordData(buf, verbose=False):
     
     time_mark_lsb_timeEvt = 0
     mult = 0
+    
+    # Evaluate the logging level once: disabled levels cost
+    # a single boolean test in the record loop
+    debug = verbose and logger.isEnabledFor(logging.DEBUG)
+    report_warnings = warnings is None
+    if warnings is None:
+        warnings = collections.Counter()
 
     try:
         assert len(buf) % 4 == 0
     except AssertionError:
-        print("\n*** ERROR ***")
-        print("Buffer is not an integer number of records!\n")
-        exit(1)
+        if not tolerant:
+            logger.error("*** ERROR *** Buffer is not an integer number of records!")
+            exit(1)
+        warnings["Buffer is not an integer number of records, incomplete record dropped"] += 1
+        buf = buf[:len(buf) - len(buf) % 4]
     
 
     n_records = len(buf)//4
     
-    print("N. of records in the byte buffer:", n_records)
+    if debug:
+        logger.debug("N. of records in the byte buffer: %d", n_records)
 
     eventBuffer = []
     event = None
@@ -372,16 +439,16 @@ def parseRecordData(buf, verbose=False):
     flushEmptyEvent = False
     
     for i in range(n_records):
-        if verbose:
-            print("--> Current record", i, "that is", i+1, "of", n_records)
+        if debug:
+            logger.debug("--> Current record %d that is %d of %d", i, i+1, n_records)
 
         # Convert the record bytes in a string with its binary representation               
         record_buf = buf[i*4:i*4+4]
         record_string = ''
         for b in record_buf:
             record_string += f'{b:0>8b}'
-        if verbose:
-            print(record_string)
+        if debug:
+            logger.debug(record_string)
             
         # Check that we are not in the next record after a first ABT/REJ record
         if (not abt_found) and (not rej_found):
@@ -391,9 +458,9 @@ def parseRecordData(buf, verbose=False):
                 time_mark = int(record_string[8:], base=2)
                 time_mark_lsb_timeEvt = record_string[-4:]
                 
-                if verbose:
-                    print("TIME EVENT", "with multiplicity", sdd_multiplicity)
-                    print("Time mark", record_string[8:], time_mark)
+                if debug:
+                    logger.debug("TIME EVENT with multiplicity %d", sdd_multiplicity)
+                    logger.debug("Time mark %s %d", record_string[8:], time_mark)
         
                 # Push previous event(s) in the buffer
                 if event is not None:
@@ -419,13 +486,13 @@ def parseRecordData(buf, verbose=False):
                 # Time mark should be checked for consistency with the TIME event!
                 time_mark_lsb = record_string[8:12]
                 if time_mark_lsb != time_mark_lsb_timeEvt:
-                    print("WARNING: Time mark LSB mismatch!")
+                    warnings["Time mark LSB mismatch"] += 1
                     
                 trigger = int(record_string[15:16])
                 adc = int(record_string[16:], base=2) 
 
-                if verbose:
-                    print("PIXEL EVENT", "ASIC", asicID, "Channel", channel, "Time mark LSB", time_mark_lsb, "ADC", adc)
+                if debug:
+                    logger.debug("PIXEL EVENT ASIC %d Channel %d Time mark LSB %s ADC %d", asicID, channel, time_mark_lsb, adc)
             
                 # Define a new PixelEvent object and append it to the relative Event object member
                 pixel = PixelEvent(mult, asicID=asicID, channel=channel, adc=adc)
@@ -440,8 +507,8 @@ def parseRecordData(buf, verbose=False):
                 obt_s = int(record_string[3:], base=2)
                 abtCounter += 1
 
-                if verbose:
-                    print("ABT EVENT PART 1", "with OBT", obt_s)
+                if debug:
+                    logger.debug("ABT EVENT PART 1 with OBT %d", obt_s)
                 
                 
             # First record of REJ event (REJ TIME EVENT)
@@ -450,8 +517,8 @@ def parseRecordData(buf, verbose=False):
                 
                 time_mark = int(record_string[8:], base=2)
                 
-                if verbose:
-                    print("REJ TIME EVENT", "with time_mark", time_mark)
+                if debug:
+                    logger.debug("REJ TIME EVENT with time_mark %d", time_mark)
                 
                 # Initialise a new Event object with multiplicity -1 (REJECTED)
                 event = Event(time_mark, -1)
@@ -459,8 +526,8 @@ def parseRecordData(buf, verbose=False):
         # In case we are on the second record of an ABT event
         elif abt_found and (not rej_found):
             # Second record of ABT event
-            if verbose:
-                print("ABT EVENT RECORD PART 2")
+            if debug:
+                logger.debug("ABT EVENT RECORD PART 2")
 
             obt_ns = int(record_string[7:], base=2)
 
@@ -479,48 +546,472 @@ def parseRecordData(buf, verbose=False):
                 # Create a fake event (timemark 0, multiplicity 0) to handle buffers starting with an ABT record
                 event = Event(0, 0)
                 event.addPixelEvent(abt)
-                print("FAKE EVENT CREATED -- Apparently the buffer starts with an ABT.")
+                warnings["Fake event created (buffer starting with an ABT)"] += 1
             abt_found = False
             
         # In case we are at the second record of a REJ event        
         elif (not abt_found) and rej_found:
             # Second record of REJ event (REJ PIXEL EVENT)
 
-            rej = record_string[:]
+            # Rejected map as an unsigned 32 bit integer (bit c: channel c)
+            rej = int.from_bytes(record_buf, "big")
             
-            if verbose:
-                print("REJ PIXEL EVENT", "with map", rejMap)
+            if debug:
+                logger.debug("REJ PIXEL EVENT with map %s", record_string)
 
             if event is not None:
                 # If an event object already exists (should always be the case), assign the Rejected Events map to its corresponding member
                 event.addRejectedMap(rej)
             else:
                 # This should not happen.
-                print("*** ERROR! REJECTED PIXEL EVENT WITHOUT PRIOR REJECTED TIME EVENT!")
+                warnings["*** ERROR! REJECTED PIXEL EVENT WITHOUT PRIOR REJECTED TIME EVENT!"] += 1
 
             rej_found = False
             rejCounter += 1
         
         else:
             # This should not happen.
-            print("*** ERROR! UNKNOWN STATE!")
+            warnings["*** ERROR! UNKNOWN STATE!"] += 1
         
         # If we are at the end of the record list, flush everything.        
         if (event is not None) and (i == n_records-1):
             eventBuffer.append(event)
             flushEmptyEvent = False
         
+    if report_warnings:
+        log_warnings(warnings)
         
     return eventBuffer, (timeCounter, pixelCounter, abtCounter, rejCounter)
+
+
+def decodeRecordData(buf, warnings=None, tolerant=False, event_filter=None, quadrant=None, monitor=None, channel_stats=None):
+    """
+    Array version of parseRecordData: the record list is decoded with vectorized
+    operations into columns, without creating Event objects (see events_from_columns).
+    Input:
+        buf, warnings, tolerant = as in parseRecordData
+        event_filter = EventFilter applied while decoding: the excluded pixels and events
+                       are not in the columns (the record counters include them), and
+                       the multiplicity of an event counts its pixels left
+        quadrant = quadrant of the record list, for event_filter
+        monitor = ChannelMonitor: the PIXEL records of each channel are counted and
+                  (counts, time span, noisy channels bitmask) is appended to channel_stats;
+                  with monitor.mask, the pixels of the noisy channels are dropped as by event_filter
+    Output:
+        columns, (timeCounter, pixelCounter, abtCounter, rejCounter)
+        where columns is a dict of arrays with
+            one element for each event: TIMEMARK, MULT, REJMAP (-1 if no map), NENTRIES
+            one element for each pixel and ABT entry of the events, in record order:
+            EVTYPE, ASICID, CHANNEL, ADC, OBTS, OBTNS
+    """
+    report_warnings = warnings is None
+    if warnings is None:
+        warnings = collections.Counter()
+    
+    if len(buf) % 4 != 0:
+        if not tolerant:
+            logger.error("*** ERROR *** Buffer is not an integer number of records!")
+            exit(1)
+        warnings["Buffer is not an integer number of records, incomplete record dropped"] += 1
+        buf = buf[:len(buf) - len(buf) % 4]
+    
+    record = np.frombuffer(buf, dtype='>u4').astype(np.int64)
+    n_records = len(record)
+    index = np.arange(n_records)
+    top3 = record >> 29
+    
+    def previous(mask):
+        return np.concatenate([[False], mask[:-1]])[:n_records]
+    
+    def last(mask):
+        # Index of the last record in mask up to each record, -1 if none
+        return np.maximum.accumulate(np.where(mask, index, -1)) if n_records > 0 else index
+    
+    # The record following a first ABT/REJ record (111/100) is its second record,
+    # whatever its content: in a run of 111/100 records, they alternate first and second
+    starter = (top3 == 7) | (top3 == 4)
+    run_start = np.maximum.accumulate(np.where(starter & ~previous(starter), index, 0)) if n_records > 0 else index
+    second = previous(starter & ((index - run_start) % 2 == 0))
+    
+    time  = ~second & (top3 == 5)
+    pixel = ~second & (record >> 31 == 0)
+    abt1  = ~second & (top3 == 7)
+    rej1  = ~second & (top3 == 4)
+    abt2  = second & previous(abt1)
+    rej2  = second & previous(rej1)
+    
+    # Multiplicity, time mark LSBs of the last TIME record
+    last_time = last(time)
+    sdd_multiplicity = (record >> 24) & 0x1F
+    mult = np.where(last_time < 0, 0, np.where(sdd_multiplicity[last_time] > 1, 2, 1))
+    lsb_mismatch = pixel & ((last_time < 0) | (((record >> 20) & 0xF) != (record[last_time] & 0xF)))
+    if np.any(lsb_mismatch):
+        warnings["Time mark LSB mismatch"] += int(np.count_nonzero(lsb_mismatch))
+    # Quadrant of the last PIXEL record (for ABT entries)
+    last_pixel = last(pixel)
+    asic_id = np.where(last_pixel < 0, 0, (record[last_pixel] >> 29) & 3)
+    
+    # A new event starts at each TIME and REJ record; an ABT before any of them
+    # starts a fake event (timemark 0, multiplicity 0)
+    opened = time | rej1
+    first_open = np.argmax(opened) if np.any(opened) else n_records
+    fake = abt2 & (index < first_open) & (index == (np.argmax(abt2) if np.any(abt2) else -1))
+    if np.any(fake):
+        warnings["Fake event created (buffer starting with an ABT)"] += 1
+    opening = opened | fake
+    event_index = np.cumsum(opening) - 1
+    starts = np.nonzero(opening)[0]
+    # An event is dropped if the next one is a REJ event
+    kept = np.ones(len(starts), dtype=bool)
+    kept[:-1] = ~rej1[starts[1:]]
+    
+    entries = (pixel | abt2) & (event_index >= 0)
+    entries[entries] = kept[event_index[entries]]
+    rej_map = np.full(len(starts), -1, dtype=np.int64)
+    rej_map[event_index[rej2]] = record[rej2]
+    event_mult = np.where(time, sdd_multiplicity, np.where(rej1, -1, 0))[starts]
+    
+    pixel_ok = pixel
+    if event_filter is not None:
+        pixel_ok = pixel_ok & event_filter.pixel_mask(record, quadrant)
+    if monitor is not None:
+        channel = (record >> 24) & 0x1F
+        counts, span, noisy = monitor.check(channel[pixel], (record & 0xFFFFFF)[opened])
+        if channel_stats is not None:
+            channel_stats.append((counts, span, noisy))
+        if monitor.mask and noisy:
+            pixel_ok = pixel_ok & (((noisy >> channel) & 1) == 0)
+    
+    if event_filter is not None or pixel_ok is not pixel:
+        # An excluded event is kept, with multiplicity 0 and without pixels, if it carries
+        # an ABT (time reference of the next events of the quadrant) or if it is the first
+        # non-rejected event (zero point of the times): the writers skip these events,
+        # and the times of the selected events do not change
+        rejected = rej1[starts]
+        entry_event = np.where(entries, event_index, 0)
+        n_pixels = np.bincount(entry_event[entries & pixel], minlength=len(starts))
+        n_abt = np.bincount(entry_event[entries & abt2], minlength=len(starts))
+        selected = (np.bincount(entry_event[entries & pixel_ok], minlength=len(starts)) > 0) | (n_pixels == 0)
+        if event_filter is not None:
+            selected &= event_filter.event_mask(event_mult, quadrant)
+        first = np.zeros(len(starts), dtype=bool)
+        if np.any(kept & ~rejected):
+            first[np.argmax(kept & ~rejected)] = True
+        demoted = kept & ~selected & ~rejected & ((n_abt > 0) | first)
+        kept = kept & (selected | demoted)
+        event_mult[demoted] = 0
+        entries &= kept[entry_event] & np.where(demoted[entry_event], abt2, abt2 | pixel_ok | rejected[entry_event])
+        # The multiplicity (and the single/multiple type of the pixels) of the events
+        # that lost pixels counts the pixels left
+        n_left = np.bincount(entry_event[entries & pixel], minlength=len(starts))
+        reduced = kept & ~rejected & (n_left > 0) & (n_left < n_pixels)
+        event_mult[reduced] = n_left[reduced]
+        mult = np.where(reduced[entry_event], np.where(event_mult[entry_event] > 1, 2, 1), mult)
+    
+    columns = {}
+    columns["TIMEMARK"] = np.where(fake, 0, record & 0xFFFFFF)[starts][kept]
+    columns["MULT"]     = event_mult[kept]
+    columns["REJMAP"]   = rej_map[kept]
+    columns["NENTRIES"] = np.bincount(event_index[entries], minlength=len(starts))[kept]
+    
+    previous_record = np.concatenate([[0], record[:-1]])[:n_records]
+    columns["EVTYPE"]  = np.where(pixel, mult, 0)[entries]
+    columns["ASICID"]  = np.where(pixel, (record >> 29) & 3, asic_id)[entries]
+    columns["CHANNEL"] = np.where(pixel, (record >> 24) & 0x1F, 0)[entries]
+    columns["ADC"]     = np.where(pixel, record & 0xFFFF, 0)[entries]
+    columns["OBTS"]    = np.where(abt2, previous_record & 0x1FFFFFFF, 0)[entries]
+    columns["OBTNS"]   = np.where(abt2, record & 0x1FFFFFF, 0)[entries]
+    
+    if report_warnings:
+        log_warnings(warnings)
+    
+    counters = (int(np.count_nonzero(time)), int(np.count_nonzero(pixel)), int(np.count_nonzero(abt1)), int(np.count_nonzero(rej2)))
+    return columns, counters
+
+
+class EventFilter(object):
+    """
+    Selection of the events applied while decoding (see decodeRecordData),
+    so that the excluded records never become columns or Event objects
+    Input:
+        quadrants = quadrants to keep (None: all)
+        channels = channels to keep (None: all); a pixel on another channel is dropped,
+                   and an event without any selected pixel
+        no_rejected = drop the rejected (REJ) events
+        max_multiplicity = drop the events with a higher multiplicity
+    """
+    def __init__(self, quadrants=None, channels=None, no_rejected=False, max_multiplicity=None):
+        self.quadrants = None if quadrants is None else sorted(set(quadrants))
+        # Bit c set: channel c selected
+        self.channel_mask = None if channels is None else sum(1 << c for c in set(channels))
+        self.no_rejected = no_rejected
+        self.max_multiplicity = max_multiplicity
+
+    def pixel_mask(self, record, quadrant=None):
+        """
+        Selected PIXEL records (quadrant and channel)
+        """
+        mask = np.ones(len(record), dtype=bool)
+        if self.quadrants is not None and quadrant is not None and quadrant not in self.quadrants:
+            mask[:] = False
+        if self.channel_mask is not None:
+            mask &= ((self.channel_mask >> ((record >> 24) & 0x1F)) & 1).astype(bool)
+        return mask
+
+    def event_mask(self, multiplicity, quadrant=None):
+        """
+        Selected events, from their multiplicity (-1 for rejected events)
+        """
+        mask = np.ones(len(multiplicity), dtype=bool)
+        if self.quadrants is not None and quadrant is not None and quadrant not in self.quadrants:
+            mask[:] = False
+        if self.no_rejected:
+            mask &= multiplicity != -1
+        if self.max_multiplicity is not None:
+            mask &= multiplicity <= self.max_multiplicity
+        return mask
+
+
+# Records of a channel in a buffer below which it is never flagged as noisy
+NOISY_MIN_COUNTS = 20
+
+
+class ChannelMonitor(object):
+    """
+    Rate monitor of the (quadrant, channel) pixels, run while decoding (see decodeRecordData).
+    In each quadrant record list, the PIXEL records of each channel are counted with one
+    np.bincount, over the time spanned by the time marks of the list; a channel is noisy
+    if its rate is above threshold (and it has at least min_counts records).
+    The counts are kept in the headers (see Header.channelCounts) and summed over the
+    acquisition in the CHANMASK extension of the LV0 file, where the channels are also
+    flagged on the summed counts and exposure (NOISY column, see chanmask_hdu).
+    The check (and the mask) is on each buffer alone, with no state carried from one buffer
+    to the next: the files are decoded in separate processes in any order (--jobs), and a
+    running state would make the masked pixels depend on the scheduling.
+    Input:
+        threshold = [counts/s] rate above which a channel is noisy
+        min_counts = records below which a channel is never noisy
+        mask = drop the pixels of the noisy channels before the events are built
+               (and the events left without pixels, as with EventFilter)
+    """
+    def __init__(self, threshold, min_counts=NOISY_MIN_COUNTS, mask=False):
+        self.threshold = threshold
+        self.min_counts = min_counts
+        self.mask = mask
+
+    def check(self, channels, time_marks):
+        """
+        Input:
+            channels = channel of each PIXEL record of a quadrant record list
+            time_marks = 24 bit time marks of its events, in record order
+        Output:
+            counts per channel (32), time span [s], noisy channels bitmask (bit c: channel c)
+        """
+        counts = np.bincount(channels, minlength=32)
+        # Time marks wrap every 2**24 ticks of 100 ns
+        span = float(np.sum(np.diff(time_marks) % (1 << 24)))*1e-7
+        noisy = (counts >= self.min_counts) & (counts > self.threshold*span)
+        return counts, span, int(np.sum(noisy.astype(np.int64) << np.arange(32)))
+
+
+def events_from_columns(columns):
+    """
+    Event objects of the columns returned by decodeRecordData,
+    as returned by parseRecordData
+    """
+    time_mark = columns["TIMEMARK"].tolist()
+    mult      = columns["MULT"].tolist()
+    rej_map   = columns["REJMAP"].tolist()
+    n_entries = columns["NENTRIES"].tolist()
+    entries = zip(columns["EVTYPE"].tolist(), columns["ASICID"].tolist(), columns["CHANNEL"].tolist(),
+                  columns["ADC"].tolist(), columns["OBTS"].tolist(), columns["OBTNS"].tolist())
+    eventBuffer = []
+    for k in range(len(time_mark)):
+        event = Event(time_mark[k], mult[k])
+        event.pixelEvents = [PixelEvent(evtype, asicID=asicID, channel=channel, adc=adc, obt_s=obt_s, obt_ns=obt_ns)
+                             for evtype, asicID, channel, adc, obt_s, obt_ns in itertools.islice(entries, n_entries[k])]
+        if rej_map[k] >= 0:
+            event.rejectedMap = rej_map[k]
+        eventBuffer.append(event)
+    return eventBuffer
+
+
+def columns_from_events(events):
+    """
+    Columns of an Event list, as returned by decodeRecordData
+    (inverse of events_from_columns)
+    """
+    entries = [entry for event in events for entry in event.pixelEvents]
+    columns = {}
+    columns["TIMEMARK"] = np.array([event.time_mark for event in events], dtype=np.int64)
+    columns["MULT"]     = np.array([event.multiplicity for event in events], dtype=np.int64)
+    columns["REJMAP"]   = np.array([-1 if event.rejectedMap is None else event.rejectedMap for event in events], dtype=np.int64)
+    columns["NENTRIES"] = np.array([len(event.pixelEvents) for event in events], dtype=np.int64)
+    for key, attribute in [("EVTYPE", "evtype"), ("ASICID", "asicID"), ("CHANNEL", "channel"), ("ADC", "adc"),
+                           ("OBTS", "obt_s"), ("OBTNS", "obt_ns")]:
+        columns[key] = np.array([getattr(entry, attribute) for entry in entries], dtype=np.int64)
+    return columns
+
+
+def event_list_size(data):
+    """
+    Number of events and of event entries of a quadrant record list
+    (Event list, or decodeRecordData columns)
+    """
+    if isinstance(data, dict):
+        return len(data["TIMEMARK"]), len(data["EVTYPE"])
+    return len(data), sum(len(event.pixelEvents) for event in data)
+
+
+def quadrant_abt_columns(columns, obts, obterr, origin):
+    """
+    ABT bookkeeping of the LV0 writers on the decodeRecordData columns of a quadrant
+    record list, without Event objects: each event is timed with the ABT state left by
+    the previous events (the last ABT entry of a non-rejected event, or the given state
+    before the list), and the last ABT entry of a non-rejected event is the state of the next ones
+    Input:
+        columns = decodeRecordData columns
+        obts, obterr, origin = ABT state of the quadrant before the list
+                               (ABT seconds, 9999999 - ABT counter, origin for the shard merge)
+    Output:
+        dict of arrays, one value per event of the list: OBTS, OBTERR, ORIGIN (state the event is timed with),
+        ABT (the event carries an ABT), ABTS, ABTNS (its last ABT entry), PIXEL (entries that are pixels),
+        NPIXELS (pixels of the event), ENTRYEVT (event of each entry);
+        and state = ABT state after the list (obts, obterr, origin)
+    """
+    mult = columns["MULT"]
+    n_events = len(mult)
+    entry_event = np.repeat(np.arange(n_events), columns["NENTRIES"])
+    pixel = columns["EVTYPE"] != 0
+    # ABT entries of the rejected events are not used
+    abt = ~pixel & (mult[entry_event] > -1)
+    last_abt = np.full(n_events, -1, dtype=np.int64)
+    np.maximum.at(last_abt, entry_event[abt], np.nonzero(abt)[0])
+    carrier = last_abt >= 0
+    abt_obts = np.zeros(n_events, dtype=np.int64)
+    abt_obtns = np.zeros(n_events, dtype=np.int64)
+    abt_obts[carrier] = columns["OBTS"][last_abt[carrier]]
+    abt_obtns[carrier] = columns["OBTNS"][last_abt[carrier]]
+    # Last carrier before each event
+    previous = np.maximum.accumulate(np.where(carrier, np.arange(n_events), -1))
+    previous = np.concatenate([[-1], previous]).astype(np.int64)[:n_events]
+    found = previous >= 0
+    output = {"OBTS":     np.where(found, abt_obts[previous], obts).astype(np.float64),
+              "OBTERR":   np.where(found, 9999999 - abt_obtns[previous], obterr).astype(np.float64),
+              "ORIGIN":   np.where(found, 0, origin),
+              "ABT":      carrier,
+              "ABTS":     abt_obts,
+              "ABTNS":    abt_obtns,
+              "PIXEL":    pixel,
+              "NPIXELS":  np.bincount(entry_event[pixel], minlength=n_events),
+              "ENTRYEVT": entry_event}
+    if np.any(carrier):
+        last = np.nonzero(carrier)[0][-1]
+        output["state"] = (float(abt_obts[last]), float(9999999 - abt_obtns[last]), 0)
+    else:
+        output["state"] = (obts, obterr, origin)
+    return output
+
+
+def interleave_rows(event_row, event_values, abt_row, abt_values, dtype=np.int64):
+    """
+    Column of the LV0 EVENTS rows of a columnar quadrant record list,
+    with the event values at event_row and the ABT values at abt_row
+    """
+    column = np.zeros(len(event_row) + len(abt_row), dtype=dtype)
+    column[event_row] = event_values
+    column[abt_row] = abt_values
+    return column
+
+
+def concatenate_chunks(chunks, dtype=np.float64):
+    """
+    One array from the per-quadrant arrays collected by the LV0 writers on columnar readouts
+    """
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype)
+
+
+def log_warnings(warnings, where=""):
+    """
+    Log once the warnings accumulated in a collections.Counter
+    """
+    for message, count in warnings.items():
+        if count > 0:
+            logger.warning("WARNING: %s (%d occurrences)%s", message, count, where)
     
 
-def ingest_buffer(filein, verbose=True, aggregated=False):
+# Tolerant parsing: maximum ABT OBT step (s) from the previous buffer
+# for a header found while resynchronizing
+RESYNC_MAX_OBT_STEP = 86400
+
+
+def plausible_header(data, position, obt_reference=None, prefix=0, check_next=True):
+    """
+    Sanity checks of a candidate header at data[position+prefix:]
+    (prefix is the size of the aggregated header, if any):
+    the ABT 100 ns counter is in range, the ABT OBT is within RESYNC_MAX_OBT_STEP
+    of obt_reference (if given), and the record lists given by the record counters
+    fit in the data and, if check_next is True, end exactly at the end of the data
+    or before another header.
+    Output:
+        True if the header is plausible
+    """
+    header_size = 128
+    start = position + prefix
+    if start + header_size > len(data):
+        return False
+    if struct.unpack_from('I', data, start + 28)[0] > 9999999:
+        return False
+    if obt_reference is not None and abs(struct.unpack_from('I', data, start + 24)[0] - obt_reference) > RESYNC_MAX_OBT_STEP:
+        return False
+    end = start + header_size + 4*sum(struct.unpack_from('4I', data, start + 111))
+    if end == len(data) or (end < len(data) and not check_next):
+        return True
+    return end + prefix + header_size <= len(data) and struct.unpack_from('I', data, end + prefix + 28)[0] <= 9999999
+
+
+def find_next_header(data, position, obt_reference=None, prefix=0):
+    """
+    Resynchronize on the first plausible header (see plausible_header)
+    at or after data[position:]
+    Output:
+        position of the header (of the aggregated header if prefix > 0), None if not found
+    """
+    for candidate in range(position, len(data) - prefix - 128 + 1):
+        if plausible_header(data, candidate, obt_reference, prefix):
+            return candidate
+    return None
+
+
+def skip_bytes(skipped, filein, start, stop, reason):
+    """
+    Record a skipped byte range [start, stop) of a file in the skipped list
+    """
+    logger.warning("WARNING: skipping bytes %d-%d of %s: %s", start, stop, filein, reason)
+    skipped.append((filein, start, stop, reason))
+
+
+def ingest_buffer(filein, verbose=True, aggregated=False, decode_events=True, tolerant=False, skipped=None, columnar=False, data=None,
+                  event_filter=None, monitor=None):
     """
     Ingests a PDHU buffer file.
     Returns the Header and Event Data arrays found for each quadrant,
     i.e., an array of tuples (HEADER, [EVENT DATA])
     Input: 
-        filein = name of the binary buffer file
+        filein = name of the binary buffer file (decompressed if .gz, .xz or .bz2)
+        decode_events = if False, the record lists are skipped and
+                        the event data arrays are left empty (HK only)
+        columnar = if True, the record lists are decoded by decodeRecordData
+                   and the event data are its column dicts instead of Event lists
+                   (see share_readout)
+        tolerant = if True, corrupted buffers are skipped instead of exiting:
+                   parsing resumes at the next plausible header (see find_next_header)
+                   and the skipped byte ranges are appended to the skipped list
+                   as (filename, start, stop, reason)
+        data = content of the file, if already read (e.g. by FilePrefetcher)
+        event_filter = EventFilter applied while decoding (by decodeRecordData)
+        monitor = ChannelMonitor run while decoding: the channel counts and the noisy
+                  channels of each buffer are kept in its Header
     Output:
         array of tuples [(HEADER, [EVENT DATA]), ...]
     One element for each buffer found in the file (at least four elements, if one buffer per file)
@@ -543,26 +1034,44 @@ def ingest_buffer(filein, verbose=True, aggregated=False):
     # Initialise output
     output = []
     
+    if data is None and os.path.splitext(filein)[1] in COMPRESSED_OPENERS:
+        data = read_raw_file(filein)
     # Get buffer file size
-    filesize = os.path.getsize(filein)
+    filesize = os.path.getsize(filein) if data is None else len(data)
     
     header_size = 128
     aggHeader_size = 25
     
+    # Header dumps and per-record details only at DEBUG level
+    debug = verbose and logger.isEnabledFor(logging.DEBUG)
+    
     if aggregated:
-        print("*** PARSING AGGREGATED FILES ***")
+        logger.info("*** PARSING AGGREGATED FILES ***")
+    
+    if tolerant and skipped is None:
+        skipped = []
     
     try:
         assert filesize > header_size
     except AssertionError:
-        print("\n***ERROR***")
-        print("In buffer", filein)
-        print("Buffer file size smaller than minimum!")
-        print("Detected file size:", filesize,"\n")
+        if tolerant:
+            skip_bytes(skipped, filein, 0, filesize, "file smaller than a header")
+            return output
+        logger.error("***ERROR*** In buffer %s: buffer file size smaller than minimum! Detected file size: %d", filein, filesize)
         exit(1)
     
-    print(filein)
-    f = open(filein, "rb")
+    logger.info(filein)
+    if data is not None:
+        f = io.BytesIO(data)
+    elif tolerant:
+        # Keep the whole file in memory to look for the next header
+        with open(filein, "rb") as f:
+            data = f.read()
+        f = io.BytesIO(data)
+    else:
+        f = open(filein, "rb")
+    if tolerant:
+        obt_reference = None
     
     endOfFileReached = False
     output_buffer = None
@@ -572,18 +1081,30 @@ def ingest_buffer(filein, verbose=True, aggregated=False):
         if output_buffer is not None:
             output.append(output_buffer)
         output_buffer = []
+        
+        if tolerant:
+            position = f.tell()
+            prefix = aggHeader_size if aggregated else 0
+            if not plausible_header(data, position, obt_reference, prefix, check_next=False):
+                resync = find_next_header(data, position + 1, obt_reference, prefix)
+                if resync is None:
+                    skip_bytes(skipped, filein, position, filesize, "no plausible header until the end of file")
+                    break
+                skip_bytes(skipped, filein, position, resync, "implausible header, resynchronized")
+                f.seek(resync)
+            obt_reference = struct.unpack_from('I', data, f.tell() + prefix + 24)[0]
     
         if aggregated:
             # If the file has been aggregated with headers
             # parse skipping the headers
             # Parse the aggregated header
             my_bytes = f.read(aggHeader_size)
-            print("Parsed aggregated header.")
-            
-            for b in my_bytes:
-                print(hex(b), int(b), chr(b))
+            logger.debug("Parsed aggregated header.")
             
-            print(my_bytes)
+            if debug:
+                for b in my_bytes:
+                    logger.debug("%s %d %s", hex(b), int(b), chr(b))
+                logger.debug(my_bytes)
             
             # Aggregated header structure:
             # 8 byte: filename string
@@ -595,30 +1116,31 @@ def ingest_buffer(filein, verbose=True, aggregated=False):
             #agg_hypen    = struct.unpack('1s', my_bytes[14])[0]
             agg_filesize = struct.unpack('8s', my_bytes[15:23])[0]
             #agg_control  = struct.unpack('c', my_bytes[18])[0]
-            print("*** Aggregated header ***")
-            print("\t Filename", agg_filename)
-            print("\t Hypen", my_bytes[14])
-            print("\t Filesize", agg_filesize)
-            # print("\t Control", agg_control)
+            if debug:
+                logger.debug("*** Aggregated header ***")
+                logger.debug("\t Filename %s", agg_filename)
+                logger.debug("\t Hypen %s", my_bytes[14])
+                logger.debug("\t Filesize %s", agg_filesize)
+                # logger.debug("\t Control %s", agg_control)
             
     
         # Parse the header
         my_bytes = f.read(header_size)
-        print("Parsed an header.")
+        logger.debug("Parsed an header.")
 
         # Unpack the header
         header = Header(my_bytes)
     
-        if verbose:
+        if debug:
             # Print header info
             header.printGPSTime()
             header.printCSAC_HK()
             header.printBEE_HK()
             header.printDetectorTemperatures()
-            print("Record counter quadrant A: \t\t", header.recordCounter0)
-            print("Record counter quadrant B: \t\t", header.recordCounter1)
-            print("Record counter quadrant C: \t\t", header.recordCounter2)
-            print("Record counter quadrant D: \t\t", header.recordCounter3)
+            logger.debug("Record counter quadrant A: \t\t %d", header.recordCounter0)
+            logger.debug("Record counter quadrant B: \t\t %d", header.recordCounter1)
+            logger.debug("Record counter quadrant C: \t\t %d", header.recordCounter2)
+            logger.debug("Record counter quadrant D: \t\t %d", header.recordCounter3)
 
         # Parse the event data.
         # Fetch the next sum_i(4*header.recordCounter_i) bytes
@@ -628,50 +1150,72 @@ def ingest_buffer(filein, verbose=True, aggregated=False):
         counters = [header.recordCounter0, header.recordCounter1, header.recordCounter2, header.recordCounter3]
     
         assert len(counters) == 4
+        
+        # Repeated warnings are counted and reported once per buffer
+        warnings = collections.Counter()
+        
+        # Parsed TIME, PIXEL, ABT, REJ records and time mark LSB mismatches
+        # of each quadrant, for the data-quality checks (see compute_DQ)
+        if decode_events:
+            header.parsedCounters = np.zeros((4, len(DQ_PARSED_FIELDS)), dtype=np.int64)
+        if decode_events and monitor is not None:
+            header.channelCounts = np.zeros((4, 32), dtype=np.int64)
+            header.channelSpan = np.zeros(4)
+            header.noisyChannels = np.zeros(4, dtype=np.int64)
     
         for asicid, quadrant in enumerate(counters):
-            print("Reading quadrant", asicid, "with", counters[asicid], "records...")
+            logger.debug("Reading quadrant %d with %d records...", asicid, counters[asicid])
         
-            if counters[asicid] > 0:
+            if counters[asicid] > 0 and not decode_events:
+                # Only the header is needed: skip the record list
+                f.seek(min(f.tell() + 4*counters[asicid], filesize))
+                header.ASIC_ID = asicid
+                output_buffer.append((header, []))
+            elif counters[asicid] > 0:
                 # If the expected number of records is greater than zero,
                 # read out 4 bytes for each record
                 record_list_bytes = 4*counters[asicid]
                 my_bytes = f.read(record_list_bytes)
         
                 # Unpack the event data buffer
-                eventBuffer, (timeCounter, pixelCounter, abtCounter, rejCounter) = parseRecordData(my_bytes)
+                lsb_mismatch = warnings["Time mark LSB mismatch"]
+                if columnar or event_filter is not None or monitor is not None:
+                    channel_stats = []
+                    eventBuffer, (timeCounter, pixelCounter, abtCounter, rejCounter) = decodeRecordData(my_bytes, warnings=warnings, tolerant=tolerant,
+                                                                                                        event_filter=event_filter, quadrant=asicid,
+                                                                                                        monitor=monitor, channel_stats=channel_stats)
+                    if channel_stats:
+                        header.channelCounts[asicid], header.channelSpan[asicid], header.noisyChannels[asicid] = channel_stats[0]
+                        if header.noisyChannels[asicid]:
+                            warnings["Noisy channels" + (" masked" if monitor.mask else "")] += bin(header.noisyChannels[asicid]).count("1")
+                    if not columnar:
+                        eventBuffer = events_from_columns(eventBuffer)
+                else:
+                    eventBuffer, (timeCounter, pixelCounter, abtCounter, rejCounter) = parseRecordData(my_bytes, verbose=verbose, warnings=warnings, tolerant=tolerant)
+                lsb_mismatch = warnings["Time mark LSB mismatch"] - lsb_mismatch
+                header.parsedCounters[asicid] = [timeCounter, pixelCounter, abtCounter, rejCounter, lsb_mismatch]
                 header.ASIC_ID = asicid
         
                 # Add to the output the (header, event_data) tuple read out just now 
                 output_buffer.append((header, eventBuffer))
                         
-                # Debug code                
-                # print(  "Triggers: ", header.BEE_HK["TriggerCounter"][asicid], \
-                #         "Events: ", header.BEE_HK["EventCounter"][asicid], \
-                #         "Rejected events: ", header.BEE_HK["RejectedCounter"][asicid], \
-                #         "Overflow events: ", header.BEE_HK["OverflowCounter"][asicid])
-                # print("Check if BEE counters match:", header.BEE_HK["TriggerCounter"][asicid]==\
-                #     header.BEE_HK["EventCounter"][asicid]+header.BEE_HK["RejectedCounter"][asicid]+header.BEE_HK["OverflowCounter"][asicid])
-                #
-                # print("TIME events: ", timeCounter, "PIXEL events: ", pixelCounter, "ABT events: ", abtCounter, "REJ events: ", rejCounter)
-                # if timeCounter + pixelCounter + rejCounter + abtCounter*2 == counters[asicid]:
-                #     print("Parsed all records")
-                # else:
-                #     print("*** MISMATCH ***", timeCounter + pixelCounter + rejCounter + abtCounter*2)
-                # print("*** DEVIATION ", header.BEE_HK["EventCounter"][asicid]-timeCounter, (header.BEE_HK["EventCounter"][asicid]-timeCounter)/timeCounter)
+                # The counter consistency checks are done on all the buffers at once
+                # when the LV0 file is written (see compute_DQ)
             else:
-                print("Flushing quadrants with zero counts...")
+                logger.debug("Flushing quadrants with zero counts...")
                 output_buffer.append((header, []))
+        
+        log_warnings(warnings, " in buffer {:d} of {:s}".format(len(output), filein))
     
         if f.tell() == filesize:
-            print("End of file reached.\n\n")
+            logger.debug("End of file reached.")
             # Final flush
             if output_buffer is not None:
                 output.append(output_buffer)
             endOfFileReached = True
         else:
-            print("We are at byte", f.tell(), "of filesize", filesize)
-            print("Continue reading...")
+            logger.debug("We are at byte %d of filesize %d", f.tell(), filesize)
+            logger.debug("Continue reading...")
             
     f.close()
     return output
@@ -681,6 +1225,117 @@ def ingest_buffer(filein, verbose=True, aggregated=False):
 
 
 
+# Columns of decodeRecordData and their dtypes in the shared memory blocks
+SHARED_EVENT_COLUMNS = [("TIMEMARK", np.int32), ("MULT", np.int8), ("REJMAP", np.int64), ("NENTRIES", np.int32)]
+SHARED_ENTRY_COLUMNS = [("EVTYPE", np.int8), ("ASICID", np.int8), ("CHANNEL", np.int8), ("ADC", np.int32),
+                        ("OBTS", np.int32), ("OBTNS", np.int32)]
+
+
+def share_readout(readout):
+    """
+    Copy the output of ingest_buffer(columnar=True) to one shared memory block,
+    so that a worker process returns only its descriptor instead of pickling
+    the Header and Event objects (see attach_readout)
+    Input:
+        readout = list of buffers, each a list of (header, columns) tuples (one per quadrant)
+    Output:
+        descriptor = (block name, [(key, dtype, shape, offset), ...])
+    """
+    headers = [buf[0][0] for buf in readout]
+    arrays = collections.OrderedDict()
+    arrays["HEADER"] = np.frombuffer(b"".join(header.headerBytes for header in headers), dtype=np.uint8).reshape(len(headers), 128)
+    # ASIC_ID is set by ingest_buffer only if a quadrant has records
+    arrays["ASIC_ID"] = np.array([getattr(header, "ASIC_ID", -1) for header in headers], dtype=np.int64)
+    arrays["PARSED"] = np.array([header.parsedCounters for header in headers], dtype=np.int64).reshape(len(headers), 4, len(DQ_PARSED_FIELDS))
+    if headers and headers[0].channelCounts is not None:
+        arrays["CHANCNT"] = np.array([header.channelCounts for header in headers], dtype=np.int64).reshape(len(headers), 4, 32)
+        arrays["CHANSPAN"] = np.array([header.channelSpan for header in headers], dtype=np.float64).reshape(len(headers), 4)
+        arrays["NOISY"] = np.array([header.noisyChannels for header in headers], dtype=np.int64).reshape(len(headers), 4)
+    quadrants = [data for buf in readout for header, data in buf if len(data) > 0]
+    arrays["NEVENTS"] = np.array([[len(data["TIMEMARK"]) if len(data) > 0 else 0 for header, data in buf] for buf in readout], dtype=np.int64).reshape(len(readout), 4)
+    for key, dtype in SHARED_EVENT_COLUMNS + SHARED_ENTRY_COLUMNS:
+        arrays[key] = np.concatenate([data[key] for data in quadrants]).astype(dtype) if quadrants else np.zeros(0, dtype=dtype)
+    
+    # Arrays are aligned to 8 bytes in the block
+    layout = []
+    size = 0
+    for key, array in arrays.items():
+        layout.append((key, array.dtype.str, array.shape, size))
+        size += (array.nbytes + 7)//8*8
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for (key, dtype, shape, offset), array in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)[...] = array
+    # The block is unlinked by attach_readout in the parent
+    block.close()
+    return block.name, layout
+
+
+def attach_readout(descriptor, blocks):
+    """
+    Rebuild the ingest_buffer(columnar=True) output from a block written by share_readout,
+    without copying the event data: the columns are views of the block (slices of one
+    array per column), which the writers use as they are, and no Event objects are made
+    in the parent. The block name is released at once (the memory stays mapped), and
+    the block is appended to blocks, to be closed by release_blocks once the writers
+    have built their tables.
+    Output:
+        list of buffers, each a list of (Header, columns) tuples (one per quadrant)
+    """
+    name, layout = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    block.unlink()
+    blocks.append(block)
+    arrays = {key: np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset) for key, dtype, shape, offset in layout}
+    event_start = np.concatenate([[0], np.cumsum(arrays["NEVENTS"].reshape(-1))])
+    entry_start = np.concatenate([[0], np.cumsum(arrays["NENTRIES"])])
+    readout = []
+    for i in range(len(arrays["HEADER"])):
+        header = Header(arrays["HEADER"][i].tobytes())
+        if arrays["ASIC_ID"][i] >= 0:
+            header.ASIC_ID = int(arrays["ASIC_ID"][i])
+        header.parsedCounters = arrays["PARSED"][i].copy()
+        if "CHANCNT" in arrays:
+            header.channelCounts = arrays["CHANCNT"][i].copy()
+            header.channelSpan = arrays["CHANSPAN"][i].copy()
+            header.noisyChannels = arrays["NOISY"][i].copy()
+        buf = []
+        for k in range(4):
+            first, last = event_start[4*i + k], event_start[4*i + k + 1]
+            columns = {key: arrays[key][first:last] for key, dtype in SHARED_EVENT_COLUMNS}
+            columns.update((key, arrays[key][entry_start[first]:entry_start[last]]) for key, dtype in SHARED_ENTRY_COLUMNS)
+            buf.append((header, columns))
+        readout.append(buf)
+    return readout
+
+
+# Blocks still referred to by arrays when release_blocks was called: closing them
+# would fail, they stay mapped until the end of the process
+BUSY_BLOCKS = []
+
+
+def release_blocks(blocks):
+    """
+    Close the blocks attached by attach_readout, once the arrays of their readouts
+    are no longer used (their names are already released)
+    """
+    while blocks:
+        block = blocks.pop()
+        try:
+            block.close()
+        except BufferError:
+            logger.debug("Shared memory block %s still in use", block.name)
+            BUSY_BLOCKS.append(block)
+
+
+def release_readout(descriptor):
+    """
+    Release a block written by share_readout without reading it
+    """
+    block = shared_memory.SharedMemory(name=descriptor[0])
+    block.close()
+    block.unlink()
+
+
 def ingest_BEE_file(filein, verbose=True, len_packet_file=False):
     """
     Ingests a BEE ASCII buffer file.
@@ -817,14 +1472,190 @@ def ingest_BEE_file(filein, verbose=True, len_packet_file=False):
     print("Length of the final event buffer:", len(final_event_buffer))
    
     return [(None, eventBuffer)]
-    
-    
-    
-def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=True, gps_ok=False, fm="FM2"):
+
+
+
+class MemoryProfiler(object):
+    """
+    Optional memory accounting for the conversion pipeline.
+    Each (product, stage) pair records:
+        peak traced memory (tracemalloc) during the stage
+        retained traced memory at the end of the stage
+        peak and final RSS, sampled by a background thread
+        top allocation sites (tracemalloc snapshot difference)
+    Stages are opened with begin(), which closes the previous one,
+    and the last one is closed with end().
+    """
+    def __init__(self, top=10, sample_interval=0.05, nframes=1):
+        self.top = top
+        self.sample_interval = sample_interval
+        self.nframes = nframes
+        self.records = []
+        self._current = None
+        self._rss_peak = 0
+        self._sampler = None
+        self._stop_sampler = threading.Event()
+
+    @staticmethod
+    def rss():
+        """
+        Current resident set size in bytes
+        (falls back to the maximum RSS where /proc is not available)
+        """
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop_sampler.wait(self.sample_interval):
+            self._rss_peak = max(self._rss_peak, self.rss())
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.nframes)
+        self._stop_sampler.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self.end()
+        if self._sampler is not None:
+            self._stop_sampler.set()
+            self._sampler.join()
+            self._sampler = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @staticmethod
+    def snapshot():
+        # Do not account for the profiler's own allocations
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def begin(self, product, stage):
+        """
+        Close the current stage (if any) and open a new one
+        """
+        if self._sampler is None:
+            self.start()
+        self.end()
+        tracemalloc.reset_peak()
+        rss = self.rss()
+        self._rss_peak = rss
+        self._current = {"product": product,
+                         "stage": stage,
+                         "traced_start": tracemalloc.get_traced_memory()[0],
+                         "rss_start": rss,
+                         "snapshot": self.snapshot()}
+
+    def end(self):
+        """
+        Close the current stage and store its record
+        """
+        if self._current is None:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        rss = self.rss()
+        snapshot = self.snapshot()
+        stats = snapshot.compare_to(self._current["snapshot"], "lineno")
+        self.records.append({"product": self._current["product"],
+                             "stage": self._current["stage"],
+                             "traced_peak": peak - self._current["traced_start"],
+                             "traced_retained": current - self._current["traced_start"],
+                             "rss_peak": max(self._rss_peak, rss),
+                             "rss_retained": rss - self._current["rss_start"],
+                             "top": [(str(s.traceback), s.size_diff, s.count_diff) for s in stats[:self.top]]})
+        self._current = None
+
+    def report(self, filename=None):
+        """
+        Print the per-stage memory report
+        (and dump it as JSON if a filename is given)
+        """
+        mb = 1024.**2
+        print("\n*** MEMORY REPORT ***\n")
+        print("{:<12s} {:<12s} {:>14s} {:>14s} {:>14s} {:>14s}".format(
+              "Product", "Stage", "Peak [MB]", "Retained [MB]", "RSS peak [MB]", "RSS diff [MB]"))
+        for r in self.records:
+            print("{:<12s} {:<12s} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f}".format(
+                  r["product"], r["stage"], r["traced_peak"]/mb, r["traced_retained"]/mb, r["rss_peak"]/mb, r["rss_retained"]/mb))
+        print()
+        products = []
+        for r in self.records:
+            if r["product"] not in products:
+                products.append(r["product"])
+        for product in products:
+            stages = [r for r in self.records if r["product"] == product]
+            print("{:<12s} {:<12s} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f}".format(
+                  product, "TOTAL", max(r["traced_peak"] for r in stages)/mb, sum(r["traced_retained"] for r in stages)/mb,
+                  max(r["rss_peak"] for r in stages)/mb, sum(r["rss_retained"] for r in stages)/mb))
+        for r in self.records:
+            print("\nTop allocation sites for", r["product"], "/", r["stage"])
+            for site, size_diff, count_diff in r["top"]:
+                print("\t {:>10.1f} kB {:>+10d} blocks \t {:s}".format(size_diff/1024., count_diff, site))
+
+        if filename is not None:
+            with open(filename, "w") as f:
+                json.dump(self.records, f, indent=1)
+
+
+def profile_stage(profiler, product, stage=None):
+    """
+    Open a profiler stage (or close the current one if stage is None).
+    Does nothing if profiling is disabled
+    """
+    if profiler is None:
+        return
+    if stage is None:
+        profiler.end()
+    else:
+        profiler.begin(product, stage)
+
+
+# Light curves (RATE product): SRA ratemeter band names, default ADC band edges and bin widths
+RATE_BAND_NAMES = ["LOW", "MID", "HIG"]
+RATE_BAND_EDGES = (0, 20000, 40000, 65536)
+RATE_BINWIDTHS = (0.1, 1.0, 10.0)
+
+# Time bin of the REJSTATS rejection counts (s)
+REJSTATS_BINWIDTH = 1.0
+
+# ADC channels per bin of the SPECTRUM histograms
+SPECTRUM_BINSIZE = 4
+
+# Burst trigger: base bin, timescales and background window (s), significance threshold
+TRIGGER_BINSIZE = 0.01
+TRIGGER_TIMESCALES = (0.1, 1.0, 4.0)
+TRIGGER_BKG_WINDOW = 20.0
+TRIGGER_THRESHOLD = 5.0
+
+# GTI: maximum time gap (s) between the events of consecutive buffers (with --gti-max-gap),
+# and missing-file tolerance in units of the median file cadence
+GTI_MAX_GAP = 1.0
+GTI_CADENCE_TOLERANCE = 1.5
+
+# Data-quality checks: flag name (bit n of DQFLAGS) and description
+DQ_FLAGS = [("COUNTERS", "Trigger counter != event + rejected + overflow counters"),
+            ("RECORDS",  "Parsed records != header record counter"),
+            ("TIMEMARK", "Time mark LSB mismatch between TIME and PIXEL records"),
+            ("OBTRESET", "ABT OBT lower than in the previous buffer"),
+            ("ABTCNT",   "ABT 100 ns counter out of range")]
+# Columns of Header.parsedCounters
+DQ_PARSED_FIELDS = ["TIME", "PIXEL", "ABT", "REJ", "LSBMISMATCH"]
+
+
+def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=True, gps_ok=False, fm="FM2", profiler=None, compress=False, threads=None, writer=None,
+                    shard=None, preview=None):
     """
     Write HERMES level 0.5 FITS file
+    If shard is given (index of the first packet of a file range), a partial product
+    is written, to be merged with the other shards by merge_LV0d5
+    If preview is given, the product is flagged as a preview (see set_preview_keywords)
     """
     print("\n*** WRITING LV0.5 FITS FILE ***\n")
+    profile_stage(profiler, "LV0.5", "count")
     
     # Number of packets: one packet corresponds to one file
     # However, one file can have more buffers!
@@ -839,6 +1670,8 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
     n_headers = 0
     n_time_events = 0
     n_total_events = 0
+    # Event data as decodeRecordData columns (e.g. from attach_readout) instead of Event lists
+    columnar = False
     for i,packet in enumerate(packets_readout):
         #print("Number of buffers in packet ID {:d}: {:d}".format(i,len(packet)))
         n_buffers += len(packet)
@@ -848,13 +1681,15 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
             assert len(buf) == 4
             for k,evlist in enumerate(buf):
                 a,b = evlist
-                n_time_events += len(b)
-                for event in b:
-                    n_total_events += len(event.pixelEvents)
+                n_events, n_entries = event_list_size(b)
+                n_time_events += n_events
+                n_total_events += n_entries
+                columnar = columnar or isinstance(b, dict)
     print("Number of buffers:", n_buffers)    
     print("Number of headers:", n_headers)    
     print("Number of time events:", n_time_events)
     print("Number of total event entries:", n_total_events)
+    profile_stage(profiler, "LV0.5", "collect")
         
     
     if write_packets_extension:
@@ -916,6 +1751,15 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
     obt_read_from_abtEvt_previous = np.zeros(4)
     obt_nsec_difference_previous  = np.zeros(4)
     
+    # Packets that do not follow the previous one (preview), where the ABT state restarts from the header
+    packet_breaks = preview_breaks(preview)
+    
+    # Origin of the ABT values of each quadrant, for the shard merge:
+    # 0 = read from an ABT record, 1 (2) = state (previous state) at the start of the shard
+    origin_current  = np.ones(4, dtype=int)
+    origin_previous = np.full(4, 2, dtype=int)
+    events_origin   = []
+    
     for i,packet in enumerate(packets_readout):
         # print("Parsing packet ID {:d} with {:d} buffers".format(i,len(packet)))
         
@@ -971,8 +1815,10 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
             
                         kp += 1
             
-                    if j==0 and i==0:
+                    if j==0 and (i==0 or (packet_breaks is not None and packet_breaks[i])):
                         # Get the ABT from the first packet and first buffer in the acquisition
+                        # (or of a preview file that does not follow the previous one: the ABT
+                        # state of a file decoded N files earlier does not apply)
                         if write_packets_extension:
                             # obt_read_from_abtEvt[header.ASIC_ID] = header.BEE_HK["ABT_OBT"]
                             # obt_nsec_difference[header.ASIC_ID] = 9999999 - header.BEE_HK["ABT_CNT"]
@@ -991,10 +1837,56 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
                             obt_nsec_difference            = np.zeros(4)
                             obt_read_from_abtEvt_previous  = np.zeros(4)
                             obt_nsec_difference_previous   = np.zeros(4)
+                        if i > 0:
+                            # Times after a preview break do not depend on the previous shard
+                            origin_current[:] = 0
+                            origin_previous[:] = 0
             
                 # The k-th buffer is the same as asicID
                 asicid = k
 
+                if isinstance(data, dict):
+                    # Columns of decodeRecordData: the same rows as below, one array per quadrant
+                    abt_columns = quadrant_abt_columns(data, obt_read_from_abtEvt_previous[asicid], obt_nsec_difference_previous[asicid],
+                                                       origin_previous[asicid])
+                    rows = np.nonzero(data["MULT"] > -1)[0]
+                    events_packetID.append(np.full(len(rows), i))
+                    events_bufferID.append(np.full(len(rows), j))
+                    events_evtID.append(rows)
+                    events_evtype.append(np.where(data["MULT"][rows] > 1, 2, 1))
+                    events_obts.append(abt_columns["OBTS"][rows])
+                    events_obterr.append(abt_columns["OBTERR"][rows])
+                    if shard is not None:
+                        events_origin.append(abt_columns["ORIGIN"][rows])
+                    events_time_mark.append(data["TIMEMARK"][rows])
+                    events_quadid.append(np.full(len(rows), asicid))
+                    events_nmult.append(data["MULT"][rows])
+                    # First 6 pixels, only if the event has at most 6 entries
+                    entry_event = abt_columns["ENTRYEVT"]
+                    pixel = abt_columns["PIXEL"]
+                    rank = np.cumsum(pixel) - 1 - (np.cumsum(abt_columns["NPIXELS"]) - abt_columns["NPIXELS"])[entry_event]
+                    pixel = pixel & (data["NENTRIES"] <= 6)[entry_event]
+                    pixel_channel = np.zeros((len(data["MULT"]), 6)) - 1
+                    pixel_adc     = np.zeros((len(data["MULT"]), 6)) - 1
+                    pixel_channel[entry_event[pixel], rank[pixel]] = data["CHANNEL"][pixel]
+                    pixel_adc[entry_event[pixel], rank[pixel]]     = data["ADC"][pixel]
+                    events_channel_0.append(pixel_channel[rows, 0])
+                    events_channel_1.append(pixel_channel[rows, 1])
+                    events_channel_2.append(pixel_channel[rows, 2])
+                    events_channel_3.append(pixel_channel[rows, 3])
+                    events_channel_4.append(pixel_channel[rows, 4])
+                    events_channel_5.append(pixel_channel[rows, 5])
+                    events_adc_0.append(pixel_adc[rows, 0])
+                    events_adc_1.append(pixel_adc[rows, 1])
+                    events_adc_2.append(pixel_adc[rows, 2])
+                    events_adc_3.append(pixel_adc[rows, 3])
+                    events_adc_4.append(pixel_adc[rows, 4])
+                    events_adc_5.append(pixel_adc[rows, 5])
+                    if np.any(abt_columns["ABT"]):
+                        obt_read_from_abtEvt[asicid], obt_nsec_difference[asicid], origin_current[asicid] = abt_columns["state"]
+                        obt_read_from_abtEvt_previous[asicid], obt_nsec_difference_previous[asicid], origin_previous[asicid] = abt_columns["state"]
+                    continue
+
                 for m, event in enumerate(data):                
                     # Initialise arrays
                     mult = event.multiplicity
@@ -1011,6 +1903,7 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
                                 # independently for each quadrant
                                 obt_read_from_abtEvt[asicid] = entry.obt_s
                                 obt_nsec_difference[asicid]  = 9999999 - entry.obt_ns
+                                origin_current[asicid] = 0
                                 isThereAnABT = True
                             else: 
                                 # Loop on the pixelEvents array
@@ -1035,6 +1928,8 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
                              events_evtype.append(1)
                         events_obts.append(obt_read_from_abtEvt_previous[asicid])
                         events_obterr.append(obt_nsec_difference_previous[asicid])
+                        if shard is not None:
+                            events_origin.append(origin_previous[asicid])
                         # time_of_event = (event.time_mark - obt_nsec_difference_previous[asicid])*1e-7 \
                         #                 + obt_read_from_abtEvt_previous[asicid]
                         # events_time.append(time_of_event)
@@ -1058,7 +1953,34 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
                         if isThereAnABT:
                             obt_read_from_abtEvt_previous[asicid] = obt_read_from_abtEvt[asicid]
                             obt_nsec_difference_previous[asicid] = obt_nsec_difference[asicid]
+                            origin_previous[asicid] = origin_current[asicid]
 
+    if columnar:
+        # One array per column
+        events_packetID  = concatenate_chunks(events_packetID, np.int64)
+        events_bufferID  = concatenate_chunks(events_bufferID, np.int64)
+        events_evtID     = concatenate_chunks(events_evtID, np.int64)
+        events_evtype    = concatenate_chunks(events_evtype, np.int64)
+        events_obts      = concatenate_chunks(events_obts)
+        events_obterr    = concatenate_chunks(events_obterr)
+        events_origin    = concatenate_chunks(events_origin, np.int64)
+        events_time_mark = concatenate_chunks(events_time_mark, np.int64)
+        events_quadid    = concatenate_chunks(events_quadid, np.int64)
+        events_nmult     = concatenate_chunks(events_nmult, np.int64)
+        events_channel_0 = concatenate_chunks(events_channel_0)
+        events_channel_1 = concatenate_chunks(events_channel_1)
+        events_channel_2 = concatenate_chunks(events_channel_2)
+        events_channel_3 = concatenate_chunks(events_channel_3)
+        events_channel_4 = concatenate_chunks(events_channel_4)
+        events_channel_5 = concatenate_chunks(events_channel_5)
+        events_adc_0     = concatenate_chunks(events_adc_0)
+        events_adc_1     = concatenate_chunks(events_adc_1)
+        events_adc_2     = concatenate_chunks(events_adc_2)
+        events_adc_3     = concatenate_chunks(events_adc_3)
+        events_adc_4     = concatenate_chunks(events_adc_4)
+        events_adc_5     = concatenate_chunks(events_adc_5)
+    
+    profile_stage(profiler, "LV0.5", "arrays")
     events_time_mark = np.array(events_time_mark)
     events_obts      = np.array(events_obts)
     events_obterr    = np.array(events_obterr)
@@ -1093,7 +2015,20 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
         met_offset = 0
     # Add to events_time
     events_time += met_offset
+    
+    if shard is not None:
+        # Boundary state of the shard (see merge_LV0d5)
+        shard_hdus = make_shard_hdus(shard, packets_readout, met_offset, None,
+                                     events_time_mark, events_quadid, events_evtype, events_origin,
+                                     events_obts, events_obterr, np.array(events_nmult) > 0,
+                                     obt_read_from_abtEvt, obt_nsec_difference, origin_current,
+                                     obt_read_from_abtEvt_previous, obt_nsec_difference_previous, origin_previous)
+        packet_offset = shard
+    else:
+        shard_hdus = []
+        packet_offset = 0
         
+    profile_stage(profiler, "LV0.5", "hdu")
     # Extensions
     if write_packets_extension:
         #sel_single_pkt = np.array([np.where(packetID == x)[0][0] for x in set(packetID)])
@@ -1102,7 +2037,7 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
         t1hdu = pyfits.BinTableHDU.from_columns([
                                                   pyfits.Column(name='PACKETID',
                                                                 format='1J',
-                                                                array=packetID[sel_single_pkt]),
+                                                                array=packetID[sel_single_pkt] + packet_offset),
                                                   pyfits.Column(name='BUFFERID',
                                                                 format='1J',
                                                                 array=bufferID[sel_single_pkt]),
@@ -1178,7 +2113,7 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
     t2hdu = pyfits.BinTableHDU.from_columns([
                                               pyfits.Column(name='PACKETID',
                                                             format='1J',
-                                                            array=np.array(events_packetID)[mask_fake_events]),
+                                                            array=np.array(events_packetID)[mask_fake_events] + packet_offset),
                                               pyfits.Column(name='BUFFERID',
                                                             format='1J',
                                                             array=np.array(events_bufferID)[mask_fake_events]),
@@ -1247,6 +2182,8 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
     # Write FITS file
     # "Null" primary array
     prhdu = pyfits.PrimaryHDU()
+    if preview is not None:
+        set_preview_keywords(prhdu.header, preview)
     
     if write_packets_extension:
         t1hdu.header.set('EXTNAME', 'PACKETS', 'Name of this binary table extension')
@@ -1260,18 +2197,45 @@ def writeFITS_LV0d5(packets_readout, outputfilename, write_packets_extension=Tru
     t2hdu.header.set('INSTRUME', fm,  'Instrument name')
 
     if write_packets_extension:
-        hdulist = pyfits.HDUList([prhdu, t1hdu, t2hdu])
+        hdulist = pyfits.HDUList([prhdu, t1hdu, t2hdu] + shard_hdus)
     else:
-        hdulist = pyfits.HDUList([prhdu, t2hdu])
-    hdulist.writeto(outputfilename, overwrite=True)
+        hdulist = pyfits.HDUList([prhdu, t2hdu] + shard_hdus)
+    profile_stage(profiler, "LV0.5", "write")
+    write_hdulist(hdulist, outputfilename, checksum=False, compress=compress, threads=threads, writer=writer)
+    profile_stage(profiler, "LV0.5")
     
     
     
-def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True, gps_ok=False, ORTrigger=False, fm="FM2"):
+def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True, gps_ok=False, ORTrigger=False, fm="FM2", profiler=None, npy_dir=None, compress=False, threads=None, writer=None,
+                  rate_outputfilename=None, rate_binwidths=RATE_BINWIDTHS, rate_band_edges=RATE_BAND_EDGES, time_sorted=False,
+                  file_times=None, gti_max_gap=None, skipped=None, shard=None, preview=None, channel_monitor=None,
+                  rejstats_outputfilename=None, rejstats_binwidth=REJSTATS_BINWIDTH):
     """
     Write HERMES level 0 FITS file
+    If npy_dir is given, the PACKETS, EVENTS and REJECTED tables are also
+    exported there as memory-mappable .npy files (see writeNPY)
+    If rate_outputfilename is given, the light curves of the events are also
+    written there (see writeFITS_RATE)
+    If rejstats_outputfilename is given, the rejections of each channel per time bin
+    are also written there (see writeFITS_REJSTATS)
+    If outputfilename is None, the LV0 file itself is not written
+    If time_sorted is True, the EVENTS rows are sorted by TIME
+    (instead of packet/buffer/quadrant order), each ABT row following its event
+    The GTIs are built from the buffer sequence (see compute_GTI);
+    file_times (e.g. the hex timestamps of the file names) are used to detect missing files
+    If skipped is given (see ingest_buffer), the skipped byte ranges are listed in a SKIPPED extension
+    If shard is given (index of the first packet of a file range), a partial product
+    is written, to be merged with the other shards by merge_LV0
+    If preview is given, the product is flagged as a preview (see set_preview_keywords):
+    the GTIs are broken between files that are not consecutive, the ONTIME and the number
+    of events are extrapolated to all the files, and the RATE light curves get the fraction
+    of each bin covered by the GTIs (FRACEXP)
+    If channel_monitor is given (the ChannelMonitor run by ingest_buffer), the channel counts
+    are summed in a CHANMASK extension and the noisy channels of each buffer are in the
+    NOISYMAP column of the PACKETS extension
     """
     print("\n*** WRITING LV0 FITS FILE ***\n")
+    profile_stage(profiler, "LV0", "count")
     
     # Number of packets: one packet corresponds to one file
     # However, one file can have more buffers!
@@ -1286,6 +2250,8 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
     n_headers = 0
     n_time_events = 0
     n_total_events = 0
+    # Event data as decodeRecordData columns (e.g. from attach_readout) instead of Event lists
+    columnar = False
     for i,packet in enumerate(packets_readout):
         #print("Number of buffers in packet ID {:d}: {:d}".format(i,len(packet)))
         n_buffers += len(packet)
@@ -1295,13 +2261,15 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
             assert len(buf) == 4
             for k,evlist in enumerate(buf):
                 a,b = evlist
-                n_time_events += len(b)
-                for event in b:
-                    n_total_events += len(event.pixelEvents)
+                n_events, n_entries = event_list_size(b)
+                n_time_events += n_events
+                n_total_events += n_entries
+                columnar = columnar or isinstance(b, dict)
     print("Number of buffers:", n_buffers)    
     print("Number of headers:", n_headers)    
     print("Number of time events:", n_time_events)
     print("Number of total event entries:", n_total_events)        
+    profile_stage(profiler, "LV0", "collect")
     
     if write_packets_extension:
         # Extension 1 is "PACKETS". 
@@ -1328,6 +2296,8 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
         record_counter1      = np.zeros(n_buffers)
         record_counter2      = np.zeros(n_buffers)
         record_counter3      = np.zeros(n_buffers)
+        parsed_counters      = np.zeros((n_buffers,4,len(DQ_PARSED_FIELDS)), dtype=np.int64)
+        parsed_ok            = True
         
     
     # Extension 2 is "EVENTS"
@@ -1343,6 +2313,8 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
     events_nmult        = []
     events_channel      = []
     events_adc          = []
+    # Pixels of each row, for the columnar readouts
+    events_npixels      = []
     
     # Extension 4 (if present) is "REJECTED"
     rejected_packetID     = []
@@ -1362,6 +2334,14 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
     obt_read_from_abtEvt_previous = np.zeros(4)
     obt_nsec_difference_previous  = np.zeros(4)
     
+    # Packets that do not follow the previous one (preview), where the ABT state restarts from the header
+    packet_breaks = preview_breaks(preview)
+    
+    # Origin of the ABT values of each quadrant, for the shard merge:
+    # 0 = read from an ABT record, 1 (2) = state (previous state) at the start of the shard
+    origin_current  = np.ones(4, dtype=int)
+    origin_previous = np.full(4, 2, dtype=int)
+    events_origin   = []
 
     for i,packet in enumerate(packets_readout):
         #print("Parsing packet ID {:d} with {:d} buffers".format(i,len(packet)))
@@ -1425,11 +2405,17 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                         record_counter1[kp] = header.recordCounter1
                         record_counter2[kp] = header.recordCounter2
                         record_counter3[kp] = header.recordCounter3
+                        if header.parsedCounters is not None:
+                            parsed_counters[kp] = header.parsedCounters
+                        else:
+                            parsed_ok = False
             
                         kp += 1
 
-                    if j==0 and i==0:
+                    if j==0 and (i==0 or (packet_breaks is not None and packet_breaks[i])):
                         # Get the ABT from the first packet and first buffer in the acquisition
+                        # (or of a preview file that does not follow the previous one: the ABT
+                        # state of a file decoded N files earlier does not apply)
                         if write_packets_extension:
                             # obt_read_from_abtEvt[header.ASIC_ID] = header.BEE_HK["ABT_OBT"]
                             # obt_nsec_difference[header.ASIC_ID] = 9999999 - header.BEE_HK["ABT_CNT"]
@@ -1449,8 +2435,60 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                             obt_nsec_difference            = np.zeros(4)
                             obt_read_from_abtEvt_previous  = np.zeros(4)
                             obt_nsec_difference_previous   = np.zeros(4)
+                        if i > 0:
+                            # Times after a preview break do not depend on the previous shard
+                            origin_current[:] = 0
+                            origin_previous[:] = 0
 
 
+                if isinstance(data, dict):
+                    # Columns of decodeRecordData: the same rows as below, one array per quadrant
+                    asicid = k
+                    abt_columns = quadrant_abt_columns(data, obt_read_from_abtEvt_previous[asicid], obt_nsec_difference_previous[asicid],
+                                                       origin_previous[asicid])
+                    mult = data["MULT"]
+                    rows = np.nonzero(mult > -1)[0]
+                    # Each event carrying an ABT is followed by an ABT row
+                    carrier = abt_columns["ABT"][rows]
+                    n_rows = len(rows) + np.count_nonzero(carrier)
+                    event_row = np.arange(len(rows)) + np.cumsum(carrier) - carrier
+                    abt_row = event_row[carrier] + 1
+                    abt_rows = rows[carrier]
+                    interleave = lambda event_values, abt_values, dtype=np.int64: interleave_rows(event_row, event_values, abt_row, abt_values, dtype)
+
+                    events_packetID.append(np.full(n_rows, i))
+                    events_bufferID.append(np.full(n_rows, j))
+                    events_evtID.append(interleave(rows, 0))
+                    events_evtype.append(interleave(2 if ORTrigger else np.where(mult[rows] > 1, 2, 1), 0))
+                    events_obts.append(interleave(abt_columns["OBTS"][rows], abt_columns["ABTS"][abt_rows], np.float64))
+                    events_obtns.append(interleave(abt_columns["OBTERR"][rows], abt_columns["ABTNS"][abt_rows], np.float64))
+                    events_time_mark.append(interleave(data["TIMEMARK"][rows], 0))
+                    if shard is not None:
+                        events_origin.append(interleave(abt_columns["ORIGIN"][rows], 0))
+                    events_quadid.append(np.full(n_rows, asicid))
+                    events_nmult.append(interleave(mult[rows], 0))
+                    # Pixels of the events (none for the ABT rows)
+                    pixel = abt_columns["PIXEL"] & (mult > -1)[abt_columns["ENTRYEVT"]]
+                    events_channel.append(data["CHANNEL"][pixel])
+                    events_adc.append(data["ADC"][pixel].astype(np.int64) - 32768)
+                    events_npixels.append(interleave(abt_columns["NPIXELS"][rows], 0))
+                    if np.any(carrier):
+                        obt_read_from_abtEvt[asicid], obt_nsec_difference[asicid], origin_current[asicid] = abt_columns["state"]
+                        obt_read_from_abtEvt_previous[asicid], obt_nsec_difference_previous[asicid], origin_previous[asicid] = abt_columns["state"]
+                    
+                    # REJECTED events, with the ABT of the quadrant (for REJSTATS)
+                    rejected = np.nonzero(mult == -1)[0]
+                    rejected_packetID.append(np.full(len(rejected), i))
+                    rejected_bufferID.append(np.full(len(rejected), j))
+                    rejected_evtID.append(rejected)
+                    rejected_evtype.append(np.full(len(rejected), 4))
+                    rejected_obts.append(abt_columns["OBTS"][rejected])
+                    rejected_obtns.append(abt_columns["OBTERR"][rejected])
+                    rejected_time_mark.append(data["TIMEMARK"][rejected])
+                    rejected_quadid.append(np.full(len(rejected), k))
+                    rejected_rejmap.append(data["REJMAP"][rejected])
+                    continue
+                
                 for m, event in enumerate(data):
                     # Initialise arrays
                     mult = event.multiplicity
@@ -1477,6 +2515,7 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                                     asicid = 0
                                 obt_read_from_abtEvt[asicid] = entry.obt_s
                                 obt_nsec_difference[asicid]  = 9999999 - entry.obt_ns
+                                origin_current[asicid] = 0
                                 isThereAnABT = True
 
                                 abt_event_packetID = i
@@ -1504,6 +2543,8 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                         events_obts.append(obt_read_from_abtEvt_previous[asicid])
                         events_obtns.append(obt_nsec_difference_previous[asicid])
                         events_time_mark.append(event.time_mark)
+                        if shard is not None:
+                            events_origin.append(origin_previous[asicid])
             
                         # time_of_event = (event.time_mark - obt_nsec_difference_previous[asicid])*1e-7 \
                         #                 + obt_read_from_abtEvt_previous[asicid]
@@ -1531,6 +2572,8 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                             events_obts.append(abt_event_obts)
                             events_obtns.append(abt_event_obtns)
                             events_time_mark.append(abt_event_time_mark)
+                            if shard is not None:
+                                events_origin.append(0)
                             # events_time.append(0)
                             events_quadid.append(abt_event_quadid)
                             events_nmult.append(abt_event_nmult)
@@ -1539,6 +2582,7 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                 
                             obt_read_from_abtEvt_previous[asicid] = obt_read_from_abtEvt[asicid]
                             obt_nsec_difference_previous[asicid] = obt_nsec_difference[asicid]
+                            origin_previous[asicid] = origin_current[asicid]
                             
                             
                     elif mult == -1:
@@ -1547,19 +2591,46 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                         rejected_bufferID.append(j)
                         rejected_evtID.append(m)
                         rejected_evtype.append(4)
-                        # rejected_obts.append(obt_read_from_abtEvt_previous[m])
-                        # rejected_obtns.append(obt_nsec_difference_previous[m])
+                        # ABT of the quadrant, for the time of the event (REJSTATS)
+                        rejected_obts.append(obt_read_from_abtEvt_previous[k])
+                        rejected_obtns.append(obt_nsec_difference_previous[k])
                         rejected_time_mark.append(event.time_mark)
                         rejected_quadid.append(k)
-                        rejected_rejmap.append(int(event.rejectedMap, base=2))
+                        rejected_rejmap.append(event.rejectedMap)
                             
         
-    # Shift for something in the integer representation (to make it work...)
-    for i in range(len(events_adc)):
-        for j in range(len(events_adc[i])):
-            events_adc[i][j] -= 32768
+    if columnar:
+        # One array per column, and the pixels of each row (already shifted) as slices of one array
+        events_packetID  = concatenate_chunks(events_packetID, np.int64)
+        events_bufferID  = concatenate_chunks(events_bufferID, np.int64)
+        events_evtID     = concatenate_chunks(events_evtID, np.int64)
+        events_evtype    = concatenate_chunks(events_evtype, np.int64)
+        events_obts      = concatenate_chunks(events_obts)
+        events_obtns     = concatenate_chunks(events_obtns)
+        events_time_mark = concatenate_chunks(events_time_mark, np.int64)
+        events_origin    = concatenate_chunks(events_origin, np.int64)
+        events_quadid    = concatenate_chunks(events_quadid, np.int64)
+        events_nmult     = concatenate_chunks(events_nmult, np.int64)
+        pixel_split = np.cumsum(concatenate_chunks(events_npixels, np.int64))[:-1]
+        events_channel = np.split(concatenate_chunks(events_channel, np.int64), pixel_split)
+        events_adc     = np.split(concatenate_chunks(events_adc, np.int64), pixel_split)
+        rejected_packetID  = concatenate_chunks(rejected_packetID, np.int64)
+        rejected_bufferID  = concatenate_chunks(rejected_bufferID, np.int64)
+        rejected_evtID     = concatenate_chunks(rejected_evtID, np.int64)
+        rejected_evtype    = concatenate_chunks(rejected_evtype, np.int64)
+        rejected_obts      = concatenate_chunks(rejected_obts)
+        rejected_obtns     = concatenate_chunks(rejected_obtns)
+        rejected_time_mark = concatenate_chunks(rejected_time_mark, np.int64)
+        rejected_quadid    = concatenate_chunks(rejected_quadid, np.int64)
+        rejected_rejmap    = concatenate_chunks(rejected_rejmap, np.int64)
+    else:
+        # Shift for something in the integer representation (to make it work...)
+        for i in range(len(events_adc)):
+            for j in range(len(events_adc[i])):
+                events_adc[i][j] -= 32768
 
 
+    profile_stage(profiler, "LV0", "arrays")
     events_time_mark = np.array(events_time_mark)
     events_obts      = np.array(events_obts)
     events_obtns     = np.array(events_obtns)
@@ -1586,7 +2657,8 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
     # # All event times in the acquisition will now start from zero
     # mask_nonzero_floor = np.floor(events_time) != 0
     # events_time[mask_nonzero_floor] = events_time[mask_nonzero_floor] - np.floor(np.min(events_time[np.floor(events_time) > 0])) + 1
-    events_time = events_time - np.floor(events_time[0])
+    time_zero = np.floor(events_time[0])
+    events_time = events_time - time_zero
         
     if write_packets_extension and gps_ok:
         # Calculate GPS time for the first header
@@ -1601,19 +2673,80 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
         met_offset = 0
     # Add to events_time
     events_time += met_offset
+    
+    # Rejected maps as unsigned 32 bit integers, and times of the rejected events on the same scale
+    rejected_rejmap = np.array(rejected_rejmap, dtype=np.uint32)
+    rejected_time = (np.array(rejected_time_mark, dtype=np.float64) - np.array(rejected_obtns, dtype=np.float64))*1e-7 \
+                    + np.array(rejected_obts, dtype=np.float64) - time_zero + met_offset
         
      
     mask_fake_events = np.logical_or(np.array(events_nmult) > 0, np.array(events_evtype) == 0)
+    
+    if shard is not None:
+        # Boundary state of the shard (see merge_LV0)
+        shard_hdus = make_shard_hdus(shard, packets_readout, met_offset, file_times,
+                                     events_time_mark, events_quadid, events_evtype, events_origin,
+                                     events_obts, events_obtns, mask_fake_events,
+                                     obt_read_from_abtEvt, obt_nsec_difference, origin_current,
+                                     obt_read_from_abtEvt_previous, obt_nsec_difference_previous, origin_previous,
+                                     gti_max_gap=gti_max_gap)
+        packet_offset = shard
+    else:
+        shard_hdus = []
+        packet_offset = 0
     #mask_fake_events = np.arange(len(events_nmult))
     # Get the minimum and maximum time in the (pure photon) event list
     tstart = np.min(np.array(events_time)[mask_fake_events][np.array(events_evtype)[mask_fake_events] > 0])
     tstop  = np.max(np.array(events_time)[mask_fake_events][np.array(events_evtype)[mask_fake_events] > 0])
     
+    # Rows of the EVENTS table
+    events_rows = np.nonzero(mask_fake_events)[0]
+    if time_sorted:
+        # Each quadrant stream is already nearly sorted: a stable sort (timsort)
+        # finds these runs and merges them, without a full comparison sort.
+        # ABT rows take the time of the event they were read with,
+        # so that they stay right after it.
+        sort_key = np.array(events_time)
+        abt_rows = np.nonzero(events_evtype == 0)[0]
+        sort_key[abt_rows] = sort_key[abt_rows - 1]
+        events_rows = events_rows[np.argsort(sort_key[events_rows], kind="stable")]
+        del sort_key
+    
     print("TSTART", tstart, "skipping ABT events")
     print("TSTOP", tstop,  "skipping ABT events")
     
     exposure = tstop - tstart
     
+    # Good Time Intervals from gaps between buffers (photon events only)
+    photons = np.logical_and(events_evtype > 0, np.array(events_nmult) > 0)
+    buffers_per_packet = np.array([len(packet) for packet in packets_readout], dtype=np.int64)
+    buffer_packet = np.repeat(np.arange(n_packets), buffers_per_packet)
+    events_buffer = (np.cumsum(buffers_per_packet) - buffers_per_packet)[np.array(events_packetID, dtype=np.int64)] \
+                    + np.array(events_bufferID, dtype=np.int64)
+    if write_packets_extension:
+        record_counters = np.stack([record_counter0, record_counter1, record_counter2, record_counter3], axis=1)
+        # Data-quality checks on all the buffers
+        dq_flags, dq_quad_flags = compute_DQ(trigger_counter, rejected_counter, event_counter, overflow_counter, record_counters,
+                                             obt_s, obt_ns, parsed_counters=parsed_counters if parsed_ok else None)
+        dq_nbuffers = np.array([np.count_nonzero(dq_flags & (1 << n)) for n in range(len(DQ_FLAGS))])
+        dq_nquad    = np.array([np.count_nonzero(dq_quad_flags & (1 << n)) for n in range(len(DQ_FLAGS))])
+        for n, (name, description) in enumerate(DQ_FLAGS):
+            if dq_nbuffers[n] > 0:
+                logger.warning("DQ %s: %s in %d of %d buffers", name, description, dq_nbuffers[n], n_buffers)
+        buffer_obt = obt_s
+        buffer_start = buffer_start_times(obt_s, obt_ns, met_offset - time_zero)
+    else:
+        record_counters = None
+        buffer_obt = None
+        buffer_start = None
+        dq_quad_flags = None
+    gti_start, gti_stop, quadgti_start, quadgti_stop, quadgti_id = \
+        compute_GTI(events_buffer[photons], np.array(events_quadid, dtype=np.int64)[photons], events_time[photons], n_buffers,
+                    record_counters=record_counters, buffer_obt=buffer_obt, buffer_packet=buffer_packet,
+                    file_times=file_times, max_gap=gti_max_gap,
+                    packet_breaks=packet_breaks, buffer_start=buffer_start, quad_flags=dq_quad_flags)
+    ontime = np.sum(gti_stop - gti_start)
+    
     # MET reference time in MJD
     mjdref = 59580+0.00080074074
     
@@ -1623,8 +2756,41 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
     print("Observation start:\t", start_date.iso)
     print("Observation stop:\t", stop_date.iso)
     print("Exposure:\t\t", exposure, "s")
+    print("Ontime:\t\t\t", ontime, "s in", len(gti_start), "GTIs")
     
         
+    if rate_outputfilename is not None:
+        profile_stage(profiler, "LV0", "rate")
+        # PHA of an event: maximum ADC value among its pixels
+        lengths = np.fromiter(map(len, events_adc), dtype=np.int64, count=len(events_adc))
+        adc = np.fromiter(itertools.chain.from_iterable(events_adc), dtype=np.int64, count=lengths.sum()) + 32768
+        events_pha = np.full(len(events_adc), -1, dtype=np.int64)
+        if len(adc) > 0:
+            nonempty = lengths > 0
+            events_pha[nonempty] = np.maximum.reduceat(adc, (np.cumsum(lengths) - lengths)[nonempty])
+        # Photon events only (no ABT entries)
+        writeFITS_RATE(events_time[photons], np.array(events_quadid)[photons], events_pha[photons], rate_outputfilename,
+                       tstart, tstop, binwidths=rate_binwidths, band_edges=rate_band_edges, fm=fm,
+                       compress=compress, threads=threads, writer=writer,
+                       gti=(gti_start, gti_stop) if preview is not None else None, preview=preview)
+    
+    if rejstats_outputfilename is not None:
+        profile_stage(profiler, "LV0", "rejstats")
+        writeFITS_REJSTATS(rejected_time, np.array(rejected_quadid, dtype=np.int64), rejected_rejmap, rejstats_outputfilename,
+                           min(tstart, np.min(rejected_time, initial=tstart)), max(tstop, np.max(rejected_time, initial=tstop)),
+                           binwidth=rejstats_binwidth, fm=fm, compress=compress, threads=threads, writer=writer)
+    
+    profile_stage(profiler, "LV0", "hdu")
+    # Channel counts and noisy channels of each buffer (see ChannelMonitor)
+    noisy_map = None
+    if channel_monitor is not None:
+        buffer_headers = [buf[0][0] for packet in packets_readout for buf in packet]
+        if all(header.channelCounts is not None for header in buffer_headers):
+            noisy_map = np.array([header.noisyChannels for header in buffer_headers], dtype=np.int64).reshape(n_buffers, 4)
+            chanmaskhdu = chanmask_hdu(np.array([header.channelCounts for header in buffer_headers]).reshape(n_buffers, 4, 32),
+                                       np.array([header.channelSpan for header in buffer_headers]).reshape(n_buffers, 4),
+                                       noisy_map, channel_monitor, fm=fm)
+    
     # Extensions
     if write_packets_extension:
         #sel_single_pkt = np.array([np.where(packetID == x)[0][0] for x in set(packetID)])
@@ -1632,7 +2798,7 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
         pkthdu = pyfits.BinTableHDU.from_columns([
                                                   pyfits.Column(name='PACKETID',
                                                                 format='1J',
-                                                                array=packetID[sel_single_pkt]),
+                                                                array=packetID[sel_single_pkt] + packet_offset),
                                                   pyfits.Column(name='BUFFERID',
                                                                 format='1J',
                                                                 array=bufferID[sel_single_pkt]),
@@ -1699,65 +2865,112 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                                                                 array=record_counter2[sel_single_pkt]),
                                                   pyfits.Column(name='RECCNT3',
                                                                 format='1I',
-                                                                array=record_counter3[sel_single_pkt])
+                                                                array=record_counter3[sel_single_pkt]),
+                                                  pyfits.Column(name='DQFLAGS',
+                                                                format='1J',
+                                                                array=dq_flags[sel_single_pkt]),
+                                                  pyfits.Column(name='DQQUAD',
+                                                                format='4J',
+                                                                array=dq_quad_flags[sel_single_pkt])
+                                                ])
+        if noisy_map is not None:
+            pkthdu = pyfits.BinTableHDU.from_columns(pkthdu.columns + pyfits.ColDefs([pyfits.Column(name='NOISYMAP',
+                                                                                                     format='4K',
+                                                                                                     array=noisy_map)]))
+        
+        # Summary of the data-quality checks
+        dqhdu = pyfits.BinTableHDU.from_columns([
+                                                  pyfits.Column(name='FLAG',
+                                                                format='8A',
+                                                                array=[name for name, description in DQ_FLAGS]),
+                                                  pyfits.Column(name='BIT',
+                                                                format='1I',
+                                                                array=np.arange(len(DQ_FLAGS))),
+                                                  pyfits.Column(name='NBUFFERS',
+                                                                format='1J',
+                                                                array=dq_nbuffers),
+                                                  pyfits.Column(name='NQUADBUF',
+                                                                format='1J',
+                                                                array=dq_nquad),
+                                                  pyfits.Column(name='FRACTION',
+                                                                format='1E',
+                                                                array=dq_nbuffers/max(n_buffers, 1)),
+                                                  pyfits.Column(name='DESCRIP',
+                                                                format='64A',
+                                                                array=[description for name, description in DQ_FLAGS])
                                                 ])
 
     
     evthdu = pyfits.BinTableHDU.from_columns([
                                               pyfits.Column(name='PACKETID',
                                                             format='1J',
-                                                            array=np.array(events_packetID)[mask_fake_events]),
+                                                            array=np.array(events_packetID)[events_rows] + packet_offset),
                                               pyfits.Column(name='BUFFERID',
                                                             format='1J',
-                                                            array=np.array(events_bufferID)[mask_fake_events]),
+                                                            array=np.array(events_bufferID)[events_rows]),
                                               pyfits.Column(name='EVTID',
                                                             format='1J',
-                                                            array=np.array(events_evtID)[mask_fake_events]),
+                                                            array=np.array(events_evtID)[events_rows]),
                                               pyfits.Column(name='EVTTYPE',
                                                             format='1B',
-                                                            array=np.array(events_evtype)[mask_fake_events]),
+                                                            array=np.array(events_evtype)[events_rows]),
                                               pyfits.Column(name='OBTSEC',
                                                             format='1J',
-                                                            array=np.array(events_obts)[mask_fake_events]),
+                                                            array=np.array(events_obts)[events_rows]),
                                               pyfits.Column(name='OBTNSEC',
                                                             format='1J',
-                                                            array=np.array(events_obtns)[mask_fake_events]),
+                                                            array=np.array(events_obtns)[events_rows]),
                                               pyfits.Column(name='TIMEMARK',
                                                             format='1J',
-                                                            array=np.array(events_time_mark)[mask_fake_events]),
+                                                            array=np.array(events_time_mark)[events_rows]),
                                               pyfits.Column(name='TIME',
                                                             format='1D',
                                                             unit='s',
-                                                            array=np.array(events_time)[mask_fake_events]),
+                                                            array=np.array(events_time)[events_rows]),
                                               pyfits.Column(name='QUADID',
                                                             format='1B',
-                                                            array=np.array(events_quadid)[mask_fake_events]),
+                                                            array=np.array(events_quadid)[events_rows]),
                                               pyfits.Column(name='NMULT',
                                                             format='1B',
-                                                            array=np.array(events_nmult)[mask_fake_events]),
+                                                            array=np.array(events_nmult)[events_rows]),
                                               pyfits.Column(name='CHANNEL',
                                                             format='1QB(30)',
-                                                            array=np.array(events_channel, dtype=object)[mask_fake_events]),
+                                                            array=np.array(events_channel, dtype=object)[events_rows]),
                                               pyfits.Column(name='PHA',
                                                             format='1QI(30)',
-                                                            array=np.array(events_adc, dtype=object)[mask_fake_events])
+                                                            array=np.array(events_adc, dtype=object)[events_rows])
                                             ])
     
     gtihdu = pyfits.BinTableHDU.from_columns([                                
                                               pyfits.Column(name='START',
                                                             format='1D',
                                                             unit='s',
-                                                            array=np.array([tstart])),
+                                                            array=gti_start),
+                                              pyfits.Column(name='STOP',
+                                                            format='1D',
+                                                            unit='s',
+                                                            array=gti_stop),
+                                            ])
+    
+    # GTIs of each quadrant
+    quadgtihdu = pyfits.BinTableHDU.from_columns([                                
+                                              pyfits.Column(name='START',
+                                                            format='1D',
+                                                            unit='s',
+                                                            array=quadgti_start),
                                               pyfits.Column(name='STOP',
                                                             format='1D',
                                                             unit='s',
-                                                            array=np.array([tstop])),
+                                                            array=quadgti_stop),
+                                              pyfits.Column(name='QUADID',
+                                                            format='1B',
+                                                            array=quadgti_id),
                                             ])
     
     rejhdu = pyfits.BinTableHDU.from_columns([
                                               pyfits.Column(name='PACKETID',
                                                             format='1J',
-                                                            array=rejected_packetID),
+                                                            array=np.array(rejected_packetID, dtype=np.int64) + packet_offset),
                                               pyfits.Column(name='BUFFERID',
                                                             format='1J',
                                                             array=rejected_bufferID),
@@ -1781,7 +2994,7 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
                                                             array=rejected_quadid),
                                               pyfits.Column(name='REJMAP',
                                                             format='1J',
-                                                            array=rejected_rejmap)
+                                                            array=rejected_rejmap.view(np.int32))
                                             ])
     
     
@@ -1801,10 +3014,17 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
     prhdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
     prhdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
     prhdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
-    prhdu.header.set('ONTIME', exposure,  'Sum of GTIs')
-    prhdu.header.set('EXPOSURE', exposure,  'Exposure time')
+    prhdu.header.set('ONTIME', ontime,  'Sum of GTIs')
+    prhdu.header.set('EXPOSURE', ontime,  'Exposure time')
     prhdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
     prhdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
+    if preview is not None:
+        # Extrapolated to the files not decoded
+        fraction = set_preview_keywords(prhdu.header, preview)
+        n_photons = np.count_nonzero(photons)
+        prhdu.header.set('PRVONTIM', ontime/fraction,  '[s] ONTIME extrapolated to all the files')
+        prhdu.header.set('PRVNEVT', int(round(n_photons/fraction)),  'Photon events extrapolated to all the files')
+        prhdu.header.set('PRVRATE', n_photons/ontime if ontime > 0 else 0.,  '[count/s] Mean photon event rate in the GTIs')
     
     
     if write_packets_extension:
@@ -1819,14 +3039,23 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
         pkthdu.header.set('MJDREFI', 59580,  'MJD reference day 01 Jan 2022 00:00:00 UTC')
         pkthdu.header.set('MJDREFF', 0.00080074074,  'MJD reference (fraction part: 32.184 secs + 37')
         pkthdu.header.set('CLOCKAPP', False,  'Set to TRUE if correction has been applied to t')
-        pkthdu.header.set('EXPOSURE', exposure,  'Exposure time')
+        pkthdu.header.set('EXPOSURE', ontime,  'Exposure time')
         pkthdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
         pkthdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
         pkthdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
-        pkthdu.header.set('ONTIME', exposure,  'Sum of GTIs')
-        pkthdu.header.set('EXPOSURE', exposure,  'Exposure time')
+        pkthdu.header.set('ONTIME', ontime,  'Sum of GTIs')
+        pkthdu.header.set('EXPOSURE', ontime,  'Exposure time')
         pkthdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
         pkthdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
+        for n, (name, description) in enumerate(DQ_FLAGS):
+            pkthdu.header.set('DQBIT{:d}'.format(n), name,  description[:47])
+        
+        dqhdu.header.set('EXTNAME', 'DQSUMMARY',  'Name of this binary table extension')
+        dqhdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+        dqhdu.header.set('INSTRUME', fm,  'Instrument name')
+        dqhdu.header.set('NBUFFERS', n_buffers,  'Number of buffers checked')
+        dqhdu.header.set('NBADBUF', int(np.count_nonzero(dq_flags)),  'Number of buffers with any DQ flag set')
+        dqhdu.header.set('DQPARSED', parsed_ok,  'Parsed record checks done')
             
 
     evthdu.header.set('EXTNAME', 'EVENTS',  'Name of this binary table extension')
@@ -1842,10 +3071,12 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
     evthdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
     evthdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
     evthdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
-    evthdu.header.set('ONTIME', exposure,  'Sum of GTIs')
-    evthdu.header.set('EXPOSURE', exposure,  'Exposure time')
+    evthdu.header.set('ONTIME', ontime,  'Sum of GTIs')
+    evthdu.header.set('EXPOSURE', ontime,  'Exposure time')
     evthdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
     evthdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
+    if time_sorted:
+        evthdu.header.set('TSORTKEY', 'TIME',  'Rows are sorted by TIME')
 
     gtihdu.header.set('EXTNAME', 'GTI',  'Name of this binary table extension')
     gtihdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
@@ -1859,14 +3090,21 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
     gtihdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
     gtihdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
     gtihdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
-    gtihdu.header.set('ONTIME', exposure,  'Sum of GTIs')
-    gtihdu.header.set('EXPOSURE', exposure,  'Exposure time')
+    gtihdu.header.set('ONTIME', ontime,  'Sum of GTIs')
+    gtihdu.header.set('EXPOSURE', ontime,  'Exposure time')
     gtihdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
     gtihdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
     gtihdu.header.set('HDUCLASS', 'OGIP',  'End date of observations')
     gtihdu.header.set('HDUCLAS1', 'GTI',  'File contains Good Time Intervals')
     gtihdu.header.set('HDUCLAS2', 'STANDARD',  'File contains Good Time Intervals')
     gtihdu.header.set('HDUNAME', 'GTI',  'ASCDM block name')
+    
+    # Same keywords as the GTI extension
+    for card in gtihdu.header.cards[gtihdu.header.index('EXTNAME'):]:
+        quadgtihdu.header.set(card.keyword, card.value, card.comment)
+    quadgtihdu.header.set('EXTNAME', 'QUADGTI',  'Name of this binary table extension')
+    quadgtihdu.header.set('HDUNAME', 'QUADGTI',  'ASCDM block name')
+    quadgtihdu.header.set('HDUCLAS2', 'QUADRANT',  'Good Time Intervals of each quadrant')
 
 
     if len(rejected_packetID) > 0:
@@ -1879,43 +3117,1899 @@ def writeFITS_LV0(packets_readout, outputfilename, write_packets_extension=True,
         rejhdu.header.set('MJDREFI', 59580,  'MJD reference day 01 Jan 2022 00:00:00 UTC')
         rejhdu.header.set('MJDREFF', 0.00080074074,  'MJD reference (fraction part: 32.184 secs + 37')
         rejhdu.header.set('CLOCKAPP', False,  'Set to TRUE if correction has been applied to t')
-        rejdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
-        rejdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
+        rejhdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
+        rejhdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
         rejhdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
-        rejhdu.header.set('ONTIME', exposure,  'Sum of GTIs')
-        rejhdu.header.set('EXPOSURE', exposure,  'Exposure time')
+        rejhdu.header.set('ONTIME', ontime,  'Sum of GTIs')
+        rejhdu.header.set('EXPOSURE', ontime,  'Exposure time')
         rejhdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
         rejhdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
         
         if write_packets_extension:
-            hdulist = pyfits.HDUList([prhdu, pkthdu, evthdu, gtihdu, rejhdu])
+            hdulist = pyfits.HDUList([prhdu, pkthdu, evthdu, gtihdu, rejhdu, quadgtihdu, dqhdu])
         else:
-            hdulist = pyfits.HDUList([prhdu, evthdu, gtihdu, rejhdu])
+            hdulist = pyfits.HDUList([prhdu, evthdu, gtihdu, rejhdu, quadgtihdu])
             
     else:
         if write_packets_extension:
-            hdulist = pyfits.HDUList([prhdu, pkthdu, evthdu, gtihdu])
+            hdulist = pyfits.HDUList([prhdu, pkthdu, evthdu, gtihdu, quadgtihdu, dqhdu])
         else:
-            hdulist = pyfits.HDUList([prhdu, evthdu, gtihdu])
+            hdulist = pyfits.HDUList([prhdu, evthdu, gtihdu, quadgtihdu])
+    
+    if skipped:
+        hdulist.append(skipped_hdu(skipped, fm=fm))
+    
+    if noisy_map is not None:
+        hdulist.append(chanmaskhdu)
+    
+    if shard is not None:
+        # Rows of the EVENTS table (time sorted or not) of each event
+        table_row = np.full(len(events_evtype), -1, dtype=np.int64)
+        table_row[events_rows] = np.arange(len(events_rows))
+        shard_hdus[-1].data['TABLEROW'] = table_row
+        hdulist.extend(shard_hdus)
+    
+    if npy_dir is not None:
+        profile_stage(profiler, "LV0", "npy")
+        writeNPY(hdulist, npy_dir)
             
-    hdulist.writeto(outputfilename, overwrite=True, checksum=True)
+    if outputfilename is not None:
+        profile_stage(profiler, "LV0", "write")
+        write_hdulist(hdulist, outputfilename, checksum=True, compress=compress, threads=threads, writer=writer)
+    profile_stage(profiler, "LV0")
     
     return tstart, tstop
 
 
-def writeFITS_HK(packets_readout, outputfilename, gps_ok=False, fm="FM2", obsdates=None):
+def skipped_hdu(skipped, fm="FM2"):
     """
-    Write HERMES housekeepings FITS file
+    SKIPPED extension: byte ranges of the raw files skipped by the tolerant parser
+    Input:
+        skipped = list of (filename, start, stop, reason)
     """
-    print("\n*** WRITING HK FITS FILE ***\n")
-    
-    # Number of packets: one packet corresponds to one file
-    # However, one file can have more buffers!
-    n_packets = len(packets_readout)
-    print("Number of packets: ", n_packets)
+    filenames, start, stop, reason = zip(*skipped)
+    hdu = pyfits.BinTableHDU.from_columns([
+                                           pyfits.Column(name='FILENAME',
+                                                         format='{:d}A'.format(max(len(os.path.basename(x)) for x in filenames)),
+                                                         array=[os.path.basename(x) for x in filenames]),
+                                           pyfits.Column(name='START',
+                                                         format='1K',
+                                                         array=np.array(start)),
+                                           pyfits.Column(name='STOP',
+                                                         format='1K',
+                                                         array=np.array(stop)),
+                                           pyfits.Column(name='REASON',
+                                                         format='{:d}A'.format(max(len(x) for x in reason)),
+                                                         array=list(reason))
+                                         ])
+    hdu.header.set('EXTNAME', 'SKIPPED',  'Name of this binary table extension')
+    hdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    hdu.header.set('INSTRUME', fm,  'Instrument name')
+    hdu.header.set('NSKIPPED', int(np.sum(np.array(stop) - np.array(start))),  'Total number of skipped bytes')
+    return hdu
+
+
+def chanmask_hdu(channel_counts, channel_span, noisy_map, monitor, fm="FM2"):
+    """
+    CHANMASK extension: one row for each (quadrant, channel), with its PIXEL records,
+    rate and number of buffers in which it was noisy (see ChannelMonitor), and whether
+    it is noisy over the acquisition (the monitor check on the summed counts and exposure)
+    Input:
+        channel_counts = (n_buffers, 4, 32) PIXEL records of each buffer
+        channel_span = (n_buffers, 4) time spanned by each quadrant record list
+        noisy_map = (n_buffers, 4) noisy channels bitmasks
+        monitor = ChannelMonitor (threshold, min_counts, mask)
+    """
+    counts = channel_counts.sum(axis=0)
+    exposure = channel_span.sum(axis=0)
+    rate = counts/np.maximum(exposure, 1e-7)[:, None]
+    buffer_rate = channel_counts/np.maximum(channel_span, 1e-7)[:, :, None]
+    max_rate = buffer_rate.max(axis=0) if len(channel_counts) > 0 else np.zeros((4, 32))
+    n_noisy = np.count_nonzero((noisy_map[:, :, None] >> np.arange(32)) & 1, axis=0)
+    noisy = (counts >= monitor.min_counts) & (counts > monitor.threshold*exposure[:, None])
     
-    # Number of headers: 
-    # count total number of (header, event_data) tuples in each packet for each buffer
+    hdu = pyfits.BinTableHDU.from_columns([
+                                           pyfits.Column(name='QUADID',
+                                                         format='1B',
+                                                         array=np.repeat(np.arange(4), 32)),
+                                           pyfits.Column(name='CHANNEL',
+                                                         format='1B',
+                                                         array=np.tile(np.arange(32), 4)),
+                                           pyfits.Column(name='COUNTS',
+                                                         format='1K',
+                                                         unit='count',
+                                                         array=counts.ravel()),
+                                           pyfits.Column(name='EXPOSURE',
+                                                         format='1D',
+                                                         unit='s',
+                                                         array=np.repeat(exposure, 32)),
+                                           pyfits.Column(name='RATE',
+                                                         format='1E',
+                                                         unit='count/s',
+                                                         array=rate.ravel()),
+                                           pyfits.Column(name='MAXRATE',
+                                                         format='1E',
+                                                         unit='count/s',
+                                                         array=max_rate.ravel()),
+                                           pyfits.Column(name='NNOISY',
+                                                         format='1J',
+                                                         array=n_noisy.ravel()),
+                                           pyfits.Column(name='NOISY',
+                                                         format='1L',
+                                                         array=noisy.ravel()),
+                                           pyfits.Column(name='MASKED',
+                                                         format='1L',
+                                                         array=(n_noisy.ravel() > 0) & monitor.mask)
+                                         ])
+    hdu.header.set('EXTNAME', 'CHANMASK',  'Name of this binary table extension')
+    hdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    hdu.header.set('INSTRUME', fm,  'Instrument name')
+    hdu.header.set('NOISYTHR', monitor.threshold,  '[count/s] Rate above which a channel is noisy')
+    hdu.header.set('NOISYMIN', monitor.min_counts,  'Records below which a channel is not noisy')
+    hdu.header.set('NOISYMSK', monitor.mask,  'Noisy channels masked at ingest')
+    hdu.header.set('NNOISY', int(np.count_nonzero(n_noisy)),  'Number of channels noisy in any buffer')
+    hdu.header.set('NNOISYAC', int(np.count_nonzero(noisy)),  'Number of channels noisy over the acquisition')
+    return hdu
+
+
+def preview_breaks(preview):
+    """
+    Input:
+        preview = (indices of the files decoded, number of files of the acquisition), or None
+    Output:
+        True for the packets (files) that do not follow the previous one, None without a preview
+    """
+    if preview is None:
+        return None
+    return np.diff(preview[0], prepend=-1) > 1
+
+
+def set_preview_keywords(header, preview):
+    """
+    Flag a quick-look product, made from a sample of the files (see preview_indices)
+    Input:
+        preview = (indices of the files decoded, number of files of the acquisition)
+    Output:
+        fraction of the files decoded
+    """
+    n_decoded, n_files = len(preview[0]), preview[1]
+    fraction = n_decoded/max(n_files, 1)
+    header.set('PREVIEW', True,  'Preview: only a sample of the files decoded')
+    header.set('PRVFILES', n_decoded,  'Number of files decoded for the preview')
+    header.set('PRVTOTAL', n_files,  'Number of files of the acquisition')
+    header.set('PRVFRAC', fraction,  'Fraction of the files decoded')
+    return fraction
+
+
+def buffer_start_times(obt_s, obt_ns, time_offset):
+    """
+    ABT time of each buffer on the event time scale: the header ABT (seconds, 100 ns counter)
+    is read as an ABT record (see the ABT rows of the LV0 EVENTS table)
+    Input:
+        obt_s, obt_ns = header ABT of each buffer
+        time_offset = offset of the event times (met_offset - time_zero)
+    """
+    return np.asarray(obt_s, dtype=np.float64) + 1 - np.asarray(obt_ns, dtype=np.float64)*1e-7 + time_offset
+
+
+def compute_GTI(buffer_index, quadid, times, n_buffers, nquadrants=4, record_counters=None, buffer_obt=None,
+                buffer_packet=None, file_times=None, max_gap=None, cadence_tolerance=GTI_CADENCE_TOLERANCE,
+                packet_breaks=None, buffer_start=None, quad_flags=None):
+    """
+    Build the Good Time Intervals from the buffer sequence, in linear time.
+    Each quadrant is live in a buffer from the buffer ABT to the ABT of the next
+    buffer (from its first to its last event if buffer_start is not given, and always
+    including its events); consecutive buffers are joined unless there is a gap in between:
+    a quadrant without records or with records lost (DQ RECORDS), an OBT going
+    backwards (reset), or missing files (a step in the file timestamps larger than
+    cadence_tolerance times the median cadence).
+    If max_gap is given, events more than max_gap seconds apart also end a GTI.
+    The quadrants without any (selected) event are not live.
+    Input:
+        buffer_index = global buffer index of each (photon) event
+        quadid, times = quadrant and time of each event
+        record_counters = (n_buffers, nquadrants) header record counters
+        buffer_obt = ABT/OBT seconds of each buffer
+        buffer_packet = packet (file) index of each buffer
+        file_times = timestamp of each packet (file)
+        packet_breaks = True for the packets (files) that do not follow the previous one
+                        (e.g. the files between them are not decoded, see preview_indices)
+        buffer_start = ABT time of each buffer on the event time scale (see buffer_start_times)
+        quad_flags = (n_buffers, nquadrants) DQ flags (see compute_DQ)
+    Output:
+        GTI start, stop (union of the quadrants),
+        per-quadrant GTI start, stop, quadrant id
+    """
+    # First and last event time of each (buffer, quadrant)
+    cell = np.asarray(buffer_index, dtype=np.int64)*nquadrants + quadid
+    first = np.full(n_buffers*nquadrants, np.inf)
+    last  = np.full(n_buffers*nquadrants, -np.inf)
+    np.minimum.at(first, cell, times)
+    np.maximum.at(last, cell, times)
+    first = first.reshape(n_buffers, nquadrants)
+    last  = last.reshape(n_buffers, nquadrants)
+    if record_counters is not None and buffer_start is not None:
+        # Live whenever the quadrant sends records, events or not
+        live = (np.asarray(record_counters) > 0) & np.isfinite(first).any(axis=0)
+    else:
+        live = np.isfinite(first)
+        if record_counters is not None:
+            live &= np.asarray(record_counters) > 0
+    if quad_flags is not None:
+        # Records lost: the quadrant is not live in the buffer
+        live &= (np.asarray(quad_flags) & (1 << 1)) == 0
+
+    # Breaks before each buffer, common to all quadrants
+    breaks = np.zeros(n_buffers, dtype=bool)
+    if buffer_obt is not None and n_buffers > 1:
+        breaks[1:] |= np.diff(buffer_obt) < 0
+    if file_times is not None and buffer_packet is not None and len(file_times) > 1:
+        buffer_packet = np.asarray(buffer_packet, dtype=np.int64)
+        step = np.diff(np.asarray(file_times, dtype=np.float64))
+        missing = np.concatenate([[False], step > cadence_tolerance*np.median(step)])
+        new_packet = np.concatenate([[False], np.diff(buffer_packet) != 0])
+        breaks |= new_packet & missing[buffer_packet]
+    if packet_breaks is not None and buffer_packet is not None and n_buffers > 1:
+        buffer_packet = np.asarray(buffer_packet, dtype=np.int64)
+        breaks[1:] |= (np.diff(buffer_packet) != 0) & np.asarray(packet_breaks, dtype=bool)[buffer_packet[1:]]
+
+    if buffer_start is not None:
+        # Buffer spans: up to the next buffer, unless there is a break in between
+        buffer_start = np.asarray(buffer_start, dtype=np.float64)
+        buffer_stop = buffer_start.copy()
+        follows = ~breaks[1:]
+        buffer_stop[:-1][follows] = buffer_start[1:][follows]
+        event_first, event_last = first, last
+        first = np.fmin(first, buffer_start[:, None])
+        last  = np.fmax(last, buffer_stop[:, None])
+    else:
+        event_first, event_last = first, last
+
+    quad_start = []
+    quad_stop  = []
+    quad_id    = []
+    for q in range(nquadrants):
+        rows = np.nonzero(live[:, q])[0]
+        if len(rows) == 0:
+            continue
+        start = first[rows, q]
+        stop  = last[rows, q]
+        # A new interval starts at the first buffer, after a dead buffer,
+        # after a break or after a time gap (if max_gap is given)
+        new = np.ones(len(rows), dtype=bool)
+        new[1:] = (np.diff(rows) > 1) | breaks[rows[1:]]
+        if max_gap is not None:
+            # Gap from the last event before the buffer to its first event
+            previous = np.maximum.accumulate(event_last[rows, q])[:-1]
+            following = event_first[rows[1:], q]
+            gap = np.isfinite(previous) & np.isfinite(following) & (following - previous > max_gap)
+            new[1:] |= gap
+            # The interval before the gap stops at its last event
+            stop[:-1][gap] = np.fmax(event_last[rows[:-1], q][gap], start[:-1][gap])
+        idx = np.nonzero(new)[0]
+        quad_start.append(np.minimum.reduceat(start, idx))
+        quad_stop.append(np.maximum.reduceat(stop, idx))
+        quad_id.append(np.full(len(idx), q))
+    if len(quad_start) == 0:
+        empty = np.zeros(0)
+        return empty, empty, empty, empty, np.zeros(0, dtype=np.int64)
+    quad_start = np.concatenate(quad_start)
+    quad_stop  = np.concatenate(quad_stop)
+    quad_id    = np.concatenate(quad_id)
+
+    # Union of the quadrant intervals
+    order = np.argsort(quad_start, kind="stable")
+    start = quad_start[order]
+    stop  = quad_stop[order]
+    reach = np.maximum.accumulate(stop)
+    new = np.ones(len(start), dtype=bool)
+    new[1:] = start[1:] > reach[:-1]
+    idx = np.nonzero(new)[0]
+    gti_start = start[idx]
+    gti_stop  = np.maximum.reduceat(stop, idx)
+    return gti_start, gti_stop, quad_start, quad_stop, quad_id
+
+
+def compute_DQ(trigger_counter, rejected_counter, event_counter, overflow_counter, record_counters,
+               obt_s, obt_ns, parsed_counters=None):
+    """
+    Evaluate the data-quality checks (DQ_FLAGS) on all the buffers at once.
+    Input:
+        trigger_counter, rejected_counter, event_counter, overflow_counter,
+        record_counters = (n_buffers, 4) header counters
+        obt_s, obt_ns = ABT of each buffer
+        parsed_counters = (n_buffers, 4, len(DQ_PARSED_FIELDS)) parsed records
+                          (see Header.parsedCounters), None if not decoded
+    Output:
+        DQ flags of each buffer (bit n set if check DQ_FLAGS[n] failed),
+        (n_buffers, 4) flags of each quadrant
+    """
+    n_buffers = len(obt_s)
+    quad_flags = np.zeros((n_buffers, 4), dtype=np.int32)
+
+    # BEE counters: every trigger is an event, a rejected or an overflow event
+    failed = np.asarray(trigger_counter) != np.asarray(event_counter) + np.asarray(rejected_counter) + np.asarray(overflow_counter)
+    quad_flags |= failed*(1 << 0)
+
+    if parsed_counters is not None:
+        # TIME and PIXEL events are one record, ABT and REJ events are two
+        time, pixel, abt, rej, lsb = np.moveaxis(np.asarray(parsed_counters), -1, 0)
+        quad_flags |= (time + pixel + 2*abt + 2*rej != np.asarray(record_counters))*(1 << 1)
+        quad_flags |= (lsb > 0)*(1 << 2)
+
+    # ABT checks are common to the four quadrants
+    buffer_flags = np.zeros(n_buffers, dtype=np.int32)
+    if n_buffers > 1:
+        buffer_flags[1:] |= (np.diff(np.asarray(obt_s, dtype=np.int64)) < 0)*(1 << 3)
+    buffer_flags |= (np.asarray(obt_ns) > 9999999)*(1 << 4)
+
+    flags = buffer_flags | np.bitwise_or.reduce(quad_flags, axis=1)
+    return flags, quad_flags
+
+
+def bin_events(times, channels, nchannels, tstart, tstop, binwidth):
+    """
+    Count events in time bins and channels with a single np.bincount.
+    Input:
+        times = event times
+        channels = integer index of each event (e.g. quadrant*nbands + band),
+                   events with a negative index are not counted
+        tstart, tstop = time range, the first bin starts at tstart
+    Output:
+        bin start times, counts array (nbins, nchannels)
+    """
+    nbins = int(np.floor((tstop - tstart)/binwidth)) + 1
+    tbin = np.floor((times - tstart)/binwidth).astype(np.int64)
+    valid = (tbin >= 0) & (tbin < nbins) & (channels >= 0)
+    index = tbin[valid]*nchannels + channels[valid]
+    counts = np.bincount(index, minlength=nbins*nchannels).reshape(nbins, nchannels)
+    return tstart + np.arange(nbins)*binwidth, counts
+
+
+def writeFITS_RATE(events_time, events_quadid, events_pha, outputfilename, tstart, tstop,
+                   binwidths=RATE_BINWIDTHS, band_edges=RATE_BAND_EDGES, fm="FM2",
+                   compress=False, threads=None, writer=None, gti=None, preview=None):
+    """
+    Write the energy-banded light curves of the events, one RATE extension
+    (EXTVER 1, 2, ...) for each bin width.
+    The columns follow the SRA ratemeter layout (LOW_QA ... HIG_QD, counts per bin),
+    so that they can be compared directly with the SRA files.
+    Input:
+        events_time, events_quadid, events_pha = arrays of the (photon) events
+        band_edges = ADC edges of the bands (band i is band_edges[i] <= PHA < band_edges[i+1])
+        binwidths = bin widths in seconds
+        gti = (start, stop) arrays of the GTIs: if given, a FRACEXP column has the fraction
+              of each bin covered by the GTIs (rate = counts/(TIMEDEL*FRACEXP))
+        preview = (indices of the files decoded, files of the acquisition), see set_preview_keywords
+    """
+    print("\n*** WRITING RATE FITS FILE ***\n")
+    
+    nbands = len(band_edges) - 1
+    if nbands == len(RATE_BAND_NAMES):
+        band_names = RATE_BAND_NAMES
+    else:
+        band_names = ["B{:d}".format(b) for b in range(nbands)]
+    
+    # Channel index: quadrant*nbands + band (-1 outside the bands)
+    band = np.searchsorted(np.asarray(band_edges), events_pha, side="right") - 1
+    band[(band < 0) | (band >= nbands)] = -1
+    channels = np.where(band >= 0, np.asarray(events_quadid, dtype=np.int64)*nbands + band, -1)
+    
+    exposure = tstop - tstart
+    mjdref = 59580+0.00080074074
+    start_date = Time(mjdref + tstart/86400., format='mjd')
+    stop_date  = Time(mjdref + tstop/86400.,  format='mjd')
+    
+    prhdu = pyfits.PrimaryHDU()
+    prhdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    prhdu.header.set('INSTRUME', fm,  'Instrument name')
+    prhdu.header.set('TIMESYS', 'TT',  'Terrestrial Time: synchronous with, but 32.184')
+    prhdu.header.set('TIMEREF', 'LOCAL',  'Time reference')
+    prhdu.header.set('TIMEUNIT', 's',  'Time unit for timing header keywords')
+    prhdu.header.set('MJDREFI', 59580,  'MJD reference day 01 Jan 2022 00:00:00 UTC')
+    prhdu.header.set('MJDREFF', 0.00080074074,  'MJD reference (fraction part: 32.184 secs + 37')
+    prhdu.header.set('CLOCKAPP', False,  'Set to TRUE if correction has been applied to t')
+    prhdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
+    prhdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
+    prhdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
+    prhdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
+    prhdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
+    if preview is not None:
+        set_preview_keywords(prhdu.header, preview)
+    
+    if gti is not None:
+        # GTI time elapsed before each edge: piecewise linear, rising within the GTIs
+        gti_edges = np.column_stack(gti).ravel()
+        gti_covered = np.concatenate([[0.], np.cumsum(gti[1] - gti[0])]).repeat(2)[1:-1]
+    
+    hdus = [prhdu]
+    for n, binwidth in enumerate(binwidths):
+        time, counts = bin_events(events_time, channels, 4*nbands, tstart, tstop, binwidth)
+        counts = counts.reshape(-1, 4, nbands)
+        print("Bin width {:g} s: {:d} bins".format(binwidth, len(time)))
+        
+        columns = [pyfits.Column(name='TIME', format='1D', unit='s', array=time)]
+        for b in range(nbands):
+            for q in range(4):
+                columns.append(pyfits.Column(name=band_names[b] + "_Q" + "ABCD"[q],
+                                             format='1J',
+                                             unit='count',
+                                             array=counts[:, q, b]))
+        if gti is not None:
+            covered = np.interp(np.append(time, time[-1] + binwidth), gti_edges, gti_covered) if len(gti_edges) > 0 else np.zeros(len(time) + 1)
+            columns.append(pyfits.Column(name='FRACEXP', format='1E', array=np.diff(covered)/binwidth))
+        ratehdu = pyfits.BinTableHDU.from_columns(columns)
+        
+        ratehdu.header.set('EXTNAME', 'RATE',  'Name of this binary table extension')
+        ratehdu.header.set('EXTVER', n+1,  'Extension version')
+        ratehdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+        ratehdu.header.set('INSTRUME', fm,  'Instrument name')
+        ratehdu.header.set('TIMESYS', 'TT',  'Terrestrial Time: synchronous with, but 32.184')
+        ratehdu.header.set('TIMEREF', 'LOCAL',  'Time reference')
+        ratehdu.header.set('TIMEUNIT', 's',  'Time unit for timing header keywords')
+        ratehdu.header.set('MJDREFI', 59580,  'MJD reference day 01 Jan 2022 00:00:00 UTC')
+        ratehdu.header.set('MJDREFF', 0.00080074074,  'MJD reference (fraction part: 32.184 secs + 37')
+        ratehdu.header.set('CLOCKAPP', False,  'Set to TRUE if correction has been applied to t')
+        ratehdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
+        ratehdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
+        ratehdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
+        ratehdu.header.set('TIMEDEL', binwidth,  'Bin width')
+        ratehdu.header.set('TIMEPIXR', 0.0,  'TIME is the start of the bin')
+        ratehdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
+        ratehdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
+        for b in range(nbands):
+            ratehdu.header.set('PHALO{:d}'.format(b+1), int(band_edges[b]),  band_names[b] + ' band lower ADC edge')
+            ratehdu.header.set('PHAHI{:d}'.format(b+1), int(band_edges[b+1]),  band_names[b] + ' band upper ADC edge (excluded)')
+        hdus.append(ratehdu)
+    
+    write_hdulist(pyfits.HDUList(hdus), outputfilename, checksum=True, compress=compress, threads=threads, writer=writer)
+
+
+def writeFITS_REJSTATS(rejected_time, rejected_quadid, rejected_rejmap, outputfilename, tstart, tstop,
+                       binwidth=REJSTATS_BINWIDTH, fm="FM2", compress=False, threads=None, writer=None):
+    """
+    Write the rejections of each channel per time bin and quadrant.
+    The rejected maps are expanded to bits with np.unpackbits (bit c of a map: channel c)
+    and the set bits are counted with bin_events, without handling each event.
+    Input:
+        rejected_time, rejected_quadid = time and quadrant of the rejected events
+        rejected_rejmap = their rejected maps (uint32)
+        tstart, tstop = time range, the first bin starts at tstart
+    """
+    print("\n*** WRITING REJSTATS FITS FILE ***\n")
+    
+    bits = np.unpackbits(np.asarray(rejected_rejmap, dtype="<u4").view(np.uint8).reshape(-1, 4), axis=1, bitorder="little")
+    event, channel = np.nonzero(bits)
+    time, counts = bin_events(np.asarray(rejected_time)[event], np.asarray(rejected_quadid)[event]*32 + channel, 4*32, tstart, tstop, binwidth)
+    counts = counts.reshape(-1, 4, 32)
+    # Rejected events of each quadrant
+    time, nrej = bin_events(np.asarray(rejected_time), np.asarray(rejected_quadid), 4, tstart, tstop, binwidth)
+    print("Rejected events:", len(rejected_rejmap), "in", len(time), "bins of", binwidth, "s")
+    
+    exposure = tstop - tstart
+    mjdref = 59580+0.00080074074
+    start_date = Time(mjdref + tstart/86400., format='mjd')
+    stop_date  = Time(mjdref + tstop/86400.,  format='mjd')
+    
+    prhdu = pyfits.PrimaryHDU()
+    prhdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    prhdu.header.set('INSTRUME', fm,  'Instrument name')
+    prhdu.header.set('TIMESYS', 'TT',  'Terrestrial Time: synchronous with, but 32.184')
+    prhdu.header.set('TIMEREF', 'LOCAL',  'Time reference')
+    prhdu.header.set('TIMEUNIT', 's',  'Time unit for timing header keywords')
+    prhdu.header.set('MJDREFI', 59580,  'MJD reference day 01 Jan 2022 00:00:00 UTC')
+    prhdu.header.set('MJDREFF', 0.00080074074,  'MJD reference (fraction part: 32.184 secs + 37')
+    prhdu.header.set('CLOCKAPP', False,  'Set to TRUE if correction has been applied to t')
+    prhdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
+    prhdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
+    prhdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
+    prhdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
+    prhdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
+    
+    columns = [pyfits.Column(name='TIME', format='1D', unit='s', array=time),
+               pyfits.Column(name='NREJ', format='4J', unit='count', array=nrej)]
+    for q in range(4):
+        columns.append(pyfits.Column(name='REJ_Q' + "ABCD"[q],
+                                     format='32J',
+                                     unit='count',
+                                     array=counts[:, q]))
+    rejhdu = pyfits.BinTableHDU.from_columns(columns)
+    
+    rejhdu.header.set('EXTNAME', 'REJSTATS',  'Name of this binary table extension')
+    rejhdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    rejhdu.header.set('INSTRUME', fm,  'Instrument name')
+    rejhdu.header.set('TIMESYS', 'TT',  'Terrestrial Time: synchronous with, but 32.184')
+    rejhdu.header.set('TIMEREF', 'LOCAL',  'Time reference')
+    rejhdu.header.set('TIMEUNIT', 's',  'Time unit for timing header keywords')
+    rejhdu.header.set('MJDREFI', 59580,  'MJD reference day 01 Jan 2022 00:00:00 UTC')
+    rejhdu.header.set('MJDREFF', 0.00080074074,  'MJD reference (fraction part: 32.184 secs + 37')
+    rejhdu.header.set('CLOCKAPP', False,  'Set to TRUE if correction has been applied to t')
+    rejhdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
+    rejhdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
+    rejhdu.header.set('TELAPSE', exposure,  'TSTOP-TSTART')
+    rejhdu.header.set('TIMEDEL', binwidth,  'Bin width')
+    rejhdu.header.set('TIMEPIXR', 0.0,  'TIME is the start of the bin')
+    rejhdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
+    rejhdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
+    rejhdu.header.set('NREJEVT', len(rejected_rejmap),  'Number of rejected events')
+    
+    write_hdulist(pyfits.HDUList([prhdu, rejhdu]), outputfilename, checksum=True, compress=compress, threads=threads, writer=writer)
+
+
+class Spectrum(object):
+    """
+    Per-pixel ADC histogram (SPECTRUM product): counts array of shape
+    (quadrant*channel, adc_bin), with pixel index = quadrant*nchannels + channel
+    and adc_bin = ADC // binsize.
+    Histograms can be accumulated file by file (accumulate_readout), the sparse
+    histograms of parallel workers added with add_cells, and partial Spectrum
+    objects added with merge() or +=.
+    """
+    def __init__(self, binsize=SPECTRUM_BINSIZE, nquadrants=4, nchannels=32):
+        self.binsize = binsize
+        self.nquadrants = nquadrants
+        self.nchannels = nchannels
+        self.nbins = (65536 + binsize - 1)//binsize
+        self.counts = np.zeros((nquadrants*nchannels, self.nbins), dtype=np.int64)
+        self.nfiles = 0
+
+    def accumulate(self, quadid, channel, adc):
+        """
+        Add the pixels given as flat arrays (quadrant, channel and ADC of each pixel)
+        """
+        self.add_cells(*spectrum_cells(quadid, channel, adc, binsize=self.binsize,
+                                       nquadrants=self.nquadrants, nchannels=self.nchannels))
+
+    def add_cells(self, index, counts):
+        """
+        Add a sparse histogram (flat bin index, counts), as returned by spectrum_cells
+        """
+        self.counts.reshape(-1)[index] += counts
+
+    def accumulate_readout(self, packet):
+        """
+        Add the pixel events of one file (list of buffers as returned by ingest_buffer,
+        with Event lists or decodeRecordData columns)
+        """
+        self.add_cells(*readout_spectrum_cells(packet, binsize=self.binsize,
+                                               nquadrants=self.nquadrants, nchannels=self.nchannels))
+        self.nfiles += 1
+
+    def merge(self, other):
+        """
+        Add a partial histogram with the same binning
+        """
+        if (other.binsize, other.nquadrants, other.nchannels) != (self.binsize, self.nquadrants, self.nchannels):
+            raise ValueError("Cannot merge spectra with different binning")
+        self.counts += other.counts
+        self.nfiles += other.nfiles
+        return self
+
+    __iadd__ = merge
+
+    def __getstate__(self):
+        # Partial histograms are sparse: pickle only the non-empty bins
+        state = self.__dict__.copy()
+        flat = self.counts.reshape(-1)
+        nonzero = np.nonzero(flat)[0]
+        state["counts"] = (nonzero, flat[nonzero])
+        return state
+
+    def __setstate__(self, state):
+        nonzero, values = state.pop("counts")
+        self.__dict__.update(state)
+        self.counts = np.zeros((self.nquadrants*self.nchannels, self.nbins), dtype=np.int64)
+        self.counts.reshape(-1)[nonzero] = values
+
+
+def spectrum_cells(quadid, channel, adc, binsize=SPECTRUM_BINSIZE, nquadrants=4, nchannels=32):
+    """
+    Sparse per-pixel ADC histogram of the pixels given as flat arrays
+    (quadrant, channel and ADC of each pixel), with the binning of Spectrum
+    Output:
+        flat index of the non-empty bins of Spectrum.counts (sorted, unique), counts of these bins
+    """
+    nbins = (65536 + binsize - 1)//binsize
+    quadid = np.asarray(quadid, dtype=np.int64)
+    channel = np.asarray(channel, dtype=np.int64)
+    adc = np.asarray(adc, dtype=np.int64)
+    valid = (quadid >= 0) & (quadid < nquadrants) & (channel >= 0) & (channel < nchannels) & (adc >= 0) & (adc < 65536)
+    index = (quadid[valid]*nchannels + channel[valid])*nbins + adc[valid]//binsize
+    # A file fills a few thousand of the 2M bins: the bins are counted on the sorted
+    # indices (np.unique), a dense np.bincount would allocate all of them for each file
+    return np.unique(index, return_counts=True)
+
+
+def readout_spectrum_cells(packet, binsize=SPECTRUM_BINSIZE, nquadrants=4, nchannels=32):
+    """
+    Sparse per-pixel ADC histogram (see spectrum_cells) of the pixel events of one file
+    (list of buffers as returned by ingest_buffer, with Event lists or decodeRecordData columns)
+    """
+    quadid = []
+    channel = []
+    adc = []
+    for buf in packet:
+        for header, data in buf:
+            if not isinstance(data, dict):
+                data = columns_from_events(data)
+            # Pixel entries of the non-rejected events
+            pixel = (np.repeat(data["MULT"], data["NENTRIES"]) > -1) & (data["EVTYPE"] != 0)
+            quadid.append(data["ASICID"][pixel])
+            channel.append(data["CHANNEL"][pixel])
+            adc.append(data["ADC"][pixel])
+    return spectrum_cells(concatenate_chunks(quadid, np.int64), concatenate_chunks(channel, np.int64), concatenate_chunks(adc, np.int64),
+                          binsize=binsize, nquadrants=nquadrants, nchannels=nchannels)
+
+
+def ingest_buffer_spectrum(filein, binsize=SPECTRUM_BINSIZE, **kwargs):
+    """
+    ingest_buffer, plus the sparse SPECTRUM histogram of the file,
+    to be added to the running Spectrum of the conversion with Spectrum.add_cells
+    Output:
+        ingest_buffer output, (flat bin index, counts)
+    """
+    output = ingest_buffer(filein, **kwargs)
+    return output, readout_spectrum_cells(output, binsize=binsize)
+
+
+def writeFITS_SPECTRUM(spectrum, outputfilename, fm="FM2", obsdates=None, compress=False, threads=None, writer=None):
+    """
+    Write the per-pixel ADC histograms (SPECTRUM extension, one row per pixel)
+    """
+    print("\n*** WRITING SPECTRUM FITS FILE ***\n")
+    print("Number of files: ", spectrum.nfiles)
+    print("Number of pixel events: ", spectrum.counts.sum())
+    
+    pixels = np.arange(spectrum.nquadrants*spectrum.nchannels)
+    spehdu = pyfits.BinTableHDU.from_columns([
+                                              pyfits.Column(name='QUADID',
+                                                            format='1B',
+                                                            array=pixels//spectrum.nchannels),
+                                              pyfits.Column(name='CHANNEL',
+                                                            format='1B',
+                                                            array=pixels%spectrum.nchannels),
+                                              pyfits.Column(name='COUNTS',
+                                                            format='{:d}J'.format(spectrum.nbins),
+                                                            unit='count',
+                                                            array=spectrum.counts),
+                                              pyfits.Column(name='TOTAL',
+                                                            format='1K',
+                                                            unit='count',
+                                                            array=spectrum.counts.sum(axis=1)),
+                                            ])
+    
+    prhdu = pyfits.PrimaryHDU()
+    prhdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    prhdu.header.set('INSTRUME', fm,  'Instrument name')
+    
+    spehdu.header.set('EXTNAME', 'SPECTRUM',  'Name of this binary table extension')
+    spehdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    spehdu.header.set('INSTRUME', fm,  'Instrument name')
+    spehdu.header.set('ADCBIN', spectrum.binsize,  'ADC channels per histogram bin')
+    spehdu.header.set('NADCBIN', spectrum.nbins,  'Number of histogram bins')
+    spehdu.header.set('NFILES', spectrum.nfiles,  'Number of accumulated raw files')
+    if obsdates is not None:
+        tstart, tstop = obsdates
+        for hdu in [prhdu, spehdu]:
+            hdu.header.set('TSTART', tstart,  'Start: Elapsed secs since HERMES epoch')
+            hdu.header.set('TSTOP', tstop,  'Stop: Elapsed secs since HERMES epoch')
+            hdu.header.set('TELAPSE', tstop - tstart,  'TSTOP-TSTART')
+    
+    write_hdulist(pyfits.HDUList([prhdu, spehdu]), outputfilename, checksum=True, compress=compress, threads=threads, writer=writer)
+
+
+class EventClock(object):
+    """
+    Streaming version of the LV0 event time computation: keeps the
+    per-quadrant ABT state across buffers, so that the event times of
+    each buffer can be computed as soon as it is read.
+    Times are aligned as in writeFITS_LV0 (zero-aligned to the first event,
+    plus the MET offset from the first header if gps_ok).
+    """
+    def __init__(self, gps_ok=False):
+        self.gps_ok = gps_ok
+        self.obt_previous = None
+        self.nsec_previous = None
+        self.offset = None
+        self.met_offset = 0
+
+    def buffer_events(self, buf):
+        """
+        Input:
+            buf = list of (header, events) tuples of one buffer (one per quadrant),
+                  Event lists or decodeRecordData columns
+        Output:
+            arrays of time, quadrant and PHA (maximum ADC) of the photon events
+        """
+        times = []
+        quadids = []
+        phas = []
+        for k, (header, data) in enumerate(buf):
+            if self.obt_previous is None:
+                # First header of the acquisition
+                self.obt_previous = np.ones(4) * header.BEE_HK["ABT_OBT"]
+                self.nsec_previous = np.ones(4) * (9999999 - header.BEE_HK["ABT_CNT"])
+                if self.gps_ok:
+                    gps_time_ref = -header.GPS_Time["GPSOffset"] + header.GPS_Time["UTCOffset"] + header.GPS_Time["WeekSeconds"] + header.GPS_Time["Week"]*7*86400
+                    self.met_offset = gps_time_ref - 1325030381.0
+            if not isinstance(data, dict):
+                data = columns_from_events(data)
+            # ABT state of the events, as in writeFITS_LV0
+            abt_columns = quadrant_abt_columns(data, self.obt_previous[k], self.nsec_previous[k], 0)
+            self.obt_previous[k], self.nsec_previous[k], origin = abt_columns["state"]
+            rows = np.nonzero(data["MULT"] > -1)[0]
+            if len(rows) == 0:
+                continue
+            time = (data["TIMEMARK"][rows] - abt_columns["OBTERR"][rows])*1e-7 + abt_columns["OBTS"][rows]
+            if self.offset is None:
+                self.offset = self.met_offset - np.floor(time[0])
+            pixel = abt_columns["PIXEL"]
+            pha = np.full(len(data["MULT"]), -1, dtype=np.int64)
+            np.maximum.at(pha, abt_columns["ENTRYEVT"][pixel], data["ADC"][pixel].astype(np.int64))
+            photon = data["MULT"][rows] > 0
+            times.append(time[photon] + self.offset)
+            quadids.append(np.full(np.count_nonzero(photon), k, dtype=np.int64))
+            phas.append(pha[rows][photon])
+        return concatenate_chunks(times), concatenate_chunks(quadids, np.int64), concatenate_chunks(phas, np.int64)
+
+
+class BurstTrigger(object):
+    """
+    Streaming burst trigger.
+    Events are counted in base bins of width binsize, per quadrant and energy band.
+    Bins are closed when the next buffer has started after them (the trigger lags
+    by one buffer, so that events are not late when buffers overlap), and each block of
+    closed bins is processed at once with prefix sums over a ring of the last
+    bins, so each bin costs O(1) whatever the timescale.
+    For each timescale the counts in the window ending at each bin are compared
+    with the background, taken from the bkg_window seconds preceding the window:
+    a trigger is issued when the significance (N - B)/sqrt(B) of at least
+    min_quadrants quadrants is above threshold.
+    Each trigger is also appended to the alert file (one JSON object per line) if given.
+    Across data gaps (or ABT jumps) longer than the trigger history, the pending bins
+    are closed and the trigger restarts after the gap, with an empty background history:
+    the empty stretch is never allocated, and at most max_pending bins are kept open.
+    """
+    def __init__(self, timescales=TRIGGER_TIMESCALES, band_edges=RATE_BAND_EDGES, binsize=TRIGGER_BINSIZE,
+                 bkg_window=TRIGGER_BKG_WINDOW, threshold=TRIGGER_THRESHOLD, min_quadrants=2, holdoff=None,
+                 alert_filename=None):
+        self.band_edges = np.asarray(band_edges)
+        self.nbands = len(band_edges) - 1
+        self.binsize = binsize
+        self.windows = [max(1, int(round(timescale/binsize))) for timescale in timescales]
+        self.timescales = [n*binsize for n in self.windows]
+        self.nbkg = max(1, int(round(bkg_window/binsize)))
+        self.threshold = threshold
+        self.min_quadrants = min_quadrants
+        self.holdoff = holdoff if holdoff is not None else max(self.timescales)
+        self.nchannels = 4*self.nbands
+        self.t0 = None
+        self.next_bin = 0
+        self.pending = np.zeros((0, self.nchannels), dtype=np.int64)
+        self.history = np.zeros((0, self.nchannels), dtype=np.int64)
+        self.history_length = max(self.windows) + self.nbkg
+        self.max_pending = 4*self.history_length
+        self.n_restarts = 0
+        self.last_trigger = {}
+        self.triggers = []
+        self.n_events = 0
+        self.n_late = 0
+        self.alert_filename = alert_filename
+        if alert_filename is not None:
+            open(alert_filename, "w").close()
+
+    def feed(self, times, quadid, pha):
+        """
+        Add the photon events of one buffer, and process the bins that are complete
+        """
+        if len(times) == 0:
+            return
+        if self.t0 is None:
+            self.t0 = np.floor(times.min()/self.binsize)*self.binsize
+        band = np.searchsorted(self.band_edges, pha, side="right") - 1
+        tbin = np.floor((times - self.t0)/self.binsize).astype(np.int64)
+        valid = (band >= 0) & (band < self.nbands) & (quadid >= 0) & (quadid < 4)
+        # Events much older than the closed bins come after an ABT jump back: the trigger restarts there
+        late = valid & (tbin < self.next_bin) & (tbin >= self.next_bin - self.history_length)
+        self.n_late += np.count_nonzero(late)
+        valid &= ~late
+        self.n_events += np.count_nonzero(valid)
+        if not np.any(valid):
+            # Only late events (or events out of the bands): nothing to add
+            return
+        
+        # Stretches of events separated by more than the trigger history
+        order = np.argsort(tbin[valid], kind="stable")
+        tbin = tbin[valid][order]
+        channel = (quadid[valid]*self.nbands + band[valid])[order]
+        splits = np.nonzero(np.diff(tbin) > self.history_length)[0] + 1
+        for start, stop in zip(np.concatenate([[0], splits]), np.concatenate([splits, [len(tbin)]])):
+            first_bin = tbin[start]
+            if first_bin < self.next_bin or first_bin - (self.next_bin + len(self.pending)) > self.history_length:
+                # Gap (or ABT jump) after the pending bins: close them and start again after the gap
+                self.restart(first_bin)
+            # Fill at most max_pending open bins at a time
+            while start < stop:
+                if tbin[start] - self.next_bin >= self.max_pending:
+                    self.process(tbin[start] - self.next_bin - self.history_length)
+                end = start + np.searchsorted(tbin[start:stop], self.next_bin + self.max_pending)
+                rows = tbin[start:end] - self.next_bin
+                nrows = max(len(self.pending), rows.max() + 1)
+                if nrows > len(self.pending):
+                    self.pending = np.concatenate([self.pending, np.zeros((nrows - len(self.pending), self.nchannels), dtype=np.int64)])
+                index = rows*self.nchannels + channel[start:end]
+                histogram = np.bincount(index)
+                self.pending.reshape(-1)[:len(histogram)] += histogram
+                start = end
+        
+        # Bins before the first event of the buffer are complete: the quadrants of a buffer
+        # overlap in time, and the next buffer may start before the last events of this one
+        horizon = times.min()
+        self.process(int(np.floor((horizon - self.t0)/self.binsize)) - self.next_bin)
+
+    def restart(self, first_bin):
+        """
+        Close all the pending bins and start again at first_bin (after a data gap),
+        with an empty background history
+        """
+        self.process(len(self.pending))
+        self.pending = np.zeros((0, self.nchannels), dtype=np.int64)
+        self.history = np.zeros((0, self.nchannels), dtype=np.int64)
+        self.next_bin = int(first_bin)
+        self.last_trigger = {}
+        self.n_restarts += 1
+
+    def flush(self):
+        """
+        Process all the pending bins (end of the data)
+        """
+        self.process(len(self.pending))
+
+    def process(self, nclosed):
+        if nclosed <= 0:
+            return
+        # Long stretches are closed max_pending bins at a time
+        while nclosed > self.max_pending:
+            self.process(self.max_pending)
+            nclosed -= self.max_pending
+        if nclosed > len(self.pending):
+            # Empty bins after the last event
+            self.pending = np.concatenate([self.pending, np.zeros((nclosed - len(self.pending), self.nchannels), dtype=np.int64)])
+        closed = self.pending[:nclosed]
+        self.pending = self.pending[nclosed:]
+        first_bin = self.next_bin
+        self.next_bin += nclosed
+        
+        extended = np.concatenate([self.history, closed])
+        h = len(self.history)
+        cumulative = np.zeros((len(extended) + 1, self.nchannels), dtype=np.int64)
+        np.cumsum(extended, axis=0, out=cumulative[1:])
+        # Absolute bin index of each row of extended
+        bins = first_bin - h + np.arange(len(extended))
+        j = np.arange(h, len(extended))
+        
+        for n, timescale in zip(self.windows, self.timescales):
+            # Rows with a full window and a full background before it
+            ok = j + 1 - n - self.nbkg >= 0
+            jj = j[ok]
+            if len(jj) == 0:
+                continue
+            counts = (cumulative[jj+1] - cumulative[jj+1-n]).reshape(-1, 4, self.nbands)
+            background = ((cumulative[jj+1-n] - cumulative[jj+1-n-self.nbkg])*(n/self.nbkg)).reshape(-1, 4, self.nbands)
+            significance = (counts - background)/np.sqrt(np.maximum(background, 1.))
+            above = (significance >= self.threshold).sum(axis=1) >= self.min_quadrants
+            for row, b in zip(*np.nonzero(above)):
+                stop = self.t0 + (bins[jj[row]] + 1)*self.binsize
+                key = (timescale, b)
+                if key in self.last_trigger and stop - self.last_trigger[key] < self.holdoff:
+                    continue
+                self.last_trigger[key] = stop
+                total = counts[row,:,b].sum()
+                total_bkg = background[row,:,b].sum()
+                trigger = {"time": stop - timescale,
+                           "timescale": timescale,
+                           "band": int(b),
+                           "counts": counts[row,:,b].tolist(),
+                           "background": background[row,:,b].tolist(),
+                           "significance": significance[row,:,b].tolist(),
+                           "quadrants": int((significance[row,:,b] >= self.threshold).sum()),
+                           "total_significance": float((total - total_bkg)/np.sqrt(max(total_bkg, 1.)))}
+                self.triggers.append(trigger)
+                logger.warning("TRIGGER at %.3f s, timescale %g s, band %d: %d counts (%.1f expected), %.1f sigma",
+                               trigger["time"], timescale, b, total, total_bkg, trigger["total_significance"])
+                if self.alert_filename is not None:
+                    with open(self.alert_filename, "a") as f:
+                        f.write(json.dumps(trigger) + "\n")
+        
+        self.history = extended[-self.history_length:]
+
+
+def writeFITS_TRIGGERS(trigger, outputfilename, fm="FM2", compress=False, threads=None, writer=None):
+    """
+    Write the triggers found by a BurstTrigger (TRIGGERS extension)
+    """
+    print("\n*** WRITING TRIGGERS FITS FILE ***\n")
+    print("Number of events: ", trigger.n_events)
+    print("Number of late events: ", trigger.n_late)
+    print("Number of restarts after data gaps: ", trigger.n_restarts)
+    print("Number of triggers: ", len(trigger.triggers))
+    
+    triggers = trigger.triggers
+    trghdu = pyfits.BinTableHDU.from_columns([
+                                              pyfits.Column(name='TIME',
+                                                            format='1D',
+                                                            unit='s',
+                                                            array=np.array([t["time"] for t in triggers])),
+                                              pyfits.Column(name='TIMESCALE',
+                                                            format='1D',
+                                                            unit='s',
+                                                            array=np.array([t["timescale"] for t in triggers])),
+                                              pyfits.Column(name='BAND',
+                                                            format='1B',
+                                                            array=np.array([t["band"] for t in triggers])),
+                                              pyfits.Column(name='NQUAD',
+                                                            format='1B',
+                                                            array=np.array([t["quadrants"] for t in triggers])),
+                                              pyfits.Column(name='COUNTS',
+                                                            format='4J',
+                                                            unit='count',
+                                                            array=np.array([t["counts"] for t in triggers]).reshape(-1, 4)),
+                                              pyfits.Column(name='BKG',
+                                                            format='4E',
+                                                            unit='count',
+                                                            array=np.array([t["background"] for t in triggers]).reshape(-1, 4)),
+                                              pyfits.Column(name='SIGMA',
+                                                            format='4E',
+                                                            array=np.array([t["significance"] for t in triggers]).reshape(-1, 4)),
+                                              pyfits.Column(name='SIGMATOT',
+                                                            format='1E',
+                                                            array=np.array([t["total_significance"] for t in triggers])),
+                                            ])
+    
+    prhdu = pyfits.PrimaryHDU()
+    prhdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    prhdu.header.set('INSTRUME', fm,  'Instrument name')
+    
+    trghdu.header.set('EXTNAME', 'TRIGGERS',  'Name of this binary table extension')
+    trghdu.header.set('TELESCOP', 'HERMES',  'Telescope name')
+    trghdu.header.set('INSTRUME', fm,  'Instrument name')
+    trghdu.header.set('TIMESYS', 'TT',  'Terrestrial Time: synchronous with, but 32.184')
+    trghdu.header.set('TIMEREF', 'LOCAL',  'Time reference')
+    trghdu.header.set('TIMEUNIT', 's',  'Time unit for timing header keywords')
+    trghdu.header.set('MJDREFI', 59580,  'MJD reference day 01 Jan 2022 00:00:00 UTC')
+    trghdu.header.set('MJDREFF', 0.00080074074,  'MJD reference (fraction part: 32.184 secs + 37')
+    trghdu.header.set('TRGBIN', trigger.binsize,  'Trigger base bin width')
+    trghdu.header.set('TRGBKG', trigger.nbkg*trigger.binsize,  'Background window')
+    trghdu.header.set('TRGTHR', trigger.threshold,  'Significance threshold')
+    trghdu.header.set('TRGNQUAD', trigger.min_quadrants,  'Minimum number of triggered quadrants')
+    trghdu.header.set('TRGNEVT', trigger.n_events,  'Number of events in the trigger bins')
+    trghdu.header.set('TRGNLATE', trigger.n_late,  'Number of late events (bins closed, dropped)')
+    trghdu.header.set('TRGLATE', trigger.n_late/max(trigger.n_events + trigger.n_late, 1),  'Fraction of late events')
+    trghdu.header.set('TRGNRST', trigger.n_restarts,  'Number of restarts after data gaps')
+    for b in range(trigger.nbands):
+        trghdu.header.set('PHALO{:d}'.format(b+1), int(trigger.band_edges[b]),  'Band lower ADC edge')
+        trghdu.header.set('PHAHI{:d}'.format(b+1), int(trigger.band_edges[b+1]),  'Band upper ADC edge (excluded)')
+    
+    write_hdulist(pyfits.HDUList([prhdu, trghdu]), outputfilename, checksum=True, compress=compress, threads=threads, writer=writer)
+
+
+def writeNPY(hdulist, dirname, extensions=("PACKETS", "EVENTS", "REJECTED", "GTI")):
+    """
+    Export the binary table extensions of an HDUList as raw .npy files,
+    one for each column, plus a JSON manifest (manifest.json).
+    Fixed-width columns are saved as they are stored in the FITS table.
+    Variable-length columns (CHANNEL, PHA) are saved flattened
+    (<EXT>_<COL>.npy) with an offsets array (<EXT>_<COL>_OFFSETS.npy):
+    the values of row i are flat[offsets[i]:offsets[i+1]].
+    Columns with TZERO = 32768 (16 bit unsigned) are saved as uint16.
+    The files can be memory-mapped with np.load(..., mmap_mode='r'),
+    see loadNPY.
+    """
+    os.makedirs(dirname, exist_ok=True)
+    
+    manifest = {"format": "HERMES_NPY",
+                "version": 1,
+                "keywords": {},
+                "tables": {}}
+    for key in ["TELESCOP", "INSTRUME", "TSTART", "TSTOP", "TELAPSE", "ONTIME", "EXPOSURE", "DATE-OBS", "DATE-END", "MJDREFI", "MJDREFF"]:
+        if key in hdulist[0].header:
+            manifest["keywords"][key] = hdulist[0].header[key]
+    
+    for hdu in hdulist[1:]:
+        extname = hdu.header.get("EXTNAME")
+        if extname not in extensions:
+            continue
+        table = {"rows": len(hdu.data), "columns": {}}
+        for i, column in enumerate(hdu.columns):
+            name = column.name
+            tzero = hdu.header.get("TZERO{:d}".format(i+1), 0)
+            data = hdu.data[name]
+            entry = {"file": "{:s}_{:s}.npy".format(extname, name)}
+            if data.dtype == object:
+                # Variable-length array column: flatten and store the offsets
+                lengths = np.array([len(x) for x in data], dtype=np.int64)
+                offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+                np.cumsum(lengths, out=offsets[1:])
+                if len(data) > 0:
+                    flat = np.concatenate([np.asarray(x) for x in data])
+                else:
+                    flat = np.zeros(0, dtype=np.int32)
+                entry["offsets"] = "{:s}_{:s}_OFFSETS.npy".format(extname, name)
+                np.save(os.path.join(dirname, entry["offsets"]), offsets)
+            else:
+                flat = np.asarray(data)
+            if tzero == 32768:
+                flat = (flat.astype(np.int32) + 32768).astype(np.uint16)
+            entry["dtype"] = flat.dtype.str
+            entry["shape"] = list(flat.shape)
+            if column.unit:
+                entry["unit"] = column.unit
+            np.save(os.path.join(dirname, entry["file"]), np.ascontiguousarray(flat))
+            table["columns"][name] = entry
+        manifest["tables"][extname] = table
+    
+    with open(os.path.join(dirname, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    
+    return manifest
+
+
+def loadNPY(dirname, mmap_mode="r"):
+    """
+    Load (memory-mapped by default) the tables exported by writeNPY.
+    Output:
+        dictionary {extname: {column name: array}}
+        for variable-length columns, also {column name + "_OFFSETS": offsets array}
+    """
+    with open(os.path.join(dirname, "manifest.json")) as f:
+        manifest = json.load(f)
+    
+    tables = {}
+    for extname, table in manifest["tables"].items():
+        tables[extname] = {}
+        for name, entry in table["columns"].items():
+            tables[extname][name] = np.load(os.path.join(dirname, entry["file"]), mmap_mode=mmap_mode)
+            if "offsets" in entry:
+                tables[extname][name + "_OFFSETS"] = np.load(os.path.join(dirname, entry["offsets"]), mmap_mode=mmap_mode)
+    return tables
+
+
+# Tiled table compression (FITS tiled table convention, as written by "fpack -table"):
+# each column of each tile of rows is gzipped into a cell of a 1QB column,
+# multi-byte numeric columns are byte-shuffled first (GZIP_2).
+TFORM_PATTERN = re.compile(r"^(\d*)([LXBIJKAEDCMPQ])([LXBIJKAEDCM]?)(?:\((\d+)\))?$")
+TFORM_WIDTHS = {"L": 1, "X": 1, "B": 1, "A": 1, "I": 2, "J": 4, "K": 8, "E": 4, "D": 8, "C": 8, "M": 16, "P": 8, "Q": 16}
+GZIP_2_TYPES = "IJKED"
+# A gzip stream is never shorter than this: smaller arrays are stored as they are
+GZIP_MIN_SIZE = 20
+
+
+def parse_tform(tform):
+    """
+    Split a binary table TFORM into repeat, type, array type (for P/Q columns)
+    and width in bytes of the column
+    """
+    match = TFORM_PATTERN.match(tform.strip())
+    if match is None:
+        raise ValueError("Unsupported TFORM: " + tform)
+    repeat = int(match.group(1)) if match.group(1) else 1
+    coltype = match.group(2)
+    arraytype = match.group(3)
+    if coltype == "X":
+        width = (repeat + 7)//8
+    else:
+        width = repeat*TFORM_WIDTHS[coltype]
+    return repeat, coltype, arraytype, width
+
+
+def shuffle_bytes(data, size):
+    """
+    Byte shuffle (GZIP_2): all the first bytes of the values, then all the second bytes, ...
+    """
+    if size <= 1:
+        return data.tobytes()
+    return data.reshape(-1, size).T.tobytes()
+
+
+def compress_tile_column(block, algorithm, size, level):
+    """
+    Compress one column of a tile of rows.
+    Input:
+        block = uint8 array (rows, column width) with the big-endian column bytes
+    """
+    if algorithm == "GZIP_2":
+        data = shuffle_bytes(block, size)
+    else:
+        data = block.tobytes()
+    return gzip.compress(data, level, mtime=0)
+
+
+def compress_tile_vla(block, heap, descriptor, algorithm, size, level):
+    """
+    Compress the arrays of one variable-length column of a tile of rows.
+    Each array is gzipped on its own, and is stored uncompressed if that is not smaller.
+    Input:
+        block = uint8 array (rows, 8 or 16) with the big-endian P or Q descriptors
+        heap = uint8 array with the heap of the uncompressed table
+    Output:
+        stored lengths (one per row), concatenated stored arrays
+    """
+    pairs = np.frombuffer(block.tobytes(), dtype=">i4" if descriptor == "P" else ">i8").reshape(-1, 2).astype(np.int64)
+    lengths = pairs[:,0]*size
+    starts = pairs[:,1]
+    ends = np.cumsum(lengths)
+    begins = ends - lengths
+    # Gather all the arrays, then replace those that can be compressed
+    raw = heap[np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - begins, lengths)]
+    stored = lengths.copy()
+    pieces = []
+    last = 0
+    for i in np.nonzero(lengths > GZIP_MIN_SIZE)[0]:
+        array = raw[begins[i]:ends[i]]
+        if algorithm == "GZIP_2":
+            compressed = gzip.compress(shuffle_bytes(array, size), level, mtime=0)
+        else:
+            compressed = gzip.compress(array.tobytes(), level, mtime=0)
+        if len(compressed) < lengths[i]:
+            pieces.append(raw[last:begins[i]].tobytes())
+            pieces.append(compressed)
+            stored[i] = len(compressed)
+            last = ends[i]
+    pieces.append(raw[last:].tobytes())
+    return stored, b"".join(pieces)
+
+
+def compress_table_hdu(hdu, raw, tile_rows=100000, threads=None, level=6):
+    """
+    Tile-compress a binary table HDU.
+    Input:
+        hdu = BinTableHDU as read from the uncompressed file (header is used)
+        raw = uint8 array with the data unit of the uncompressed HDU (table and heap)
+        tile_rows = number of rows in each tile
+        threads = number of compression threads (default: ThreadPoolExecutor default)
+    Output:
+        compressed BinTableHDU (data not decoded by astropy)
+    """
+    header = hdu.header
+    naxis1 = header["NAXIS1"]
+    naxis2 = header["NAXIS2"]
+    pcount = header.get("PCOUNT", 0)
+    tfields = header["TFIELDS"]
+    theap = header.get("THEAP", naxis1*naxis2)
+    
+    table = raw[:naxis1*naxis2].reshape(naxis2, naxis1)
+    heap = raw[theap:theap+pcount]
+    
+    # Column layout and compression algorithm
+    columns = []
+    start = 0
+    for i in range(tfields):
+        tform = header["TFORM{:d}".format(i+1)]
+        repeat, coltype, arraytype, width = parse_tform(tform)
+        if coltype in "PQ":
+            size = TFORM_WIDTHS[arraytype] if arraytype else 1
+            algorithm = "GZIP_2" if arraytype in GZIP_2_TYPES and size > 1 else "GZIP_1"
+        else:
+            size = TFORM_WIDTHS[coltype]
+            algorithm = "GZIP_2" if coltype in GZIP_2_TYPES and size > 1 else "GZIP_1"
+        columns.append((tform, coltype, start, width, size, algorithm))
+        start += width
+    
+    tiles = [(first, min(first+tile_rows, naxis2)) for first in range(0, naxis2, tile_rows)]
+    
+    # Compress all the (tile, column) cells in parallel (zlib releases the GIL)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        jobs = []
+        for first, last in tiles:
+            for tform, coltype, start, width, size, algorithm in columns:
+                block = table[first:last, start:start+width]
+                if width == 0:
+                    jobs.append(None)
+                elif coltype in "PQ":
+                    jobs.append(executor.submit(compress_tile_vla, block, heap, coltype, algorithm, size, level))
+                else:
+                    jobs.append(executor.submit(compress_tile_column, block, algorithm, size, level))
+        results = [job.result() if job is not None else None for job in jobs]
+        
+        # Variable-length arrays go first in the heap: their position is needed
+        # to write the descriptors, which are stored (gzipped) in the column cells
+        heap_pieces = []
+        heap_size = 0
+        descriptor_jobs = {}
+        k = 0
+        for first, last in tiles:
+            for tform, coltype, start, width, size, algorithm in columns:
+                if width > 0 and coltype in "PQ":
+                    stored, data = results[k]
+                    offsets = heap_size + np.cumsum(stored) - stored
+                    out_descriptors = np.stack([stored, offsets], axis=1).astype(">i8")
+                    heap_pieces.append(data)
+                    heap_size += len(data)
+                    in_descriptors = table[first:last, start:start+width].tobytes()
+                    descriptor_jobs[k] = executor.submit(gzip.compress, in_descriptors + out_descriptors.tobytes(), level, mtime=0)
+                k += 1
+        for k, job in descriptor_jobs.items():
+            results[k] = job.result()
+    
+    # Cells of the compressed table: one row per tile, one 1QB descriptor per column
+    cells = np.zeros((len(tiles), tfields, 2), dtype=">i8")
+    maxlen = np.zeros(tfields, dtype=np.int64)
+    for k, cell in enumerate(results):
+        if cell is None:
+            continue
+        cells[k//tfields, k%tfields] = (len(cell), heap_size)
+        maxlen[k%tfields] = max(maxlen[k%tfields], len(cell))
+        heap_pieces.append(cell)
+        heap_size += len(cell)
+    
+    # Header: original keywords, with the ZTABLE keywords describing the uncompressed table
+    zheader = pyfits.Header()
+    zheader.append(("XTENSION", "BINTABLE", "binary table extension"))
+    zheader.append(("BITPIX", 8, "array data type"))
+    zheader.append(("NAXIS", 2, "number of array dimensions"))
+    zheader.append(("NAXIS1", 16*tfields, "length of dimension 1"))
+    zheader.append(("NAXIS2", len(tiles), "length of dimension 2"))
+    zheader.append(("PCOUNT", heap_size, "number of group parameters"))
+    zheader.append(("GCOUNT", 1, "number of groups"))
+    zheader.append(("TFIELDS", tfields, "number of table fields"))
+    skip = ["XTENSION", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "PCOUNT", "GCOUNT", "TFIELDS", "THEAP", "CHECKSUM", "DATASUM"]
+    for card in header.cards:
+        if card.keyword in skip:
+            continue
+        if card.keyword.startswith("TFORM"):
+            zheader.append((card.keyword, "1QB({:d})".format(maxlen[int(card.keyword[5:])-1]), card.comment))
+        else:
+            zheader.append(card)
+    if "CHECKSUM" in header:
+        zheader.append(("ZHECKSUM", header["CHECKSUM"], header.comments["CHECKSUM"]))
+    if "DATASUM" in header:
+        zheader.append(("ZDATASUM", header["DATASUM"], header.comments["DATASUM"]))
+    zheader.append(("ZTABLE", True, "this is a compressed table"))
+    zheader.append(("ZTILELEN", min(tile_rows, naxis2), "number of rows in each tile"))
+    zheader.append(("ZNAXIS1", naxis1, "length of dimension 1"))
+    zheader.append(("ZNAXIS2", naxis2, "length of dimension 2"))
+    zheader.append(("ZPCOUNT", pcount, "number of group parameters"))
+    if theap != naxis1*naxis2:
+        zheader.append(("ZTHEAP", theap, "offset to the start of the heap"))
+    for i, column in enumerate(columns):
+        zheader.append(("ZFORM{:d}".format(i+1), column[0]))
+    for i, column in enumerate(columns):
+        zheader.append(("ZCTYP{:d}".format(i+1), column[5], "compression algorithm for column"))
+    
+    data = cells.tobytes() + b"".join(heap_pieces)
+    padding = b"\0"*(-len(data) % 2880)
+    return pyfits.BinTableHDU.fromstring(zheader.tostring().encode("ascii") + data + padding)
+
+
+def writeFITS_compressed(hdulist, outputfilename, tile_rows=100000, threads=None, min_size=28800):
+    """
+    Write an HDUList with its binary tables tile-compressed (FITS tiled table
+    convention, GZIP_1/GZIP_2 only: expanded with funpack, or read with readFITS_compressed;
+    astropy and fitsio do not uncompress tables).
+    Tiles are compressed by a pool of threads.
+    The checksums of the uncompressed HDUs are kept in ZHECKSUM/ZDATASUM,
+    and all the written HDUs get their own CHECKSUM/DATASUM.
+    Input:
+        tile_rows = number of rows in each tile
+        threads = number of compression threads
+        min_size = tables with a data unit smaller than this (bytes) are written uncompressed
+    """
+    # Serialize the uncompressed file, to get the tables as they are stored on disk
+    buffer = io.BytesIO()
+    hdulist.writeto(buffer, checksum=True)
+    uncompressed = buffer.getvalue()
+    buffer.close()
+    raw = np.frombuffer(uncompressed, dtype=np.uint8)
+    
+    with pyfits.open(io.BytesIO(uncompressed)) as stored:
+        hdus = []
+        for i, hdu in enumerate(stored):
+            info = stored.fileinfo(i)
+            datasize = hdu.header.get("NAXIS1", 0)*hdu.header.get("NAXIS2", 0) + hdu.header.get("PCOUNT", 0)
+            if isinstance(hdu, pyfits.BinTableHDU) and datasize >= min_size:
+                logger.info("Compressing %s (%d rows)", hdu.header.get("EXTNAME", ""), hdu.header["NAXIS2"])
+                hdus.append(compress_table_hdu(hdu, raw[info["datLoc"]:info["datLoc"]+datasize], tile_rows=tile_rows, threads=threads))
+            else:
+                hdus.append(hdu)
+        pyfits.HDUList(hdus).writeto(outputfilename, overwrite=True, checksum=True)
+
+
+def unshuffle_bytes(data, size):
+    """
+    Inverse of shuffle_bytes
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    if size <= 1:
+        return data
+    return data.reshape(size, -1).T.reshape(-1)
+
+
+def uncompress_tile_column(cell, rows, width, algorithm, size):
+    """
+    Uncompress one column of a tile of rows.
+    Output:
+        uint8 array (rows, column width) with the big-endian column bytes
+    """
+    data = gzip.decompress(cell)
+    if algorithm == "GZIP_2":
+        return unshuffle_bytes(data, size).reshape(rows, width)
+    return np.frombuffer(data, dtype=np.uint8).reshape(rows, width)
+
+
+def uncompress_tile_vla(cell, heap, rows, width, algorithm, size):
+    """
+    Uncompress the arrays of one variable-length column of a tile of rows.
+    Output:
+        lengths (number of elements, one per row), concatenated arrays (bytes)
+    """
+    descriptors = np.frombuffer(gzip.decompress(cell), dtype=np.uint8)
+    pairs = np.frombuffer(descriptors[:rows*width].tobytes(), dtype=">i4" if width == 8 else ">i8").reshape(-1, 2).astype(np.int64)
+    stored = np.frombuffer(descriptors[rows*width:].tobytes(), dtype=">i8").reshape(-1, 2).astype(np.int64)
+    lengths = pairs[:,0]*size
+    pieces = []
+    for i in range(rows):
+        if lengths[i] == 0:
+            continue
+        array = heap[stored[i,1]:stored[i,1]+stored[i,0]]
+        if stored[i,0] == lengths[i]:
+            pieces.append(array.tobytes())
+        elif algorithm == "GZIP_2":
+            pieces.append(unshuffle_bytes(gzip.decompress(array.tobytes()), size).tobytes())
+        else:
+            pieces.append(gzip.decompress(array.tobytes()))
+    return pairs[:,0], b"".join(pieces)
+
+
+def readFITS_compressed(filename, extname, first=0, last=None, threads=None):
+    """
+    Read a range of rows of a tile-compressed binary table (as written by writeFITS_compressed).
+    Only the tiles containing the requested rows are uncompressed, in parallel.
+    Input:
+        first, last = row range (last excluded, default: up to the end of the table)
+    Output:
+        FITS_rec with the rows of the uncompressed table
+    """
+    with pyfits.open(filename) as hdulist:
+        hdu = hdulist[extname]
+        header = hdu.header.copy()
+        datloc = hdulist.fileinfo(hdulist.index_of(extname))["datLoc"]
+    
+    if not header.get("ZTABLE", False):
+        with pyfits.open(filename) as hdulist:
+            return hdulist[extname].data[first:last].copy()
+    
+    tfields = header["TFIELDS"]
+    ntiles = header["NAXIS2"]
+    tile_rows = header["ZTILELEN"]
+    naxis1 = header["ZNAXIS1"]
+    naxis2 = header["ZNAXIS2"]
+    theap = header.get("THEAP", header["NAXIS1"]*ntiles)
+    if last is None or last > naxis2:
+        last = naxis2
+    
+    raw = np.memmap(filename, dtype=np.uint8, mode="r", offset=datloc, shape=(theap + header["PCOUNT"],))
+    cells = np.frombuffer(raw[:header["NAXIS1"]*ntiles].tobytes(), dtype=">i8").reshape(ntiles, tfields, 2).astype(np.int64)
+    heap = raw[theap:]
+    
+    columns = []
+    for i in range(tfields):
+        tform = header["ZFORM{:d}".format(i+1)]
+        repeat, coltype, arraytype, width = parse_tform(tform)
+        size = TFORM_WIDTHS[arraytype or coltype] if coltype in "PQ" else TFORM_WIDTHS[coltype]
+        algorithm = header.get("ZCTYP{:d}".format(i+1), "GZIP_1")
+        if algorithm not in ("GZIP_1", "GZIP_2"):
+            raise ValueError("Unsupported table compression " + algorithm + " (use funpack)")
+        columns.append((tform, coltype, width, size, algorithm))
+    
+    tiles = range(first//tile_rows, (last + tile_rows - 1)//tile_rows)
+    nrows = min(tiles[-1]*tile_rows + tile_rows, naxis2) - tiles[0]*tile_rows if len(tiles) else 0
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        jobs = []
+        for t in tiles:
+            rows = min(tile_rows, naxis2 - t*tile_rows)
+            for i, (tform, coltype, width, size, algorithm) in enumerate(columns):
+                cell = heap[cells[t,i,1]:cells[t,i,1]+cells[t,i,0]].tobytes()
+                if width == 0:
+                    jobs.append(None)
+                elif coltype in "PQ":
+                    jobs.append(executor.submit(uncompress_tile_vla, cell, heap, rows, width, algorithm, size))
+                else:
+                    jobs.append(executor.submit(uncompress_tile_column, cell, rows, width, algorithm, size))
+        results = [job.result() if job is not None else None for job in jobs]
+    
+    # Rebuild the row-major table, with a new heap holding only the arrays of the selected tiles
+    table = np.zeros((nrows, naxis1), dtype=np.uint8)
+    heap_pieces = []
+    heap_size = 0
+    k = 0
+    for t in tiles:
+        start_row = (t - tiles[0])*tile_rows
+        rows = min(tile_rows, naxis2 - t*tile_rows)
+        start = 0
+        for tform, coltype, width, size, algorithm in columns:
+            if width > 0 and coltype in "PQ":
+                nelem, data = results[k]
+                offsets = heap_size + np.cumsum(nelem*size) - nelem*size
+                descriptors = np.stack([nelem, offsets], axis=1).astype(">i4" if coltype == "P" else ">i8")
+                table[start_row:start_row+rows, start:start+width] = np.frombuffer(descriptors.tobytes(), dtype=np.uint8).reshape(rows, width)
+                heap_pieces.append(data)
+                heap_size += len(data)
+            elif width > 0:
+                table[start_row:start_row+rows, start:start+width] = results[k]
+            start += width
+            k += 1
+    
+    uheader = pyfits.Header()
+    uheader.append(("XTENSION", "BINTABLE", "binary table extension"))
+    uheader.append(("BITPIX", 8, "array data type"))
+    uheader.append(("NAXIS", 2, "number of array dimensions"))
+    uheader.append(("NAXIS1", naxis1, "length of dimension 1"))
+    uheader.append(("NAXIS2", nrows, "length of dimension 2"))
+    uheader.append(("PCOUNT", heap_size, "number of group parameters"))
+    uheader.append(("GCOUNT", 1, "number of groups"))
+    uheader.append(("TFIELDS", tfields, "number of table fields"))
+    skip = ["XTENSION", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "PCOUNT", "GCOUNT", "TFIELDS", "THEAP", "CHECKSUM", "DATASUM",
+            "ZHECKSUM", "ZDATASUM", "ZTABLE", "ZTILELEN", "ZNAXIS1", "ZNAXIS2", "ZPCOUNT", "ZTHEAP"]
+    for card in header.cards:
+        if card.keyword in skip or card.keyword.startswith("ZFORM") or card.keyword.startswith("ZCTYP"):
+            continue
+        if card.keyword.startswith("TFORM"):
+            uheader.append((card.keyword, header["ZFORM" + card.keyword[5:]], card.comment))
+        else:
+            uheader.append(card)
+    
+    data = table.tobytes() + b"".join(heap_pieces)
+    padding = b"\0"*(-len(data) % 2880)
+    uhdu = pyfits.BinTableHDU.fromstring(uheader.tostring().encode("ascii") + data + padding)
+    offset = tiles[0]*tile_rows if len(tiles) else 0
+    return uhdu.data[first-offset:last-offset]
+
+
+class FITSWriterPool(object):
+    """
+    Write-behind pool for the FITS products.
+    The writers hand their finished HDUList to the pool, and the checksum
+    computation, compression and disk I/O run in background threads while
+    the next product is being built.
+    At most max_pending HDULists are held at a time: submit() blocks
+    until a slot is free, which bounds the memory use.
+    barrier() waits for all the pending writes and reports the errors.
+    """
+    def __init__(self, workers=1, max_pending=2):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = []
+
+    def submit(self, function, outputfilename, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(function, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.pending.append((outputfilename, future))
+        return future
+
+    def barrier(self):
+        """
+        Wait for all the pending writes.
+        Output:
+            list of (filename, exception) for the writes that failed
+        """
+        errors = []
+        for outputfilename, future in self.pending:
+            error = future.exception()
+            if error is not None:
+                logger.error("ERROR: writing %s failed: %s", outputfilename, error)
+                errors.append((outputfilename, error))
+            else:
+                logger.info("Written %s", outputfilename)
+        self.pending = []
+        return errors
+
+    def close(self):
+        errors = self.barrier()
+        self.executor.shutdown()
+        return errors
+
+
+class FilePrefetcher(object):
+    """
+    Read-ahead of the raw files.
+    A reader thread loads (and decompresses, see read_raw_file) the next files
+    into memory while the current one is decoded, so that the decoding does not
+    wait for slow storage.
+    At most depth files and max_bytes bytes are held ahead at a time
+    (a file larger than max_bytes is read only when nothing else is held).
+    If archive is given, the files are members of that tar archive (see RawArchive),
+    streamed in archive order: members stored out of time order are held until
+    they are needed, beyond the limits if the decoding is waiting for a later member.
+    Iterating gives (filename, data) in the order of filenames.
+    """
+    def __init__(self, filenames, depth=2, max_bytes=256*2**20, archive=None):
+        self.filenames = list(filenames)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.archive = archive
+        self.ready = {}
+        # Files being read or ready, and their bytes
+        self.held_files = 0
+        self.held_bytes = 0
+        # File the consumer is waiting for
+        self.waiting = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def reserve(self, size):
+        """
+        Wait for room for a file of size bytes
+        Output:
+            False if the prefetcher was closed
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or
+                                    (self.waiting is not None and self.waiting not in self.ready) or
+                                    (self.held_files < self.depth and (self.held_files == 0 or self.held_bytes + size <= self.max_bytes)))
+            if self.closed:
+                return False
+            self.held_files += 1
+            self.held_bytes += size
+            return True
+
+    def put(self, filename, data, size, error=None):
+        with self.condition:
+            self.ready[filename] = (data, size, error)
+            self.condition.notify_all()
+
+    def read(self):
+        if self.archive is not None:
+            self.read_archive()
+            return
+        for filename in self.filenames:
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                size = 0
+            if not self.reserve(size):
+                return
+            # The errors are raised in the consumer, when the file is reached
+            data, error = None, None
+            try:
+                data = read_raw_file(filename)
+            except (OSError, EOFError) as e:
+                error = e
+            self.put(filename, data, size, error)
+
+    def read_archive(self):
+        wanted = set(self.filenames)
+        try:
+            with tarfile.open(self.archive, "r|*") as tar:
+                for member in tar:
+                    filename = os.path.join(self.archive, member.name)
+                    if filename not in wanted:
+                        continue
+                    if not self.reserve(member.size):
+                        return
+                    self.put(filename, tar.extractfile(member).read(), member.size)
+                    wanted.discard(filename)
+        except (OSError, EOFError, tarfile.TarError) as e:
+            error = e
+        else:
+            error = EOFError("member not found in " + self.archive)
+        # The members not read give the error when they are reached
+        for filename in wanted:
+            self.put(filename, None, 0, error)
+
+    def __iter__(self):
+        for filename in self.filenames:
+            with self.condition:
+                self.waiting = filename
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: filename in self.ready)
+                data, size, error = self.ready.pop(filename)
+                self.waiting = None
+                self.held_files -= 1
+                self.held_bytes -= size
+                self.condition.notify_all()
+            if error is not None:
+                raise error
+            yield filename, data
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+# Raw files compressed one by one (e.g. 65000000.xz) are decompressed when read
+COMPRESSED_OPENERS = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}
+
+
+def read_raw_file(filename):
+    """
+    Content of a raw file, decompressed if its extension is in COMPRESSED_OPENERS
+    """
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(filename)[1], open)
+    with opener(filename, "rb") as f:
+        return f.read()
+
+
+def raw_file_time(filename):
+    """
+    UNIX timestamp of a raw file: its name is the hex representation of the timestamp
+    (possibly followed by an extension)
+    """
+    return int(os.path.splitext(os.path.basename(filename))[0], base=16)
+
+
+def list_raw_files(dirname):
+    """
+    Raw buffer files of a directory, ordered by their hex value
+    (filename is the hex representation of the UNIX timestamp of the buffer)
+    Output:
+        list of file names, list of UNIX timestamps
+    """
+    files = glob.glob(dirname + os.sep + "*")
+    files.sort(key=raw_file_time)
+    # UNIX timestamps of the files, used to find missing files in the GTIs
+    file_times = [raw_file_time(f) for f in files]
+    return files, file_times
+
+
+def readout_headers(outputs):
+    """
+    Headers of all the buffers of a conversion, as one HEADER_DTYPE array
+    Input:
+        outputs = scan_header_file arrays, or ingest_buffer readouts, one per packet (file)
+    """
+    tables = []
+    for output in outputs:
+        if isinstance(output, np.ndarray):
+            tables.append(output)
+        else:
+            tables.append(np.frombuffer(b"".join(buf[0][0].headerBytes for buf in output), dtype=HEADER_DTYPE))
+    return np.concatenate(tables) if tables else np.zeros(0, dtype=HEADER_DTYPE)
+
+
+def header_obsdates(headers, gps_ok=False):
+    """
+    Observation start and stop from the buffer headers, for the products written
+    without the LV0 event times: the buffer ABTs on the LV0 time scale (zero-aligned
+    on the first buffer, plus the MET offset of the GPS time of the first header as
+    in writeFITS_LV0), from the first buffer to the last one plus the median cadence
+    Input:
+        headers = HEADER_DTYPE array of the buffers (see readout_headers)
+        gps_ok = MET times, as the LV0 times with GPS; otherwise zero-aligned
+    Output:
+        tstart, tstop (None if there are no buffers)
+    """
+    if len(headers) == 0:
+        return None
+    buffer_start = buffer_start_times(headers["ABT_OBT"], headers["ABT_CNT"], 0.)
+    time_zero = np.floor(buffer_start[0])
+    if gps_ok:
+        # Integer conversions as done in Header
+        first = headers[0]
+        gps_time_ref = -np.trunc(first["GPSOffset"]) + np.trunc(first["UTCOffset"]) + np.trunc(first["WeekSeconds"]) \
+                       + float(first["Week"])*7*86400
+        # Convert in MET: the GPS time at MET reference time is 1325030381.0
+        met_offset = gps_time_ref - 1325030381.0
+    else:
+        met_offset = 0
+    buffer_start = buffer_start - time_zero + met_offset
+    cadence = np.median(np.diff(buffer_start)) if len(buffer_start) > 1 else 0.
+    return buffer_start[0], buffer_start[-1] + cadence
+
+
+# Files whose sizes give the mean file size of a preview byte budget
+PREVIEW_SIZE_SAMPLE = 16
+
+
+def preview_indices(n_files, step=None, budget=None, file_size=None):
+    """
+    Files decoded by a quick-look preview: one every step files,
+    or as many files as fit in a byte budget, spread evenly across the acquisition
+    Input:
+        n_files = number of files of the acquisition
+        step = decode one file every step
+        budget = bytes to decode (instead of step)
+        file_size = function index -> size of that file in bytes, only called
+                    on PREVIEW_SIZE_SAMPLE files (the campaign is never scanned by size)
+    Output:
+        array of file indices, in time order
+    """
+    if n_files == 0:
+        return np.zeros(0, dtype=np.int64)
+    if budget is None:
+        return np.arange(0, n_files, step)
+    sample = np.unique(np.linspace(0, n_files - 1, min(n_files, PREVIEW_SIZE_SAMPLE)).round().astype(np.int64))
+    mean_size = max(np.mean([file_size(i) for i in sample]), 1)
+    n_preview = min(max(int(budget // mean_size), 1), n_files)
+    return np.unique(np.linspace(0, n_files - 1, n_preview).round().astype(np.int64))
+
+
+# Container of concatenated raw buffer files (see pack_container)
+CONTAINER_MAGIC = b"HERMESRC"
+CONTAINER_INDEX_DTYPE = np.dtype([("NAME", "S64"), ("TIME", "<i8"), ("OFFSET", "<i8"), ("SIZE", "<i8")])
+
+
+def pack_container(files, file_times, outputfilename):
+    """
+    Concatenate raw buffer files, unchanged, into one container file:
+        8 bytes magic (CONTAINER_MAGIC)
+        the contents of the files, one after the other
+        index, one CONTAINER_INDEX_DTYPE element per file (name, timestamp, offset and size of the content)
+        index offset (8 bytes), number of files (8 bytes), magic
+    Input:
+        files, file_times = raw files and their timestamps, in time order (see list_raw_files)
+    Output:
+        index
+    Raises ValueError if a file name does not fit in the index (64 bytes)
+    """
+    names = [os.path.basename(filein).encode() for filein in files]
+    too_long = [name.decode() for name in names if len(name) > CONTAINER_INDEX_DTYPE["NAME"].itemsize]
+    if too_long:
+        raise ValueError("file names longer than {:d} bytes cannot be packed: {}".format(CONTAINER_INDEX_DTYPE["NAME"].itemsize,
+                                                                                      ", ".join(too_long)))
+    index = np.zeros(len(files), dtype=CONTAINER_INDEX_DTYPE)
+    with open(outputfilename, "wb") as out:
+        out.write(CONTAINER_MAGIC)
+        for i, (filein, file_time) in enumerate(zip(files, file_times)):
+            with open(filein, "rb") as f:
+                data = f.read()
+            index[i] = (names[i], file_time, out.tell(), len(data))
+            out.write(data)
+        index_offset = out.tell()
+        out.write(index.tobytes())
+        out.write(struct.pack("<QQ", index_offset, len(files)) + CONTAINER_MAGIC)
+    return index
+
+
+def is_container(filename):
+    """
+    True if filename is a container written by pack_container
+    """
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, "rb") as f:
+        return f.read(len(CONTAINER_MAGIC)) == CONTAINER_MAGIC
+
+
+class RawContainer(object):
+    """
+    Read access to a container written by pack_container.
+    The file is memory-mapped: listing the files only reads the index,
+    and read(name) gives the content of a file without any other system call.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        trailer = len(self.map) - 16 - len(CONTAINER_MAGIC)
+        if self.map[:len(CONTAINER_MAGIC)] != CONTAINER_MAGIC or self.map[trailer + 16:] != CONTAINER_MAGIC:
+            raise ValueError(filename + " is not a HERMES raw container")
+        index_offset, n_files = struct.unpack_from("<QQ", self.map, trailer)
+        self.index = np.frombuffer(self.map, dtype=CONTAINER_INDEX_DTYPE, count=n_files, offset=index_offset).copy()
+        # The files are named <container>/<name>
+        self.files = [os.path.join(filename, name.decode()) for name in self.index["NAME"]]
+        self.times = self.index["TIME"].tolist()
+        self.positions = dict((name, i) for i, name in enumerate(self.files))
+
+    def __len__(self):
+        return len(self.files)
+
+    def read(self, name):
+        """
+        Content of the file <container>/<name>
+        """
+        entry = self.index[self.positions[name]]
+        return self.map[entry["OFFSET"]:entry["OFFSET"] + entry["SIZE"]]
+
+    def size(self, name):
+        return int(self.index[self.positions[name]]["SIZE"])
+
+    def close(self):
+        self.map.close()
+
+
+# Tar archives, also compressed, read by RawArchive
+ARCHIVE_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.xz", ".txz", ".tar.bz2", ".tbz2")
+
+
+def is_archive(filename):
+    """
+    True if filename is a tar archive (see ARCHIVE_EXTENSIONS)
+    """
+    return os.path.isfile(filename) and filename.endswith(ARCHIVE_EXTENSIONS)
+
+
+class RawArchive(object):
+    """
+    Raw buffer files in a tar archive, read without extracting them.
+    The files are named <archive>/<member name> and ordered by the hex value of
+    their base name. Listing a compressed archive (getmembers) decompresses all of it,
+    and the conversion decompresses it a second time when a FilePrefetcher streams the
+    members: the listing cannot come from that stream, since the files are sorted (and
+    the shards and previews chosen) before the first one is decoded. A conversion with
+    a catalog (see query_catalog) does not open the RawArchive, and decompresses once.
+    read() seeks in the archive, which is cheap only going forward:
+    the files of a compressed archive are better streamed in order by a FilePrefetcher.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.tar = tarfile.open(filename, "r:*")
+        self.members = dict((os.path.join(filename, member.name), member) for member in self.tar.getmembers() if member.isfile())
+        self.files = sorted(self.members, key=raw_file_time)
+        self.times = [raw_file_time(f) for f in self.files]
+
+    def __len__(self):
+        return len(self.files)
+
+    def read(self, name):
+        """
+        Content of the file <archive>/<member name>
+        """
+        return self.tar.extractfile(self.members[name]).read()
+
+    def size(self, name):
+        return self.members[name].size
+
+    def close(self):
+        self.tar.close()
+
+
+# Containers and archives opened in this process (e.g. once by each pool worker)
+open_containers = {}
+
+
+def open_container(filename):
+    """
+    RawContainer (or RawArchive, for a tar archive) of filename, opened once per process
+    """
+    # A forked worker must not share the file position of the parent
+    key = (os.getpid(), filename)
+    if key not in open_containers:
+        open_containers[key] = RawArchive(filename) if is_archive(filename) else RawContainer(filename)
+    return open_containers[key]
+
+
+def write_hdulist(hdulist, outputfilename, checksum=True, compress=False, threads=None, writer=None):
+    """
+    Write an HDUList, tile-compressed if compress is True,
+    in the background if a FITSWriterPool is given
+    """
+    if writer is not None:
+        return writer.submit(write_hdulist, outputfilename, hdulist, outputfilename,
+                             checksum=checksum, compress=compress, threads=threads)
+    if compress:
+        writeFITS_compressed(hdulist, outputfilename, threads=threads)
+    else:
+        hdulist.writeto(outputfilename, overwrite=True, checksum=checksum)
+
+
+def writeFITS_HK(packets_readout, outputfilename, gps_ok=False, fm="FM2", obsdates=None, profiler=None, compress=False, threads=None, writer=None,
+                 shard=None, preview=None):
+    """
+    Write HERMES housekeepings FITS file
+    If shard is given (index of the first packet of a file range), a partial product
+    is written, to be merged with the other shards by merge_HK
+    If preview is given, the product is flagged as a preview (see set_preview_keywords)
+    """
+    print("\n*** WRITING HK FITS FILE ***\n")
+    profile_stage(profiler, "HK", "count")
+    
+    # Number of packets: one packet corresponds to one file
+    # However, one file can have more buffers!
+    n_packets = len(packets_readout)
+    print("Number of packets: ", n_packets)
+    
+    # Number of headers: 
+    # count total number of (header, event_data) tuples in each packet for each buffer
     # Number of time events: 
     # count total length of event_data summing over each (header, event_data) tuples in each packet
     n_buffers = 0
@@ -1931,13 +5025,14 @@ def writeFITS_HK(packets_readout, outputfilename, gps_ok=False, fm="FM2", obsdat
             assert len(buf) == 4
             for k,evlist in enumerate(buf):
                 a,b = evlist
-                n_time_events += len(b)
-                for event in b:
-                    n_total_events += len(event.pixelEvents)
+                n_events, n_entries = event_list_size(b)
+                n_time_events += n_events
+                n_total_events += n_entries
     print("Number of buffers:", n_buffers)    
     print("Number of headers:", n_headers)    
     print("Number of time events:", n_time_events)
     print("Number of total event entries:", n_total_events)
+    profile_stage(profiler, "HK", "collect")
         
     # Extension 1 is "PACKETS". 
     packetID            = np.zeros(n_buffers)
@@ -2034,13 +5129,30 @@ def writeFITS_HK(packets_readout, outputfilename, gps_ok=False, fm="FM2", obsdat
                                     
             kp += 1
             
+    return writeFITS_HK_columns(outputfilename, packetID, bufferID, gps_offset, utc_offset, week_sec, week_num, obt_s,
+                                quad_status, trigger_counter, rejected_counter, event_counter, overflow_counter,
+                                plvolt, plcurr, plvolt_phys, plcurr_phys, fee_temp_phys, bee_temp_phys, csac_info_phys,
+                                gps_ok=gps_ok, fm=fm, obsdates=obsdates, profiler=profiler,
+                                compress=compress, threads=threads, writer=writer, shard=shard, preview=preview)
 
+
+def writeFITS_HK_columns(outputfilename, packetID, bufferID, gps_offset, utc_offset, week_sec, week_num, obt_s,
+                         quad_status, trigger_counter, rejected_counter, event_counter, overflow_counter,
+                         plvolt, plcurr, plvolt_phys, plcurr_phys, fee_temp_phys, bee_temp_phys, csac_info_phys,
+                         gps_ok=False, fm="FM2", obsdates=None, profiler=None, compress=False, threads=None, writer=None,
+                         shard=None, preview=None):
+    """
+    Write HERMES housekeepings FITS file from the per-buffer HK arrays
+    (as filled by writeFITS_HK or writeFITS_HK_scan)
+    """
+    n_buffers = len(packetID)
     
-    
+    profile_stage(profiler, "HK", "hdu")
     # Extensions
     sel_single_pkt = range(n_buffers)
     
     # Zero-align times
+    obt_raw = obt_s
     obt_s = obt_s[sel_single_pkt]-obt_s[0]
     
     if gps_ok:
@@ -2055,6 +5167,20 @@ def writeFITS_HK(packets_readout, outputfilename, gps_ok=False, fm="FM2", obsdat
     else:
         met_offset = 0
         
+    if shard is not None:
+        # Raw OBT of each buffer and time reference, to align the times of the shards (see merge_HK)
+        shardhdu = pyfits.BinTableHDU.from_columns([
+                                                  pyfits.Column(name='OBTSEC',
+                                                                format='1D',
+                                                                array=obt_raw)
+                                                ])
+        shardhdu.header.set('EXTNAME', 'SHARD',  'Name of this binary table extension')
+        shardhdu.header.set('FIRSTPKT', shard,  'First packet (file) of the shard')
+        shardhdu.header.set('METOFFS', met_offset,  '[s] MET offset of the first buffer of the shard')
+        packet_offset = shard
+    else:
+        packet_offset = 0
+    
     # Add to the time
     obt_s += met_offset
     
@@ -2065,7 +5191,7 @@ def writeFITS_HK(packets_readout, outputfilename, gps_ok=False, fm="FM2", obsdat
                                                             array=obt_s[sel_single_pkt]),        
                                               pyfits.Column(name='PACKETID',
                                                             format='1J',
-                                                            array=packetID[sel_single_pkt]),
+                                                            array=packetID[sel_single_pkt] + packet_offset),
                                               pyfits.Column(name='BUFFERID',
                                                             format='1J',
                                                             array=bufferID[sel_single_pkt]),
@@ -2140,6 +5266,8 @@ def writeFITS_HK(packets_readout, outputfilename, gps_ok=False, fm="FM2", obsdat
     prhdu.header.set('EXPOSURE', exposure,  'Exposure time')
     prhdu.header.set('DATE-OBS', start_date.fits,  'Start date of observations')
     prhdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
+    if preview is not None:
+        set_preview_keywords(prhdu.header, preview)
     
     
     t1hdu.header.set('EXTNAME', 'HK',  'Name of this binary table extension')
@@ -2160,4 +5288,703 @@ def writeFITS_HK(packets_readout, outputfilename, gps_ok=False, fm="FM2", obsdat
     t1hdu.header.set('DATE-END', stop_date.fits,  'End date of observations')
     
     hdulist = pyfits.HDUList([prhdu, t1hdu])
-    hdulist.writeto(outputfilename, overwrite=True, checksum=True)
+    if shard is not None:
+        hdulist.append(shardhdu)
+    profile_stage(profiler, "HK", "write")
+    write_hdulist(hdulist, outputfilename, checksum=True, compress=compress, threads=threads, writer=writer)
+    profile_stage(profiler, "HK")
+
+
+def scan_header_file(filein, aggregated=False, tolerant=False, skipped=None, data=None):
+    """
+    Header-only scan of a PDHU buffer file.
+    Reads each 128 bytes header and uses the four record counters
+    to seek past the record lists, without touching the event data.
+    Input: 
+        filein = name of the binary buffer file (decompressed if .gz, .xz or .bz2)
+        tolerant, skipped = skip corrupted buffers (see ingest_buffer)
+        data = content of the file, if already read (e.g. by FilePrefetcher)
+    Output:
+        numpy structured array (HEADER_DTYPE), one element for each buffer in the file
+    """
+    header_size = 128
+    aggHeader_size = 25
+    
+    if data is None and os.path.splitext(filein)[1] in COMPRESSED_OPENERS:
+        data = read_raw_file(filein)
+    filesize = os.path.getsize(filein) if data is None else len(data)
+    headers = bytearray()
+    
+    if tolerant:
+        # Same as below, checking each header and resynchronizing
+        if skipped is None:
+            skipped = []
+        if data is None:
+            with open(filein, "rb") as f:
+                data = f.read()
+        prefix = aggHeader_size if aggregated else 0
+        position = 0
+        obt_reference = None
+        while position < len(data):
+            if position == 0 and len(data) <= header_size:
+                skip_bytes(skipped, filein, 0, len(data), "file smaller than a header")
+                break
+            if not plausible_header(data, position, obt_reference, prefix, check_next=False):
+                resync = find_next_header(data, position + 1, obt_reference, prefix)
+                if resync is None:
+                    skip_bytes(skipped, filein, position, len(data), "no plausible header until the end of file")
+                    break
+                skip_bytes(skipped, filein, position, resync, "implausible header, resynchronized")
+                position = resync
+            header_bytes = data[position + prefix:position + prefix + header_size]
+            headers += header_bytes
+            obt_reference = struct.unpack_from('I', header_bytes, 24)[0]
+            position += prefix + header_size + 4*sum(struct.unpack_from('4I', header_bytes, 111))
+        return np.frombuffer(bytes(headers), dtype=HEADER_DTYPE)
+    
+    with (open(filein, "rb") if data is None else io.BytesIO(data)) as f:
+        position = 0
+        while position + header_size + (aggHeader_size if aggregated else 0) <= filesize:
+            if aggregated:
+                position += aggHeader_size
+                f.seek(position)
+            header_bytes = f.read(header_size)
+            headers += header_bytes
+            counters = struct.unpack('4I', header_bytes[111:127])
+            position += header_size + 4*sum(counters)
+            f.seek(position)
+            
+    return np.frombuffer(bytes(headers), dtype=HEADER_DTYPE)
+
+
+# Raw file catalog (see update_catalog): one row per raw file,
+# record counts summed over the buffers of the file
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path        TEXT PRIMARY KEY,
+    source      TEXT NOT NULL,
+    unit        TEXT,
+    time        INTEGER NOT NULL,
+    size        INTEGER NOT NULL,
+    mtime       REAL NOT NULL,
+    nbuffers    INTEGER NOT NULL,
+    reccnt0     INTEGER NOT NULL,
+    reccnt1     INTEGER NOT NULL,
+    reccnt2     INTEGER NOT NULL,
+    reccnt3     INTEGER NOT NULL,
+    abtmin      INTEGER,
+    abtmax      INTEGER,
+    gpsmin      INTEGER,
+    gpsmax      INTEGER,
+    skipped     INTEGER NOT NULL,
+    sha256      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_source_time ON files (source, time);
+CREATE INDEX IF NOT EXISTS files_unit_time ON files (unit, time);
+"""
+
+
+def open_catalog(filename):
+    """
+    Open (or create) the SQLite raw file catalog
+    """
+    catalog = sqlite3.connect(filename)
+    catalog.executescript(CATALOG_SCHEMA)
+    return catalog
+
+
+def catalog_entry(filein, data, aggregated=False):
+    """
+    Catalog columns of a raw file, from a header-only scan of its content
+    (corrupted buffers are skipped as in tolerant mode, and their bytes counted)
+    Output:
+        dict of the columns from nbuffers to sha256
+    """
+    skipped = []
+    headers = scan_header_file(filein, aggregated=aggregated, tolerant=True, skipped=skipped, data=data)
+    counters = headers["recordCounters"].sum(axis=0) if len(headers) > 0 else np.zeros(4, dtype=np.int64)
+    entry = {"nbuffers": len(headers),
+             "skipped": sum(stop - start for name, start, stop, reason in skipped),
+             "sha256": hashlib.sha256(data).hexdigest()}
+    for k in range(4):
+        entry["reccnt{:d}".format(k)] = int(counters[k])
+    for column, field in [("abt", "ABT_OBT"), ("gps", "GPSStatus")]:
+        entry[column + "min"] = int(headers[field].min()) if len(headers) > 0 else None
+        entry[column + "max"] = int(headers[field].max()) if len(headers) > 0 else None
+    return entry
+
+
+def update_catalog(catalog, source, unit=None, aggregated=False):
+    """
+    Add the raw files of source (directory, container or tar archive) to the catalog.
+    Incremental: the files with the same size, modification time and unit are not scanned again,
+    and the rows of the files no longer in source are removed.
+    The paths are absolute, the files of a container or archive are named <source>/<name>
+    Output:
+        number of files scanned, number of files unchanged
+    """
+    source = os.path.abspath(source.rstrip(os.sep))
+    known = dict((path, (size, mtime, file_unit)) for path, size, mtime, file_unit in
+                 catalog.execute("SELECT path, size, mtime, unit FROM files WHERE source = ?", (source,)))
+    if is_container(source) or is_archive(source):
+        container = open_container(source)
+        files, file_times = container.files, container.times
+        mtime = os.path.getmtime(source)
+        # Members are read in order from the archive stream
+        items = FilePrefetcher(files, archive=source) if is_archive(source) else None
+        def stat(filein):
+            return (container.members[filein].size if is_archive(source) else int(container.index[container.positions[filein]]["SIZE"])), mtime
+    else:
+        files, file_times = list_raw_files(source)
+        items = None
+        def stat(filein):
+            return os.path.getsize(filein), os.path.getmtime(filein)
+    
+    scanned = 0
+    unchanged = 0
+    rows = []
+    contents = iter(items) if items is not None else None
+    for filein, file_time in zip(files, file_times):
+        size, file_mtime = stat(filein)
+        data = next(contents)[1] if contents is not None else None
+        if known.pop(filein, None) == (size, file_mtime, unit):
+            unchanged += 1
+            continue
+        if data is None:
+            data = container.read(filein) if is_container(source) else read_raw_file(filein)
+        entry = catalog_entry(filein, data, aggregated=aggregated)
+        entry.update(path=filein, source=source, unit=unit, time=file_time, size=size, mtime=file_mtime)
+        rows.append(entry)
+        scanned += 1
+    if items is not None:
+        items.close()
+    
+    columns = ["path", "source", "unit", "time", "size", "mtime", "nbuffers", "reccnt0", "reccnt1", "reccnt2", "reccnt3",
+               "abtmin", "abtmax", "gpsmin", "gpsmax", "skipped", "sha256"]
+    with catalog:
+        catalog.executemany("INSERT OR REPLACE INTO files (" + ", ".join(columns) + ") VALUES (" + ", ".join("?"*len(columns)) + ")",
+                            [[row[column] for column in columns] for row in rows])
+        catalog.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+    return scanned, unchanged
+
+
+def query_catalog(catalog, source=None, unit=None, start=None, stop=None, gps_status=None, clean=False):
+    """
+    Select raw files from the catalog (indexed query, no filesystem access)
+    Input:
+        source = directory, container or archive (see update_catalog)
+        unit = unit given to update_catalog
+        start, stop = range of the file timestamps (UNIX time, stop excluded)
+        gps_status = keep only the files whose buffers all have this GPS status
+        clean = keep only the files without skipped (corrupted) bytes
+    Output:
+        list of file paths, list of UNIX timestamps, in time order
+    """
+    conditions = []
+    values = []
+    if source is not None:
+        conditions.append("source = ?")
+        values.append(os.path.abspath(source.rstrip(os.sep)))
+    if unit is not None:
+        conditions.append("unit = ?")
+        values.append(unit)
+    if start is not None:
+        conditions.append("time >= ?")
+        values.append(start)
+    if stop is not None:
+        conditions.append("time < ?")
+        values.append(stop)
+    if gps_status is not None:
+        conditions.append("gpsmin = ? AND gpsmax = ?")
+        values += [gps_status, gps_status]
+    if clean:
+        conditions.append("skipped = 0")
+    query = "SELECT path, time FROM files" + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY time, path"
+    rows = catalog.execute(query, values).fetchall()
+    return [path for path, time in rows], [time for path, time in rows]
+
+
+def writeFITS_HK_scan(header_tables, outputfilename, gps_ok=False, fm="FM2", obsdates=None, profiler=None, compress=False, threads=None, writer=None,
+                      shard=None, preview=None):
+    """
+    Write HERMES housekeepings FITS file from header scans.
+    Same content as writeFITS_HK, with the columns computed as array operations.
+    Input:
+        header_tables = list of arrays returned by scan_header_file, one per packet (file)
+        shard = index of the first packet, for a partial product (see writeFITS_HK)
+        preview = (indices of the files decoded, files of the acquisition), see set_preview_keywords
+    """
+    print("\n*** WRITING HK FITS FILE (HEADER SCAN) ***\n")
+    profile_stage(profiler, "HK", "collect")
+    
+    n_packets = len(header_tables)
+    print("Number of packets: ", n_packets)
+    
+    n_per_packet = np.array([len(x) for x in header_tables], dtype=int)
+    headers = np.concatenate(header_tables) if n_packets > 0 else np.zeros(0, dtype=HEADER_DTYPE)
+    n_buffers = len(headers)
+    print("Number of buffers:", n_buffers)
+    
+    # Packet ID and buffer ID within the packet
+    packetID = np.repeat(np.arange(n_packets), n_per_packet).astype(float)
+    bufferID = (np.arange(n_buffers) - np.repeat(np.cumsum(n_per_packet) - n_per_packet, n_per_packet)).astype(float)
+    
+    # Integer conversions as done in Header
+    gps_offset  = np.trunc(headers["GPSOffset"]).astype(np.int64).astype(float)
+    utc_offset  = np.trunc(headers["UTCOffset"]).astype(np.int64)
+    week_sec    = np.trunc(headers["WeekSeconds"].astype(float)).astype(np.int64).astype(float)
+    week_num    = headers["Week"].astype(float)
+    obt_s       = headers["ABT_OBT"].astype(float)
+    
+    quad_status      = np.unpackbits(headers["QuadrantStatus"], axis=1).astype(float)
+    trigger_counter  = headers["TriggerCounter"].astype(float)
+    rejected_counter = headers["RejectedCounter"].astype(float)
+    event_counter    = headers["EventCounter"].astype(float)
+    overflow_counter = headers["OverflowCounter"].astype(float)
+    
+    BEE_HK = {}
+    for n, name in enumerate(HK_RAW_FIELDS):
+        BEE_HK[name + "_raw"] = headers["HK_raw"][:, n].astype(int)
+    convert_HK(BEE_HK)
+    
+    plvolt_names = ["3V3D", "3V3A", "3V3-BEE", "2V0", "5V0-FEE", "HV", "12V0", "5V0-BEE"]
+    plcurr_names = ["3V3D_I", "3V3A_I", "3V3-BEE_I", "2V0_I", "5V0-FEE_I", "12V0_I", "5V0-BEE_I"]
+    plvolt      = np.stack([BEE_HK[x + "_raw"] for x in plvolt_names], axis=-1).astype(float).reshape(n_buffers, 8)
+    plcurr      = np.stack([BEE_HK[x + "_raw"] for x in plcurr_names], axis=-1).astype(float).reshape(n_buffers, 7)
+    plvolt_phys = np.stack([BEE_HK[x] for x in plvolt_names], axis=-1).astype(float).reshape(n_buffers, 8)
+    plcurr_phys = np.stack([BEE_HK[x] for x in plcurr_names], axis=-1).astype(float).reshape(n_buffers, 7)
+    
+    det_temp       = headers["Det_Temp"]/10.
+    fee_temp_phys  = det_temp[:, 1:7]
+    bee_temp_phys  = det_temp[:, 0]
+    csac_info_phys = np.stack([headers["CSACStatus"].astype(float),
+                               headers["LaserI"] * 0.01,
+                               headers["HeatP"] * 0.01,
+                               headers["Temp"] * 0.01], axis=-1).reshape(n_buffers, 4)
+    
+    return writeFITS_HK_columns(outputfilename, packetID, bufferID, gps_offset, utc_offset, week_sec, week_num, obt_s,
+                                quad_status, trigger_counter, rejected_counter, event_counter, overflow_counter,
+                                plvolt, plcurr, plvolt_phys, plcurr_phys, fee_temp_phys, bee_temp_phys, csac_info_phys,
+                                gps_ok=gps_ok, fm=fm, obsdates=obsdates, profiler=profiler,
+                                compress=compress, threads=threads, writer=writer, shard=shard, preview=preview)
+
+
+def make_shard_hdus(first_packet, packets_readout, met_offset, file_times, time_mark, quadid, evtype, origin,
+                    obts, obtns, in_table, current_s, current_ns, current_origin, previous_s, previous_ns, previous_origin,
+                    gti_max_gap=None):
+    """
+    Extensions with the boundary state of a shard (partial product of a range of files)
+    Input:
+        first_packet = index of the first packet (file) of the shard in the whole acquisition
+        met_offset = time offset of the shard (MET from its first header)
+        time_mark, quadid, evtype = time mark, quadrant and type of all the events (ABT rows included)
+        origin, obts, obtns = ABT value of each event, and where it came from:
+                              0 = ABT record, 1 (2) = ABT (previous ABT) at the start of the shard
+        in_table = events written in the EVENTS table
+        current_*, previous_* = ABT state of each quadrant at the end of the shard
+        gti_max_gap = GTI parameter of the LV0 (see compute_GTI)
+    Output:
+        SHARD (one row per packet), SHARDQUAD (one row per quadrant) and SHARDEVT (one row per event) HDUs
+    """
+    n_packets = len(packets_readout)
+    header = packets_readout[0][0][0][0]
+    
+    columns = [pyfits.Column(name='PACKETID',
+                             format='1J',
+                             array=first_packet + np.arange(n_packets)),
+               pyfits.Column(name='NBUFFERS',
+                             format='1J',
+                             array=np.array([len(packet) for packet in packets_readout]))]
+    if file_times is not None:
+        columns.append(pyfits.Column(name='FILETIME',
+                                     format='1K',
+                                     array=np.asarray(file_times, dtype=np.int64)))
+    shardhdu = pyfits.BinTableHDU.from_columns(columns)
+    shardhdu.header.set('EXTNAME', 'SHARD',  'Name of this binary table extension')
+    shardhdu.header.set('FIRSTPKT', first_packet,  'First packet (file) of the shard')
+    shardhdu.header.set('NPACKETS', n_packets,  'Number of packets (files) in the shard')
+    shardhdu.header.set('METOFFS', met_offset,  '[s] MET offset of the first buffer of the shard')
+    shardhdu.header.set('INITOBTS', header.BEE_HK["ABT_OBT"],  'ABT seconds of the first header')
+    shardhdu.header.set('INITNSEC', 9999999 - header.BEE_HK["ABT_CNT"],  'ABT 100 ns offset of the first header')
+    if gti_max_gap is not None:
+        shardhdu.header.set('GTIMAXGP', gti_max_gap,  '[s] Maximum time gap within a GTI')
+    
+    quadhdu = pyfits.BinTableHDU.from_columns([
+                                              pyfits.Column(name='QUADID',
+                                                            format='1B',
+                                                            array=np.arange(4)),
+                                              pyfits.Column(name='CUROBTS',
+                                                            format='1D',
+                                                            array=current_s),
+                                              pyfits.Column(name='CURNSEC',
+                                                            format='1D',
+                                                            array=current_ns),
+                                              pyfits.Column(name='CURORIG',
+                                                            format='1B',
+                                                            array=current_origin),
+                                              pyfits.Column(name='PRVOBTS',
+                                                            format='1D',
+                                                            array=previous_s),
+                                              pyfits.Column(name='PRVNSEC',
+                                                            format='1D',
+                                                            array=previous_ns),
+                                              pyfits.Column(name='PRVORIG',
+                                                            format='1B',
+                                                            array=previous_origin)
+                                            ])
+    quadhdu.header.set('EXTNAME', 'SHARDQUAD',  'Name of this binary table extension')
+    
+    # Row of each event in the EVENTS table, -1 if not written
+    in_table = np.asarray(in_table, dtype=bool)
+    table_row = np.where(in_table, np.cumsum(in_table) - 1, -1)
+    evthdu = pyfits.BinTableHDU.from_columns([
+                                              pyfits.Column(name='TIMEMARK',
+                                                            format='1K',
+                                                            array=np.asarray(time_mark, dtype=np.int64)),
+                                              pyfits.Column(name='QUADID',
+                                                            format='1B',
+                                                            array=np.asarray(quadid)),
+                                              pyfits.Column(name='EVTTYPE',
+                                                            format='1B',
+                                                            array=np.asarray(evtype)),
+                                              pyfits.Column(name='ORIGIN',
+                                                            format='1B',
+                                                            array=np.asarray(origin)),
+                                              pyfits.Column(name='OBTSEC',
+                                                            format='1D',
+                                                            array=np.asarray(obts)),
+                                              pyfits.Column(name='OBTNSEC',
+                                                            format='1D',
+                                                            array=np.asarray(obtns)),
+                                              pyfits.Column(name='TABLEROW',
+                                                            format='1K',
+                                                            array=table_row)
+                                            ])
+    evthdu.header.set('EXTNAME', 'SHARDEVT',  'Name of this binary table extension')
+    return [shardhdu, quadhdu, evthdu]
+
+
+def open_shards(shard_files):
+    """
+    Open the partial products of the shards, ordered by their first packet,
+    and check that they cover a contiguous range of packets
+    """
+    shards = sorted([pyfits.open(filename) for filename in shard_files], key=lambda x: x['SHARD'].header['FIRSTPKT'])
+    for previous, shard in zip(shards[:-1], shards[1:]):
+        expected = previous['SHARD'].header['FIRSTPKT'] + previous['SHARD'].header.get('NPACKETS', 0)
+        if 'NPACKETS' in previous['SHARD'].header and shard['SHARD'].header['FIRSTPKT'] != expected:
+            raise ValueError("Shards are not contiguous: {:s} starts at packet {:d}, expected {:d}".format(
+                             shard.filename(), shard['SHARD'].header['FIRSTPKT'], expected))
+    return shards
+
+
+def resolve_shard_events(shards):
+    """
+    Replace the ABT values that each shard inherited from its own first header
+    with the ABT state at the end of the previous shards, as in a single run
+    Output:
+        list of SHARDEVT arrays (time mark, quadrant, type, ABT seconds, ABT offset, EVENTS row) of each shard
+    """
+    first = shards[0]['SHARD'].header
+    current_s   = np.full(4, first['INITOBTS'], dtype=float)
+    current_ns  = np.full(4, first['INITNSEC'], dtype=float)
+    previous_s  = current_s.copy()
+    previous_ns = current_ns.copy()
+    
+    resolved = []
+    for shard in shards:
+        data = shard['SHARDEVT'].data
+        quadid = data['QUADID'].astype(np.int64)
+        origin = data['ORIGIN']
+        obts   = data['OBTSEC'].copy()
+        obtns  = data['OBTNSEC'].copy()
+        for value, (state_s, state_ns) in [(1, (current_s, current_ns)), (2, (previous_s, previous_ns))]:
+            rows = origin == value
+            obts[rows]  = state_s[quadid[rows]]
+            obtns[rows] = state_ns[quadid[rows]]
+        resolved.append((data['TIMEMARK'], quadid, data['EVTTYPE'], obts, obtns, data['TABLEROW']))
+        
+        # State at the end of the shard
+        quad = shard['SHARDQUAD'].data
+        states = []
+        for s, ns, orig in [('CUROBTS', 'CURNSEC', 'CURORIG'), ('PRVOBTS', 'PRVNSEC', 'PRVORIG')]:
+            states.append(np.select([quad[orig] == 1, quad[orig] == 2], [current_s, previous_s], quad[s]))
+            states.append(np.select([quad[orig] == 1, quad[orig] == 2], [current_ns, previous_ns], quad[ns]))
+        current_s, current_ns, previous_s, previous_ns = states
+    return resolved
+
+
+def merge_shard_hdu(template, columns, cards=()):
+    """
+    Rebuild a binary table extension with the merged columns and the keywords of a shard
+    Input:
+        template = HDU of a shard
+        columns = dict name -> merged array, in the order of the template columns
+        cards = (keyword, value) to update
+    """
+    hdu = pyfits.BinTableHDU.from_columns([pyfits.Column(name=column.name,
+                                                         format=column.format,
+                                                         unit=column.unit,
+                                                         array=columns[column.name])
+                                           for column in template.columns])
+    for card in template.header.cards:
+        if card.keyword not in hdu.header and card.keyword not in ['CHECKSUM', 'DATASUM']:
+            hdu.header.set(card.keyword, card.value, card.comment)
+    for keyword, value in cards:
+        if keyword in hdu.header:
+            hdu.header[keyword] = value
+    return hdu
+
+
+def merge_primary_hdu(template, cards=()):
+    """
+    Primary HDU with the keywords of a shard
+    """
+    prhdu = pyfits.PrimaryHDU()
+    for card in template.header.cards:
+        if card.keyword not in prhdu.header and card.keyword not in ['CHECKSUM', 'DATASUM']:
+            prhdu.header.set(card.keyword, card.value, card.comment)
+    for keyword, value in cards:
+        if keyword in prhdu.header:
+            prhdu.header[keyword] = value
+    return prhdu
+
+
+def concatenate_shard_columns(shards, extname, rows=None):
+    """
+    Concatenate the columns of an extension of the shards
+    Input:
+        rows = optional list with the row order of each shard
+    Output:
+        dict name -> array
+    """
+    hdus = [shard[extname] for shard in shards if extname in shard]
+    columns = collections.OrderedDict()
+    for column in hdus[0].columns:
+        arrays = []
+        for n, hdu in enumerate(hdus):
+            array = hdu.data[column.name]
+            if rows is not None:
+                array = array[rows[n]]
+            if column.format.startswith(('1P', '1Q', 'P', 'Q')):
+                array = list(array)
+            arrays.append(array)
+        if isinstance(arrays[0], list):
+            columns[column.name] = np.array(list(itertools.chain.from_iterable(arrays)) + [None], dtype=object)[:-1]
+        else:
+            columns[column.name] = np.concatenate(arrays)
+    return columns
+
+
+def stored_vla_rows(hdu, name, dtype):
+    """
+    Values of a variable-length array column as stored in the heap (without TZERO scaling),
+    one array per row; the HDU data are not modified
+    """
+    descriptors = hdu.data.view(np.ndarray)[name]
+    heap = hdu.data._get_heap_data()
+    itemsize = np.dtype(dtype).itemsize
+    return [heap[offset:offset + count*itemsize].view(dtype) for count, offset in descriptors.reshape(-1, 2)]
+
+
+def shard_times(time_mark, evtype, obts, obtns, met_offset):
+    """
+    Event times of the merged event list (ABT rows included), as computed by the LV0 writers,
+    and their offset (met_offset - time_zero, see buffer_start_times)
+    """
+    events_time = (time_mark - obtns)*1e-7 + obts
+    events_time[evtype == 0] += 1
+    time_zero = np.floor(events_time[0])
+    events_time = events_time - time_zero
+    events_time += met_offset
+    return events_time, met_offset - time_zero
+
+
+def time_cards(tstart, tstop, ontime=None):
+    """
+    Time keywords of the merged products
+    """
+    mjdref = 59580+0.00080074074
+    start_date = Time(mjdref + tstart/86400., format='mjd')
+    stop_date  = Time(mjdref + tstop/86400.,  format='mjd')
+    cards = [('TSTART', tstart), ('TSTOP', tstop), ('TELAPSE', tstop - tstart),
+             ('DATE-OBS', start_date.fits), ('DATE-END', stop_date.fits)]
+    if ontime is not None:
+        cards += [('ONTIME', ontime), ('EXPOSURE', ontime)]
+    return cards
+
+
+def merge_LV0d5(shard_files, outputfilename, compress=False, threads=None, writer=None):
+    """
+    Merge the LV0.5 partial products written with writeFITS_LV0d5(..., shard=first_packet)
+    into the file a single run on all the packets would write
+    """
+    shards = open_shards(shard_files)
+    resolved = resolve_shard_events(shards)
+    time_mark, quadid, evtype, obts, obtns, table_row = [np.concatenate(x) for x in zip(*resolved)]
+    events_time, time_offset = shard_times(time_mark, evtype, obts, obtns, shards[0]['SHARD'].header['METOFFS'])
+    in_table = table_row >= 0
+    
+    events = concatenate_shard_columns(shards, 'EVENTS')
+    events['OBTSEC'] = obts[in_table]
+    events['OBTERR'] = obtns[in_table]
+    events['TIME']   = events_time[in_table]
+    
+    hdulist = pyfits.HDUList([merge_primary_hdu(shards[0][0])])
+    if 'PACKETS' in shards[0]:
+        hdulist.append(merge_shard_hdu(shards[0]['PACKETS'], concatenate_shard_columns(shards, 'PACKETS')))
+    hdulist.append(merge_shard_hdu(shards[0]['EVENTS'], events))
+    print("Merged", len(shards), "LV0.5 shards")
+    write_hdulist(hdulist, outputfilename, checksum=False, compress=compress, threads=threads, writer=writer)
+    for shard in shards:
+        shard.close()
+
+
+def merge_LV0(shard_files, outputfilename, compress=False, threads=None, writer=None):
+    """
+    Merge the LV0 partial products written with writeFITS_LV0(..., shard=first_packet)
+    into the file a single run on all the packets would write
+    (times, GTIs and DQ flags are recomputed on the whole event list)
+    Output:
+        tstart, tstop (for the HK merge)
+    """
+    shards = open_shards(shard_files)
+    if 'PACKETS' not in shards[0]:
+        raise ValueError("LV0 shards without the PACKETS extension cannot be merged")
+    resolved = resolve_shard_events(shards)
+
+
+    # EVENTS rows back in event list order, to find the row of each event
+    table_order = [table_row[table_row >= 0] for time_mark, quadid, evtype, obts, obtns, table_row in resolved]
+    time_mark, quadid, evtype, obts, obtns, table_row = [np.concatenate(x) for x in zip(*resolved)]
+    events_time, time_offset = shard_times(time_mark, evtype, obts, obtns, shards[0]['SHARD'].header['METOFFS'])
+    in_table = table_row >= 0
+    
+    events = concatenate_shard_columns(shards, 'EVENTS', rows=table_order)
+    # PHA as stored in the shards (ADC - 32768, see writeFITS_LV0): astropy applies
+    # TZERO12 to the first row of the heap only when reading, so the scaled values
+    # cannot be written back as they are
+    pha = [np.array(stored_vla_rows(shard['EVENTS'], 'PHA', '>i2') + [None], dtype=object)[:-1][rows]
+           for shard, rows in zip(shards, table_order)]
+    events['PHA'] = np.concatenate(pha)
+    events['OBTSEC']  = obts[in_table]
+    events['OBTNSEC'] = obtns[in_table]
+    events['TIME']    = events_time[in_table]
+    
+    table_evtype = events['EVTTYPE']
+    tstart = np.min(events['TIME'][table_evtype > 0])
+    tstop  = np.max(events['TIME'][table_evtype > 0])
+    
+    # Rows of the EVENTS table
+    events_rows = np.arange(len(table_evtype))
+    time_sorted = 'TSORTKEY' in shards[0]['EVENTS'].header
+    if time_sorted:
+        # ABT rows right after their event (see writeFITS_LV0)
+        sort_key = events_time.copy()
+        abt_rows = np.nonzero(evtype == 0)[0]
+        sort_key[abt_rows] = sort_key[abt_rows - 1]
+        events_rows = np.argsort(sort_key[in_table], kind="stable")
+        del sort_key
+    
+    print("TSTART", tstart, "skipping ABT events")
+    print("TSTOP", tstop,  "skipping ABT events")
+    
+    # Good Time Intervals on the whole buffer sequence
+    packets = concatenate_shard_columns(shards, 'PACKETS')
+    shard_packets = concatenate_shard_columns(shards, 'SHARD')
+    n_buffers = len(packets['PACKETID'])
+    buffers_per_packet = shard_packets['NBUFFERS'].astype(np.int64)
+    buffer_packet = np.repeat(np.arange(len(buffers_per_packet)), buffers_per_packet)
+    events_buffer = (np.cumsum(buffers_per_packet) - buffers_per_packet)[events['PACKETID'].astype(np.int64)] \
+                    + events['BUFFERID'].astype(np.int64)
+    photons = np.logical_and(table_evtype > 0, events['NMULT'] > 0)
+    record_counters = np.stack([packets['RECCNT{:d}'.format(n)] for n in range(4)], axis=1)
+    gti_max_gap = shards[0]['SHARD'].header.get('GTIMAXGP')
+    gti_start, gti_stop, quadgti_start, quadgti_stop, quadgti_id = \
+        compute_GTI(events_buffer[photons], events['QUADID'].astype(np.int64)[photons], events['TIME'][photons], n_buffers,
+                    record_counters=record_counters, buffer_obt=packets['OBTSEC'].astype(float), buffer_packet=buffer_packet,
+                    file_times=shard_packets.get('FILETIME'), max_gap=gti_max_gap,
+                    buffer_start=buffer_start_times(packets['OBTSEC'], packets['OBTNSEC'], time_offset),
+                    quad_flags=packets['DQQUAD'])
+    ontime = np.sum(gti_stop - gti_start)
+    
+    # The OBT reset check is the only DQ check across buffers
+    obt_reset = np.zeros(n_buffers, dtype=packets['DQFLAGS'].dtype)
+    obt_reset[1:] = np.diff(packets['OBTSEC'].astype(np.int64)) < 0
+    packets['DQFLAGS'] = (packets['DQFLAGS'] & ~(1 << 3)) | (obt_reset << 3)
+    dq_nbuffers = np.array([np.count_nonzero(packets['DQFLAGS'] & (1 << n)) for n in range(len(DQ_FLAGS))])
+    dq_nquad    = np.array([np.count_nonzero(packets['DQQUAD'] & (1 << n)) for n in range(len(DQ_FLAGS))])
+    for n, (name, description) in enumerate(DQ_FLAGS):
+        if dq_nbuffers[n] > 0:
+            logger.warning("DQ %s: %s in %d of %d buffers", name, description, dq_nbuffers[n], n_buffers)
+    
+    cards = time_cards(tstart, tstop, ontime)
+    dqsummary = shards[0]['DQSUMMARY']
+    dqcards = [('NBUFFERS', n_buffers),
+               ('NBADBUF', int(np.count_nonzero(packets['DQFLAGS']))),
+               ('DQPARSED', all(shard['DQSUMMARY'].header['DQPARSED'] for shard in shards))]
+    dqcolumns = collections.OrderedDict((name, dqsummary.data[name]) for name in dqsummary.columns.names)
+    dqcolumns['NBUFFERS'] = dq_nbuffers
+    dqcolumns['NQUADBUF'] = dq_nquad
+    dqcolumns['FRACTION'] = dq_nbuffers/max(n_buffers, 1)
+    
+    hdulist = pyfits.HDUList([merge_primary_hdu(shards[0][0], cards),
+                              merge_shard_hdu(shards[0]['PACKETS'], packets, cards),
+                              merge_shard_hdu(shards[0]['EVENTS'], collections.OrderedDict(
+                                              (name, array[events_rows]) for name, array in events.items()), cards),
+                              merge_shard_hdu(shards[0]['GTI'], {'START': gti_start, 'STOP': gti_stop}, cards)])
+    rejected = [shard for shard in shards if 'REJECTED' in shard]
+    if rejected:
+        hdulist.append(merge_shard_hdu(rejected[0]['REJECTED'], concatenate_shard_columns(rejected, 'REJECTED'), cards))
+    hdulist.append(merge_shard_hdu(shards[0]['QUADGTI'], {'START': quadgti_start, 'STOP': quadgti_stop, 'QUADID': quadgti_id}, cards))
+    hdulist.append(merge_shard_hdu(dqsummary, dqcolumns, dqcards))
+    skipped = [shard for shard in shards if 'SKIPPED' in shard]
+    if skipped:
+        columns = concatenate_shard_columns(skipped, 'SKIPPED')
+        hdulist.append(skipped_hdu(list(zip(columns['FILENAME'], columns['START'], columns['STOP'], columns['REASON'])),
+                                   fm=shards[0][0].header['INSTRUME']))
+    
+    mjdref = 59580+0.00080074074
+    start_date = Time(mjdref + tstart/86400., format='mjd')
+    stop_date  = Time(mjdref + tstop/86400.,  format='mjd')
+    print()
+    print("Merged", len(shards), "LV0 shards")
+    print("Observation start:\t", start_date.iso)
+    print("Observation stop:\t", stop_date.iso)
+    print("Ontime:\t\t\t", ontime, "s in", len(gti_start), "GTIs")
+    write_hdulist(hdulist, outputfilename, checksum=True, compress=compress, threads=threads, writer=writer)
+    for shard in shards:
+        shard.close()
+    return tstart, tstop
+
+
+def merge_HK(shard_files, outputfilename, obsdates=None, compress=False, threads=None, writer=None):
+    """
+    Merge the HK partial products written with writeFITS_HK(..., shard=first_packet)
+    Input:
+        obsdates = tstart, tstop of the merged LV0 (see merge_LV0), as given to writeFITS_HK
+    """
+    shards = open_shards(shard_files)
+    columns = concatenate_shard_columns(shards, 'HK')
+    obt_s = concatenate_shard_columns(shards, 'SHARD')['OBTSEC']
+    columns['TIME'] = obt_s - obt_s[0]
+    columns['TIME'] += shards[0]['SHARD'].header['METOFFS']
+    
+    if obsdates is None:
+        tstart, tstop = np.min(columns['TIME']), np.max(columns['TIME'])
+    else:
+        tstart, tstop = obsdates
+    print("Got this tstart:", tstart, "and this tstop:", tstop)
+    mjdref = 59580+0.00080074074
+    start_date = Time(mjdref + tstart/86400., format='mjd')
+    stop_date  = Time(mjdref + tstop/86400.,  format='mjd')
+    exposure = stop_date.gps - start_date.gps
+    cards = [('TSTART', tstart), ('TSTOP', tstop), ('TELAPSE', exposure), ('ONTIME', exposure), ('EXPOSURE', exposure),
+             ('DATE-OBS', start_date.fits), ('DATE-END', stop_date.fits)]
+    
+    hdulist = pyfits.HDUList([merge_primary_hdu(shards[0][0], cards),
+                              merge_shard_hdu(shards[0]['HK'], columns, cards)])
+    print("Merged", len(shards), "HK shards")
+    write_hdulist(hdulist, outputfilename, checksum=True, compress=compress, threads=threads, writer=writer)
+    for shard in shards:
+        shard.close()
@@ -1,38 +1,448 @@
 import sys
 import os
 import struct
-import glob
+import logging
+import argparse
+import json
+import functools
+import collections
+import multiprocessing
+from multiprocessing import resource_tracker
 
 from HERMES_FITSer import *
-    
-dirname = sys.argv[1] 
-outputs = []
 
-# Options
-# TODO: pass them as command-line arguments?
-fm = "DM"
-gps_ok = True
-aggregated = False
 
-# Get the list of files contained in the directory, ordered by their hex value 
-# (filename is the hex representation of the UNIX timestamp of the buffer)
-files = glob.glob(dirname + os.sep + "*")
-# The first option works if the file does not have any extension,
-# the second should work in any case
-# files.sort(key=lambda f: int(f.split(os.sep)[-1], base=16))
-files.sort(key=lambda f: int(os.path.splitext(f)[0].split(os.sep)[-1], base=16))
+PRODUCTS = ["LV0d5", "LV0", "HK", "RATE", "REJSTATS", "SPECTRUM", "TRIGGERS"]
+DEFAULT_PRODUCTS = ["LV0d5", "LV0", "HK"]
+# Products that can be written as shards and merged by HERMES_merge.py
+SHARD_PRODUCTS = ["LV0d5", "LV0", "HK"]
+# Products that can be made from a sample of the files (--preview)
+PREVIEW_PRODUCTS = ["LV0d5", "LV0", "HK", "RATE"]
+
+
+def ingest_file(filein, ingest=None, tolerant=False, shared=False, data=None, container=None):
+    """
+    Run ingest on a file, also returning the byte ranges skipped in tolerant mode
+    (a list filled in the worker process would not reach the parent)
+    If shared is True, the events are decoded to columns and the readout is returned
+    as a shared memory descriptor (see share_readout), to be attached by the parent
+    data is the content of the file, if already read (see FilePrefetcher)
+    If container is given, filein is <container>/<name of a file in the container>
+    (see RawContainer and RawArchive), read from the container if data is not given
+    """
+    kwargs = {"columnar": True} if shared else {}
+    if container is not None and data is None:
+        data = open_container(container).read(filein)
+    if data is not None:
+        kwargs["data"] = data
+    skipped = []
+    if tolerant:
+        kwargs.update(tolerant=True, skipped=skipped)
+    try:
+        output = ingest(filein, **kwargs)
+    except SystemExit:
+        # The parser exits on corrupted files: in a pool worker this would kill
+        # the process and lose the task, so the error is returned to the parent
+        raise RuntimeError("Cannot read " + filein)
+    if shared:
+        if isinstance(output, tuple):
+            # SPECTRUM: (readout, sparse histogram)
+            output = (share_readout(output[0]), output[1])
+        else:
+            output = share_readout(output)
+    return output, skipped
+
+
+def ingest_window(pool, ingest, items, window):
+    """
+    Results of ingest(filein, data=data) on the (filein, data) items, in order,
+    computed by the pool with at most window files in flight
+    (pool.imap would take all the items, and their data, at once)
+    """
+    pending = collections.deque()
+    for filein, data in items:
+        pending.append(pool.apply_async(ingest, (filein,), {"data": data}))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
 
-# Cycle on every file in the directory and extract the byte buffer
-# TODO: add exception if filesize=0 or less than minimum size
-for filein in files:
-    output = ingest_buffer(filein, verbose=True, aggregated=aggregated)
-    outputs.append(output)
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a directory of HERMES raw buffer files to LV0, LV0.5 and HK FITS files")
+    parser.add_argument("dirname", help="directory containing the raw buffer files (also compressed: .gz, .xz, .bz2), "
+                        "container of the files (see HERMES_pack.py) or tar archive (.tar, .tar.gz, .tar.xz, .tar.bz2)")
+    parser.add_argument("--fm", default="DM", help="flight model / instrument name (default: DM)")
+    parser.add_argument("--gps", dest="gps_ok", action="store_true", default=True, help="align times to MET using the GPS time in the headers (default)")
+    parser.add_argument("--no-gps", dest="gps_ok", action="store_false", help="do not use the GPS time: zero-align the times")
+    parser.add_argument("--aggregated", action="store_true", help="parse aggregated files (buffers preceded by an aggregated header)")
+    parser.add_argument("--outdir", default=None, help="output directory (default: next to the input directory)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of parallel processes reading the raw files (default: 1)")
+    parser.add_argument("--products", nargs="+", default=DEFAULT_PRODUCTS, choices=PRODUCTS, metavar="PRODUCT",
+                        help="products to generate, among " + ", ".join(PRODUCTS) + " (default: " + " ".join(DEFAULT_PRODUCTS) + ")")
+    parser.add_argument("--rate-binwidths", type=float, nargs="+", default=list(RATE_BINWIDTHS), metavar="SEC",
+                        help="bin widths of the RATE light curves (default: " + " ".join(str(x) for x in RATE_BINWIDTHS) + ")")
+    parser.add_argument("--rate-bands", type=int, nargs="+", default=list(RATE_BAND_EDGES), metavar="ADC",
+                        help="ADC edges of the RATE energy bands (default: " + " ".join(str(x) for x in RATE_BAND_EDGES) + ")")
+    parser.add_argument("--rejstats-binwidth", type=float, default=REJSTATS_BINWIDTH, metavar="SEC",
+                        help="bin width of the REJSTATS rejection counts (default: {:g})".format(REJSTATS_BINWIDTH))
+    parser.add_argument("--spectrum-binsize", type=int, default=SPECTRUM_BINSIZE, metavar="ADC",
+                        help="ADC channels per bin of the SPECTRUM histograms (default: {:d})".format(SPECTRUM_BINSIZE))
+    parser.add_argument("--trigger-threshold", type=float, default=TRIGGER_THRESHOLD, metavar="SIGMA",
+                        help="significance threshold of the burst trigger (default: {:g})".format(TRIGGER_THRESHOLD))
+    parser.add_argument("--gti-max-gap", type=float, nargs="?", const=GTI_MAX_GAP, default=None, metavar="SEC",
+                        help="also end the GTIs at the time gaps between the events of consecutive buffers longer than SEC "
+                             "(default: buffer boundaries only; SEC defaults to {:g})".format(GTI_MAX_GAP))
+    parser.add_argument("--quadrants", type=int, nargs="+", default=None, choices=range(4), metavar="Q",
+                        help="keep only the events of these quadrants (0-3), selected while decoding")
+    parser.add_argument("--channels", type=int, nargs="+", default=None, choices=range(32), metavar="CH",
+                        help="keep only the pixels on these channels (0-31), and the events with at least one of them")
+    parser.add_argument("--no-rejected", action="store_true", help="drop the rejected events (no REJECTED table rows)")
+    parser.add_argument("--max-multiplicity", type=int, default=None, metavar="N", help="drop the events with multiplicity higher than N")
+    parser.add_argument("--noisy-threshold", type=float, default=None, metavar="RATE",
+                        help="monitor the rate of each quadrant channel while decoding, flagging the channels above RATE counts/s (CHANMASK extension of the LV0 file)")
+    parser.add_argument("--noisy-min-counts", type=int, default=NOISY_MIN_COUNTS, metavar="N",
+                        help="records of a channel in a buffer below which it is not flagged (default: {:d})".format(NOISY_MIN_COUNTS))
+    parser.add_argument("--mask-noisy", action="store_true", help="drop the pixels of the noisy channels of each buffer before building the events")
+    parser.add_argument("--time-sorted", action="store_true", help="sort the LV0 EVENTS rows by TIME")
+    parser.add_argument("--tolerant", action="store_true",
+                        help="skip corrupted buffers and resynchronize on the next header instead of exiting (skipped ranges in <output>_skipped.json)")
+    parser.add_argument("--npy", action="store_true", help="also export the LV0 tables as memory-mappable .npy files (<output>_LV0_npy directory)")
+    parser.add_argument("--catalog", default=None, help="take the files of dirname from this catalog (see HERMES_catalog.py) instead of listing them")
+    parser.add_argument("--unit", default=None, help="with --catalog: convert only the files of this unit (see HERMES_catalog.py --unit)")
+    parser.add_argument("--start", type=int, default=None, help="with --catalog: convert only the files from this UNIX time")
+    parser.add_argument("--stop", type=int, default=None, help="with --catalog: convert only the files before this UNIX time")
+    parser.add_argument("--gps-status", type=int, default=None, help="with --catalog: convert only the files whose buffers all have this GPS status")
+    parser.add_argument("--clean-only", action="store_true", help="with --catalog: convert only the files without corrupted bytes")
+    parser.add_argument("--shard", default=None, metavar="FIRST:STOP",
+                        help="convert only the files FIRST to STOP-1 (in time order) to partial products (<output>_shardFIRST-STOP_*), to be merged with HERMES_merge.py")
+    parser.add_argument("--preview", type=int, default=None, metavar="N",
+                        help="quick-look: decode only one file every N, spread over the whole acquisition (<output>_preview_* products)")
+    parser.add_argument("--preview-mb", type=float, default=None, metavar="MB",
+                        help="quick-look: decode about MB megabytes of files, spread evenly over the whole acquisition")
+    parser.add_argument("--compress", action="store_true", help="write tile-compressed binary tables (<output>.fits.fz, expand with funpack)")
+    parser.add_argument("--prefetch", type=int, default=2, metavar="FILES",
+                        help="files read ahead (and decompressed) by a background thread while the current one is decoded, without --jobs (0: no read-ahead, default: 2)")
+    parser.add_argument("--prefetch-mb", type=float, default=256, metavar="MB",
+                        help="maximum size of the files read ahead (default: 256 MB)")
+    parser.add_argument("--transport", choices=["shm", "pickle"], default="shm",
+                        help="how the -j worker processes return the decoded events: shared memory columns (default) or pickled objects")
+    parser.add_argument("--writers", type=int, default=1, help="number of background threads writing the FITS files while the next product is built (0: write in sequence, default: 1)")
+    parser.add_argument("--memprofile", action="store_true", help="record peak and retained memory for each stage")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print headers and records (DEBUG level)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="log only warnings and errors")
+    args = parser.parse_args(argv)
+    if args.shard is not None:
+        try:
+            args.shard = tuple(int(x) for x in args.shard.split(":"))
+            assert len(args.shard) == 2 and 0 <= args.shard[0] < args.shard[1]
+        except (ValueError, AssertionError):
+            parser.error("--shard must be FIRST:STOP, with 0 <= FIRST < STOP")
+        if any(product not in SHARD_PRODUCTS for product in args.products):
+            parser.error("--shard supports only the " + ", ".join(SHARD_PRODUCTS) + " products")
+        if args.compress:
+            parser.error("--shard cannot be used with --compress (compress the merged products instead)")
+    if args.preview is not None or args.preview_mb is not None:
+        if args.preview is not None and args.preview_mb is not None:
+            parser.error("--preview and --preview-mb cannot be used together")
+        if (args.preview is not None and args.preview < 1) or (args.preview_mb is not None and args.preview_mb <= 0):
+            parser.error("--preview must be at least 1 and --preview-mb positive")
+        if args.shard is not None:
+            parser.error("--preview cannot be used with --shard")
+        if any(product not in PREVIEW_PRODUCTS for product in args.products):
+            parser.error("--preview supports only the " + ", ".join(PREVIEW_PRODUCTS) + " products")
+    if args.mask_noisy and args.noisy_threshold is None:
+        parser.error("--mask-noisy needs a --noisy-threshold")
+    if args.noisy_threshold is not None and args.shard is not None:
+        parser.error("--noisy-threshold cannot be used with --shard")
+    if args.catalog is None and (args.unit is not None or args.start is not None or args.stop is not None or args.gps_status is not None or args.clean_only):
+        parser.error("--unit, --start, --stop, --gps-status and --clean-only select the files from a --catalog")
+    return args
+
+
+class Conversion(object):
+    """
+    Conversion of a directory of raw files to the products selected in args (see parse_arguments).
+    The files are ingested by the caller, in any order (e.g. by a process pool),
+    their outputs are collected with add() and the products are written by finish()
+    """
+    def __init__(self, args, profiler=None, shared=False):
+        """
+        If shared is True, self.ingest returns the decoded events in shared memory
+        (for a process pool, see ingest_file) and add() attaches them
+        """
+        self.args = args
+        self.profiler = profiler
+        
+        dirname = args.dirname.rstrip(os.sep)
+        if args.catalog is not None:
+            # The catalog paths are absolute (see update_catalog)
+            dirname = os.path.abspath(dirname)
+        # The raw files can also be packed in a container (see HERMES_pack.py)
+        # or in a tar archive, read without extraction
+        self.container = dirname if is_container(dirname) or is_archive(dirname) else None
+        # The members of an archive are streamed in order (see FilePrefetcher)
+        self.archive = dirname if is_archive(dirname) else None
+        if self.archive is not None:
+            dirname = dirname[:-len([x for x in ARCHIVE_EXTENSIONS if dirname.endswith(x)][0])]
+        elif self.container is not None:
+            dirname = os.path.splitext(dirname)[0]
+        if args.outdir is not None:
+            os.makedirs(args.outdir, exist_ok=True)
+            self.outputbase = os.path.join(args.outdir, os.path.basename(dirname))
+        else:
+            self.outputbase = dirname
+        
+        # Events are decoded only if an event product is requested,
+        # otherwise only the headers are scanned
+        self.decode_events = any(product in args.products for product in ["LV0d5", "LV0", "RATE", "REJSTATS", "SPECTRUM", "TRIGGERS"])
+        
+        # Get the list of files contained in the directory, ordered by their hex value 
+        # (filename is the hex representation of the UNIX timestamp of the buffer),
+        # and their UNIX timestamps, used to find missing files in the GTIs
+        if args.catalog is not None:
+            # Indexed query of the catalog filled by HERMES_catalog.py, no filesystem scan
+            catalog = open_catalog(args.catalog)
+            files, file_times = query_catalog(catalog, source=self.container or dirname, unit=args.unit, start=args.start, stop=args.stop,
+                                              gps_status=args.gps_status, clean=args.clean_only)
+            catalog.close()
+            if not files:
+                logger.error("***ERROR*** No file of %s in the catalog %s matches the selection", self.container or dirname, args.catalog)
+                exit(1)
+        elif self.container is not None:
+            # From the container index (or archive listing), in the same order
+            container = open_container(self.container)
+            files, file_times = list(container.files), list(container.times)
+        else:
+            files, file_times = list_raw_files(dirname)
+        
+        # A shard converts a range of files, its packets are numbered from the first one
+        self.shard = None
+        if args.shard is not None:
+            self.shard, stop = args.shard
+            files = files[self.shard:stop]
+            file_times = file_times[self.shard:stop]
+            self.outputbase = self.outputbase + "_shard{:d}-{:d}".format(self.shard, stop)
+        
+        # A preview decodes a sample of the files, the products are flagged and
+        # their exposure extrapolated from the fraction of the files decoded
+        self.preview = None
+        if args.preview is not None or args.preview_mb is not None:
+            if self.container is not None:
+                file_size = lambda i: open_container(self.container).size(files[i])
+            else:
+                file_size = lambda i: os.path.getsize(files[i])
+            budget = args.preview_mb*2**20 if args.preview_mb is not None else None
+            sample = preview_indices(len(files), step=args.preview, budget=budget, file_size=file_size)
+            self.preview = (sample, len(files))
+            files = [files[i] for i in sample]
+            file_times = [file_times[i] for i in sample]
+            self.outputbase = self.outputbase + "_preview"
+            print("Preview:", len(files), "of", self.preview[1], "files")
+        self.files = files
+        self.file_times = file_times
+        
+        # Event selection applied while decoding
+        event_filter = None
+        if args.quadrants is not None or args.channels is not None or args.no_rejected or args.max_multiplicity is not None:
+            event_filter = EventFilter(quadrants=args.quadrants, channels=args.channels, no_rejected=args.no_rejected,
+                                       max_multiplicity=args.max_multiplicity)
+        # Rate monitor of the channels, also applied while decoding
+        self.monitor = None
+        if args.noisy_threshold is not None:
+            self.monitor = ChannelMonitor(args.noisy_threshold, min_counts=args.noisy_min_counts, mask=args.mask_noisy)
+        
+        # Files smaller than a header stop the run (ingest_buffer), or are skipped with --tolerant
+        if "SPECTRUM" in args.products:
+            # Each file also gives a partial histogram
+            ingest = functools.partial(ingest_buffer_spectrum, binsize=args.spectrum_binsize, verbose=True, aggregated=args.aggregated,
+                                       event_filter=event_filter, monitor=self.monitor)
+        elif self.decode_events:
+            ingest = functools.partial(ingest_buffer, verbose=True, aggregated=args.aggregated, event_filter=event_filter, monitor=self.monitor)
+        else:
+            ingest = functools.partial(scan_header_file, aggregated=args.aggregated)
+        # Only the decoded events are worth moving through shared memory
+        self.shared = shared and self.decode_events
+        if self.shared:
+            # Start the resource tracker before the pool, so that the workers share it
+            # and the blocks they create are released by the parent (or at exit)
+            resource_tracker.ensure_running()
+        self.ingest = functools.partial(ingest_file, ingest=ingest, tolerant=args.tolerant, shared=self.shared, container=self.container)
+        
+        # The burst trigger is fed buffer by buffer, as soon as each file is read
+        self.trigger = None
+        if "TRIGGERS" in args.products:
+            self.trigger = BurstTrigger(threshold=args.trigger_threshold, alert_filename=self.outputbase + "_alerts.jsonl")
+            self.clock = EventClock(gps_ok=args.gps_ok)
+        
+        self.outputs = [None]*len(files)
+        # Shared memory blocks of the readout (see attach_readout)
+        self.blocks = []
+        self.skipped = [None]*len(files)
+        # Files fed to the trigger (in time order)
+        self.fed = 0
+        # Running SPECTRUM histogram, to which each file is added as it comes
+        self.spectrum = None
+        if "SPECTRUM" in args.products:
+            self.spectrum = Spectrum(binsize=args.spectrum_binsize)
+    
+    def add(self, index, result):
+        """
+        Collect the result of self.ingest on self.files[index]
+        """
+        output, self.skipped[index] = result
+        if self.spectrum is not None:
+            # Add the sparse histogram of the file to the running one, and keep only the readout
+            output, cells = output
+            self.spectrum.add_cells(*cells)
+            self.spectrum.nfiles += 1
+        if self.shared:
+            output = attach_readout(output, self.blocks)
+        self.outputs[index] = output
+        if self.trigger is not None:
+            while self.fed < len(self.files) and self.outputs[self.fed] is not None:
+                for buf in self.outputs[self.fed]:
+                    self.trigger.feed(*self.clock.buffer_events(buf))
+                self.fed += 1
+    
+    def discard(self, result):
+        """
+        Drop the result of self.ingest (e.g. after a failure), releasing its shared memory
+        """
+        output, skipped = result
+        if self.shared:
+            release_readout(output[0] if "SPECTRUM" in self.args.products else output)
+    
+    def finish(self, writer=None, threads=None):
+        """
+        Write the products, once all the files have been added
+        Input:
+            writer = FITSWriterPool for the background writes
+            threads = compression threads
+        """
+        args = self.args
+        outputbase = self.outputbase
+        profiler = self.profiler
+        fm = args.fm
+        gps_ok = args.gps_ok
+        shard = self.shard
+        outputs = self.outputs
+        skipped = [x for skipped_ranges in self.skipped for x in skipped_ranges]
+        
+        if self.trigger is not None:
+            self.trigger.flush()
+            
+        print("Readout", len(self.files), "files")
+        if args.tolerant:
+            print("Skipped", len(skipped), "byte ranges in", len(set(x[0] for x in skipped)), "files")
+            with open(outputbase + "_skipped.json", "w") as f:
+                json.dump([{"file": filein, "start": start, "stop": stop, "reason": reason} for filein, start, stop, reason in skipped], f, indent=1)
+        
+        spectrum = self.spectrum
+        
+            
+        # Create FITS files    
+        compress = args.compress
+        extension = ".fits.fz" if compress else ".fits"
+        obsdates = None
+        if "LV0d5" in args.products:
+            writeFITS_LV0d5(outputs, outputbase + "_LV0d5" + extension, fm=fm, gps_ok=gps_ok, profiler=profiler, compress=compress, threads=threads, writer=writer,
+                            shard=shard, preview=self.preview)
+        if "LV0" in args.products or "RATE" in args.products or "REJSTATS" in args.products:
+            # The RATE light curves and the REJSTATS counts are built from the LV0 event times
+            lv0_file = outputbase + "_LV0" + extension if "LV0" in args.products else None
+            npy_dir = outputbase + "_LV0_npy" if args.npy and "LV0" in args.products else None
+            rate_file = outputbase + "_RATE" + extension if "RATE" in args.products else None
+            rejstats_file = outputbase + "_REJSTATS" + extension if "REJSTATS" in args.products else None
+            obsdates = writeFITS_LV0(outputs, lv0_file, fm=fm, gps_ok=gps_ok, profiler=profiler, npy_dir=npy_dir, compress=compress, threads=threads, writer=writer,
+                                     rate_outputfilename=rate_file, rate_binwidths=args.rate_binwidths, rate_band_edges=args.rate_bands,
+                                     time_sorted=args.time_sorted, file_times=self.file_times, gti_max_gap=args.gti_max_gap, skipped=skipped,
+                                     shard=shard, preview=self.preview, channel_monitor=self.monitor,
+                                     rejstats_outputfilename=rejstats_file, rejstats_binwidth=args.rejstats_binwidth)
+        if obsdates is None:
+            # No LV0 event times: observation dates from the buffer headers
+            obsdates = header_obsdates(readout_headers(outputs), gps_ok=gps_ok)
+        if "HK" in args.products and not self.decode_events:
+            writeFITS_HK_scan(outputs, outputbase + "_HK" + extension, fm=fm, gps_ok=gps_ok, obsdates=obsdates, profiler=profiler, compress=compress, threads=threads, writer=writer,
+                              shard=shard, preview=self.preview)
+        elif "HK" in args.products:
+            writeFITS_HK(outputs, outputbase + "_HK" + extension, fm=fm, gps_ok=gps_ok, obsdates=obsdates, profiler=profiler, compress=compress, threads=threads, writer=writer,
+                         shard=shard, preview=self.preview)
+        
+        if spectrum is not None:
+            writeFITS_SPECTRUM(spectrum, outputbase + "_SPECTRUM" + extension, fm=fm, obsdates=obsdates, compress=compress, threads=threads, writer=writer)
+        
+        if self.trigger is not None:
+            writeFITS_TRIGGERS(self.trigger, outputbase + "_TRIGGERS" + extension, fm=fm, compress=compress, threads=threads, writer=writer)
+        
+        # The products keep the readout alive otherwise
+        outputs = None
+        self.release()
     
-print("Readout", len(files), "files")
+    def release(self):
+        """
+        Drop the readout, and close its shared memory blocks
+        """
+        self.outputs = None
+        release_blocks(self.blocks)
 
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    
+    if args.verbose:
+        loglevel = logging.DEBUG
+    elif args.quiet:
+        loglevel = logging.WARNING
+    else:
+        loglevel = logging.INFO
+    
+    logging.basicConfig(level=loglevel, format="%(message)s")
+    
+    profiler = MemoryProfiler() if args.memprofile else None
+    
+    conversion = Conversion(args, profiler=profiler, shared=args.jobs > 1 and args.transport == "shm")
     
-# Create FITS files    
-writeFITS_LV0d5(outputs, dirname + "_LV0d5.fits", fm=fm, gps_ok=gps_ok)
-obsdates = writeFITS_LV0(outputs, dirname + "_LV0.fits", fm=fm, gps_ok=gps_ok)
-writeFITS_HK(outputs, dirname + "_HK.fits", fm=fm, gps_ok=gps_ok, obsdates=obsdates)
+    # Cycle on every file in the directory and extract the byte buffer
+    profile_stage(profiler, "readout", "ingest")
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    prefetcher = None
+    if conversion.archive is not None or (pool is None and args.prefetch > 0 and conversion.container is None):
+        # The next files are read (and decompressed) while the current one is decoded.
+        # The archive members are streamed in any case, seeking in a compressed archive is slow
+        prefetcher = FilePrefetcher(conversion.files, depth=max(args.prefetch, 1), max_bytes=int(args.prefetch_mb*2**20),
+                                    archive=conversion.archive)
+    if pool is not None and prefetcher is not None:
+        results = ingest_window(pool, conversion.ingest, prefetcher, 2*args.jobs)
+    elif pool is not None:
+        results = pool.imap(conversion.ingest, conversion.files)
+    elif prefetcher is not None:
+        results = (conversion.ingest(filein, data=data) for filein, data in prefetcher)
+    else:
+        results = map(conversion.ingest, conversion.files)
+    for index, result in enumerate(results):
+        conversion.add(index, result)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if prefetcher is not None:
+        prefetcher.close()
+    
+    # Compressed tables are written with as many compression threads as jobs (default: one per CPU)
+    threads = args.jobs if args.jobs > 1 else None
+    writer = FITSWriterPool(args.writers) if args.writers > 0 else None
+    conversion.finish(writer=writer, threads=threads)
+    
+    # Wait for the background writes
+    errors = writer.close() if writer is not None else []
+    
+    if profiler is not None:
+        profiler.stop()
+        profiler.report(conversion.outputbase + "_memory.json")
+    
+    if errors:
+        sys.exit(1)
+
 
+if __name__ == "__main__":
+    main()
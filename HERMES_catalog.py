@@ -0,0 +1,42 @@
+import argparse
+import logging
+
+from HERMES_FITSer import *
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Fill the SQLite catalog of HERMES raw files with a header-only scan, or select files from it")
+    parser.add_argument("catalog", help="SQLite catalog file (created if missing)")
+    parser.add_argument("sources", nargs="*", help="directories, containers or tar archives of raw files to add (incremental: unchanged files are not scanned again)")
+    parser.add_argument("--unit", default=None, help="unit of the added files (e.g. FM1), also used to select the files")
+    parser.add_argument("--aggregated", action="store_true", help="the added files are aggregated (buffers preceded by an aggregated header)")
+    parser.add_argument("--select", action="store_true", help="print the selected files (path, UNIX timestamp)")
+    parser.add_argument("--source", default=None, help="select the files of this directory, container or archive")
+    parser.add_argument("--start", type=int, default=None, help="select the files from this UNIX time")
+    parser.add_argument("--stop", type=int, default=None, help="select the files before this UNIX time")
+    parser.add_argument("--gps-status", type=int, default=None, help="select the files whose buffers all have this GPS status")
+    parser.add_argument("--clean-only", action="store_true", help="select the files without corrupted (skipped) bytes")
+    parser.add_argument("-q", "--quiet", action="store_true", help="log only warnings and errors")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
+
+    catalog = open_catalog(args.catalog)
+    for source in args.sources:
+        scanned, unchanged = update_catalog(catalog, source, unit=args.unit, aggregated=args.aggregated)
+        print("{:s}: {:d} files scanned, {:d} unchanged".format(source, scanned, unchanged))
+
+    if args.select:
+        files, file_times = query_catalog(catalog, source=args.source, unit=args.unit, start=args.start, stop=args.stop,
+                                          gps_status=args.gps_status, clean=args.clean_only)
+        for filein, file_time in zip(files, file_times):
+            print(filein, file_time)
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
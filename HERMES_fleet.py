@@ -0,0 +1,191 @@
+"""
+Convert the raw directories of several HERMES units on one shared process pool.
+
+The fleet manifest is a JSON file:
+{
+    "jobs": 12,
+    "options": ["--outdir", "products", "--products", "LV0", "HK"],
+    "units": {
+        "FM1": {"dirname": "/data/FM1/20240101", "options": ["--no-gps"]},
+        "FM2": {"dirname": "/data/FM2/20240101"}
+    }
+}
+Each unit is converted with the HERMES_LV0_FITSer.py options "dirname --fm UNIT",
+followed by the common and by the unit options ("jobs" and "options" are optional).
+With --outdir, the products of each unit go to the subdirectory UNIT of the output
+directory (e.g. products/FM1/20240101_LV0.fits), since the raw directories of the
+units often have the same name.
+"""
+import os
+import sys
+import argparse
+import logging
+import json
+import collections
+import queue
+import tarfile
+import multiprocessing
+
+from HERMES_LV0_FITSer import *
+from HERMES_LV0_FITSer import parse_arguments as parse_arguments_LV0
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Convert the raw directories of several HERMES units on one shared process pool")
+    parser.add_argument("manifest", help="JSON fleet manifest (units, directories and HERMES_LV0_FITSer.py options)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes reading the raw files (default: manifest \"jobs\", or one per CPU)")
+    parser.add_argument("--writers", type=int, default=1, help="number of background threads writing the FITS files (0: write in sequence, default: 1)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="log only warnings and errors")
+    return parser.parse_args(argv)
+
+
+def read_manifest(filename):
+    """
+    Read the fleet manifest
+    Output:
+        number of jobs (None if not given), ordered dict unit -> HERMES_LV0_FITSer.py arguments
+    """
+    with open(filename) as f:
+        manifest = json.load(f, object_pairs_hook=collections.OrderedDict)
+    common = manifest.get("options", [])
+    units = collections.OrderedDict()
+    for unit, entry in manifest["units"].items():
+        argv = [entry["dirname"], "--fm", unit] + common + entry.get("options", [])
+        args = parse_arguments_LV0(argv)
+        if args.memprofile:
+            raise ValueError("--memprofile is not supported in a fleet run (unit {:s})".format(unit))
+        if args.outdir is not None:
+            # One output directory per unit
+            args.outdir = os.path.join(args.outdir, unit)
+        units[unit] = args
+    return manifest.get("jobs"), units
+
+
+def run_fleet(conversions, jobs, writer=None):
+    """
+    Ingest the files of all the units on one process pool, with fair-share scheduling:
+    each free slot goes to the unit with the fewest files in the pool, so every unit
+    progresses at the same rate until the smaller ones are done.
+    The products of a unit are written as soon as all its files are read.
+    Input:
+        conversions = ordered dict unit -> Conversion
+        jobs = number of processes
+    Output:
+        list of the units that failed
+    """
+    # Units writing to the same products would overwrite each other
+    outputbases = collections.defaultdict(list)
+    for unit, conversion in conversions.items():
+        outputbases[os.path.abspath(conversion.outputbase)].append(unit)
+    duplicates = [(outputbase, units) for outputbase, units in outputbases.items() if len(units) > 1]
+    if duplicates:
+        raise ValueError("Units with the same output files: " + "; ".join(
+                         "{:s} -> {:s}_*".format(", ".join(units), outputbase) for outputbase, units in duplicates))
+    
+    # Files queued to the pool, for each unit: enough to keep the workers
+    # busy while the products of a unit are built
+    depth = 2*jobs
+    pending   = collections.OrderedDict((unit, collections.deque(range(len(c.files)))) for unit, c in conversions.items())
+    running   = collections.OrderedDict((unit, 0) for unit in conversions)
+    remaining = collections.OrderedDict((unit, len(c.files)) for unit, c in conversions.items())
+    failed = []
+    done = queue.Queue()
+    
+    # The members of an archive are streamed in order by the parent (see FilePrefetcher)
+    # and sent to the workers: extracting them from each worker would decompress
+    # a compressed archive from the start again for every file
+    streams = collections.OrderedDict()
+    for unit, conversion in conversions.items():
+        if conversion.archive is not None and conversion.files:
+            prefetcher = FilePrefetcher(conversion.files, depth=max(conversion.args.prefetch, 1),
+                                        max_bytes=int(conversion.args.prefetch_mb*2**20), archive=conversion.archive)
+            streams[unit] = (prefetcher, iter(prefetcher))
+
+    pool = multiprocessing.Pool(jobs)
+
+    def submit():
+        while sum(running.values()) < depth:
+            candidates = [unit for unit in pending if pending[unit]]
+            if not candidates:
+                return
+            unit = min(candidates, key=lambda x: running[x])
+            index = pending[unit].popleft()
+            running[unit] += 1
+            conversion = conversions[unit]
+            kwargs = {}
+            if unit in streams:
+                try:
+                    filein, kwargs["data"] = next(streams[unit][1])
+                except (OSError, EOFError, tarfile.TarError) as error:
+                    done.put((unit, index, None, error))
+                    continue
+                assert filein == conversion.files[index]
+            pool.apply_async(conversion.ingest, (conversion.files[index],), kwargs,
+                             callback=lambda result, unit=unit, index=index: done.put((unit, index, result, None)),
+                             error_callback=lambda error, unit=unit, index=index: done.put((unit, index, None, error)))
+
+    def finish(unit):
+        if unit in failed:
+            return
+        print("Writing the products of", unit)
+        conversions[unit].finish(writer=writer, threads=jobs)
+
+    for unit in conversions:
+        if remaining[unit] == 0:
+            finish(unit)
+    submit()
+    while any(running.values()):
+        unit, index, result, error = done.get()
+        running[unit] -= 1
+        remaining[unit] -= 1
+        if error is not None:
+            logger.error("%s: failed reading %s: %s", unit, conversions[unit].files[index], error)
+            if unit not in failed:
+                failed.append(unit)
+                # Drop the other files of the unit
+                remaining[unit] -= len(pending[unit])
+                pending[unit].clear()
+                if unit in streams:
+                    streams.pop(unit)[0].close()
+                conversions[unit].release()
+        elif unit in failed:
+            conversions[unit].discard(result)
+        else:
+            conversions[unit].add(index, result)
+        if remaining[unit] == 0:
+            finish(unit)
+        submit()
+
+    pool.close()
+    pool.join()
+    for prefetcher, stream in streams.values():
+        prefetcher.close()
+    return failed
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
+
+    manifest_jobs, units = read_manifest(args.manifest)
+    jobs = args.jobs or manifest_jobs or multiprocessing.cpu_count()
+
+    conversions = collections.OrderedDict((unit, Conversion(unit_args, shared=unit_args.transport == "shm")) for unit, unit_args in units.items())
+    for unit, conversion in conversions.items():
+        print(unit, ":", len(conversion.files), "files in", units[unit].dirname)
+
+    writer = FITSWriterPool(args.writers) if args.writers > 0 else None
+    failed = run_fleet(conversions, jobs, writer=writer)
+
+    # Wait for the background writes
+    errors = writer.close() if writer is not None else []
+
+    for unit in failed:
+        print("FAILED", unit)
+    if failed or errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import os
+import argparse
+import logging
+
+from HERMES_FITSer import *
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the LV0, LV0.5 and HK shards written by HERMES_LV0_FITSer.py --shard")
+    parser.add_argument("outputbase", help="output base name of the merged products (<outputbase>_LV0.fits, ...)")
+    parser.add_argument("shards", nargs="+", help="output base names of the shards (e.g. products/run_shard0-1000)")
+    parser.add_argument("--compress", action="store_true", help="write tile-compressed binary tables (<output>.fits.fz, expand with funpack)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="log only warnings and errors")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
+
+    extension = ".fits.fz" if args.compress else ".fits"
+
+    # A product is merged if all the shards have it
+    def shard_files(product):
+        files = [shard + "_" + product + ".fits" for shard in args.shards]
+        return files if all(os.path.exists(f) for f in files) else None
+
+    if shard_files("LV0d5") is not None:
+        merge_LV0d5(shard_files("LV0d5"), args.outputbase + "_LV0d5" + extension, compress=args.compress)
+    # The HK keywords take the observation dates of the LV0, as in a single run
+    obsdates = None
+    if shard_files("LV0") is not None:
+        obsdates = merge_LV0(shard_files("LV0"), args.outputbase + "_LV0" + extension, compress=args.compress)
+    if shard_files("HK") is not None:
+        merge_HK(shard_files("HK"), args.outputbase + "_HK" + extension, obsdates=obsdates, compress=args.compress)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+import argparse
+import logging
+
+from HERMES_FITSer import *
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Pack a directory of HERMES raw buffer files into one container (input of HERMES_LV0_FITSer.py), or list a container")
+    parser.add_argument("dirname", help="directory containing the raw buffer files, or container to list with --list")
+    parser.add_argument("output", nargs="?", default=None, help="container file (default: <dirname>.hrc)")
+    parser.add_argument("--list", action="store_true", help="list the files of the container dirname (name, UNIX timestamp, offset, size)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="log only warnings and errors")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
+
+    if args.list:
+        container = RawContainer(args.dirname)
+        for name, file_time, offset, size in container.index.tolist():
+            print(name.decode(), file_time, offset, size)
+        print(len(container), "files in", args.dirname)
+        container.close()
+        return
+
+    dirname = args.dirname.rstrip(os.sep)
+    output = args.output if args.output is not None else dirname + ".hrc"
+    files, file_times = list_raw_files(dirname)
+    try:
+        index = pack_container(files, file_times, output)
+    except ValueError as error:
+        logger.error("***ERROR*** %s", error)
+        exit(1)
+    logger.info("Packed %d files (%d bytes) in %s", len(index), index["SIZE"].sum(), output)
+
+
+if __name__ == "__main__":
+    main()
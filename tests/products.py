@@ -0,0 +1,28 @@
+"""
+Run the command-line converters on a test acquisition and compare their products
+"""
+import os
+import subprocess
+import sys
+
+import astropy.io.fits as pyfits
+
+REPOSITORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def run_script(script, *arguments):
+    """
+    Run a script of the repository (e.g. HERMES_LV0_FITSer.py) in a separate process
+    """
+    command = [sys.executable, os.path.join(REPOSITORY, script)] + [str(x) for x in arguments]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode == 0, result.stderr.decode()[-2000:]
+
+
+def assert_same_fits(reference, other):
+    """
+    The two FITS files have the same headers and data
+    (the checksums and the file creation dates may differ)
+    """
+    diff = pyfits.FITSDiff(reference, other, ignore_keywords=["CHECKSUM", "DATASUM", "DATE"])
+    assert diff.identical, diff.report()
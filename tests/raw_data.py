@@ -0,0 +1,122 @@
+"""
+Synthetic raw acquisitions for the tests: buffers of a 128 byte header
+and the 4 byte big-endian records of the four quadrants
+"""
+import os
+import random
+import struct
+
+
+def raw_header(abt_s, abt_ns, counters, trigger=(0, 0, 0, 0), event=(0, 0, 0, 0)):
+    """
+    128 byte buffer header
+    Input:
+        abt_s, abt_ns = ABT of the buffer (BEE_HK)
+        counters = record counter of each quadrant
+        trigger, event = BEE trigger and event counters of each quadrant
+    """
+    header = bytearray(128)
+    header[0:8] = struct.pack('d', 12.0)
+    header[8:16] = struct.pack('d', 18.0)
+    header[16:20] = struct.pack('f', 3600.0)
+    header[20:22] = struct.pack('h', 2290)
+    header[22] = 3
+    bee_hk = bytearray(64)
+    bee_hk[0:4] = struct.pack('I', abt_s)
+    bee_hk[4:8] = struct.pack('I', abt_ns)
+    bee_hk[8:16] = struct.pack('4h', *trigger)
+    bee_hk[24:32] = struct.pack('4h', *event)
+    bee_hk[40:45] = bytes([0xA5, 0x0F, 0xF0, 0x01, 0x80])
+    for i in range(48, 63):
+        bee_hk[i] = 100 + i
+    header[24:88] = bee_hk
+    header[88:104] = struct.pack('8h', 251, 200, 210, 220, 230, 240, 250, 0)
+    header[104] = 7
+    header[105:111] = struct.pack('3H', 1234, 5678, 4321)
+    header[111:127] = struct.pack('4I', *counters)
+    return bytes(header)
+
+
+def record(bits):
+    """
+    4 byte record from its bit string
+    """
+    return int(bits, 2).to_bytes(4, 'big')
+
+
+def quadrant_records(rng, quadrant, n_events, abt_s, rejected=True, hot=None):
+    """
+    Records of n_events events of a quadrant: TIME + PIXEL records,
+    REJ events (5%) and ABT events (2%);
+    hot = (quadrant, channel) getting 60% of the pixels of that quadrant
+    Output:
+        list of records, number of TIME events
+    """
+    records = []
+    time_mark = rng.randint(0, 1000)
+    n_time = 0
+    for k in range(n_events):
+        time_mark = (time_mark + rng.randint(100, 50000)) % (1 << 24)
+        if rejected and rng.random() < 0.05:
+            records.append(record('100' + '00000' + format(time_mark, '024b')))
+            records.append(record(format(rng.getrandbits(32), '032b')))
+            continue
+        multiplicity = rng.choice([1, 1, 1, 2, 3])
+        records.append(record('101' + format(multiplicity, '05b') + format(time_mark, '024b')))
+        n_time += 1
+        for p in range(multiplicity):
+            channel = rng.randint(0, 31)
+            if hot is not None and quadrant == hot[0] and rng.random() < 0.6:
+                channel = hot[1]
+            adc = rng.randint(0, 65535)
+            records.append(record('0' + format(quadrant, '02b') + format(channel, '05b') + format(time_mark & 0xF, '04b')
+                                  + '000' + '1' + format(adc, '016b')))
+        if rng.random() < 0.02:
+            abt_s += 1
+            records.append(record('111' + format(abt_s, '029b')))
+            records.append(record('0000000' + format(rng.randint(0, 9999999), '025b')))
+    return records, n_time
+
+
+def aggregated_header(index, size):
+    """
+    25 byte aggregated header of a buffer: name (13 bytes), "-", size (8 bytes), " B"
+    """
+    return ('%013d' % index).encode() + b' -' + ('%08d' % size).encode() + b' B'
+
+
+def write_acquisition(dirname, n_files=5, n_events=200, seed=1, rejected=True, buffers_per_file=1, start=0x65000000, step=10,
+                      aggregated=False, hot=None):
+    """
+    Write a raw acquisition: one file every step seconds, named after its hex UNIX timestamp,
+    the buffers 5 s apart in ABT (each preceded by an aggregated header if aggregated),
+    with a hot (quadrant, channel) if given (see quadrant_records)
+    Output:
+        list of file names
+    """
+    os.makedirs(dirname, exist_ok=True)
+    rng = random.Random(seed)
+    abt = 1000
+    files = []
+    for f in range(n_files):
+        data = b''
+        for b in range(buffers_per_file):
+            quadrants = []
+            counters = []
+            events = []
+            for q in range(4):
+                records, n_time = quadrant_records(rng, q, n_events, abt, rejected, hot)
+                quadrants.append(b''.join(records))
+                counters.append(len(records))
+                events.append(n_time)
+            buffer = raw_header(abt, rng.randint(0, 9999999), counters, trigger=tuple(events), event=tuple(events))
+            buffer += b''.join(quadrants)
+            if aggregated:
+                buffer = aggregated_header(f*buffers_per_file + b, len(buffer)) + buffer
+            data += buffer
+            abt += 5
+        filename = os.path.join(dirname, format(start + step*f, 'x'))
+        with open(filename, 'wb') as fh:
+            fh.write(data)
+        files.append(filename)
+    return files
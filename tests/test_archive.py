@@ -0,0 +1,50 @@
+import lzma
+import os
+import tarfile
+
+import pytest
+
+from raw_data import write_acquisition
+from products import run_script, assert_same_fits
+
+PRODUCTS = ["LV0d5", "LV0", "HK"]
+
+
+@pytest.fixture(scope="module")
+def reference(tmp_path_factory):
+    """
+    Acquisition and the products of its plain directory
+    """
+    directory = tmp_path_factory.mktemp("archive")
+    files = write_acquisition(str(directory / "raw"), n_files=4, n_events=100, buffers_per_file=2)
+    run_script("HERMES_LV0_FITSer.py", directory / "raw", "-q", "--outdir", directory / "dir", "--products", *PRODUCTS)
+    return directory, files
+
+
+def assert_same_products(directory, outdir):
+    for product in PRODUCTS:
+        assert_same_fits(str(directory / "dir" / ("raw_" + product + ".fits")), str(outdir / ("raw_" + product + ".fits")))
+
+
+@pytest.mark.parametrize("extension, mode", [(".tar", "w"), (".tar.gz", "w:gz")])
+def test_tar_archive(reference, extension, mode):
+    directory, files = reference
+    archive = directory / ("raw" + extension)
+    # Members stored out of time order, in a subdirectory
+    with tarfile.open(str(archive), mode) as tar:
+        for filein in reversed(files):
+            tar.add(filein, arcname=os.path.join("raw", os.path.basename(filein)))
+    outdir = directory / extension.replace(".", "_")
+    run_script("HERMES_LV0_FITSer.py", archive, "-q", "--outdir", outdir, "--products", *PRODUCTS)
+    assert_same_products(directory, outdir)
+
+
+def test_compressed_files(reference):
+    directory, files = reference
+    os.makedirs(str(directory / "xz" / "raw"))
+    for filein in files:
+        with open(filein, "rb") as f, lzma.open(str(directory / "xz" / "raw" / (os.path.basename(filein) + ".xz")), "wb") as out:
+            out.write(f.read())
+    outdir = directory / "xz_out"
+    run_script("HERMES_LV0_FITSer.py", directory / "xz" / "raw", "-q", "--outdir", outdir, "--products", *PRODUCTS)
+    assert_same_products(directory, outdir)
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from HERMES_FITSer import open_catalog, update_catalog, query_catalog, scan_header_file
+from raw_data import write_acquisition
+from products import REPOSITORY, run_script, assert_same_fits
+
+GARBAGE = b"\x01"*37
+
+
+@pytest.fixture
+def sources(tmp_path):
+    """
+    Two units of four files (one file of unit B with a corrupted start), and an empty catalog
+    """
+    files_a = write_acquisition(str(tmp_path / "A"), n_files=4, n_events=50, buffers_per_file=2)
+    files_b = write_acquisition(str(tmp_path / "B"), n_files=4, n_events=50, seed=2, start=0x65000100)
+    with open(files_b[2], "rb") as f:
+        data = f.read()
+    with open(files_b[2], "wb") as f:
+        f.write(GARBAGE + data)
+    catalog = open_catalog(str(tmp_path / "catalog.sqlite"))
+    yield tmp_path, files_a, files_b, catalog
+    catalog.close()
+
+
+def file_times(files):
+    return [int(os.path.basename(x), 16) for x in files]
+
+
+def test_update_catalog(sources):
+    tmp_path, files_a, files_b, catalog = sources
+    assert update_catalog(catalog, str(tmp_path / "A"), unit="A") == (4, 0)
+    rows = catalog.execute("SELECT path, source, unit, time, size, nbuffers, reccnt0, reccnt1, reccnt2, reccnt3, "
+                           "abtmin, abtmax, gpsmin, gpsmax, skipped, sha256 FROM files ORDER BY time").fetchall()
+    assert [row[0] for row in rows] == [os.path.abspath(x) for x in files_a]
+    for filein, row in zip(files_a, rows):
+        headers = scan_header_file(filein)
+        with open(filein, "rb") as f:
+            data = f.read()
+        assert row[1:6] == (os.path.abspath(str(tmp_path / "A")), "A", int(os.path.basename(filein), 16), len(data), len(headers))
+        assert list(row[6:10]) == headers["recordCounters"].sum(axis=0).tolist()
+        assert row[10:14] == (headers["ABT_OBT"].min(), headers["ABT_OBT"].max(), headers["GPSStatus"].min(), headers["GPSStatus"].max())
+        assert row[14] == 0
+        assert row[15] == hashlib.sha256(data).hexdigest()
+    # Incremental: only the new, modified and removed files change
+    assert update_catalog(catalog, str(tmp_path / "A"), unit="A") == (0, 4)
+    with open(files_a[1], "ab") as f:
+        f.write(b"\x00"*4)
+    os.remove(files_a[3])
+    assert update_catalog(catalog, str(tmp_path / "A"), unit="A") == (1, 2)
+    assert catalog.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 3
+    assert catalog.execute("SELECT size FROM files WHERE path = ?", (os.path.abspath(files_a[1]),)).fetchone()[0] == \
+           os.path.getsize(files_a[1])
+    # Corrupted bytes
+    update_catalog(catalog, str(tmp_path / "B"), unit="B")
+    assert catalog.execute("SELECT skipped FROM files WHERE path = ?", (os.path.abspath(files_b[2]),)).fetchone()[0] == len(GARBAGE)
+
+
+def test_query_catalog(sources):
+    tmp_path, files_a, files_b, catalog = sources
+    update_catalog(catalog, str(tmp_path / "A"), unit="A")
+    update_catalog(catalog, str(tmp_path / "B"), unit="B")
+    paths_a = [os.path.abspath(x) for x in files_a]
+    paths_b = [os.path.abspath(x) for x in files_b]
+    assert query_catalog(catalog) == (paths_a + paths_b, file_times(files_a) + file_times(files_b))
+    assert query_catalog(catalog, source=str(tmp_path / "B"))[0] == paths_b
+    assert query_catalog(catalog, unit="A")[0] == paths_a
+    assert query_catalog(catalog, unit="C")[0] == []
+    times = file_times(files_a)
+    assert query_catalog(catalog, unit="A", start=times[1], stop=times[3]) == (paths_a[1:3], times[1:3])
+    assert query_catalog(catalog, unit="B", clean=True)[0] == paths_b[:2] + paths_b[3:]
+    gps_status = int(scan_header_file(files_a[0])["GPSStatus"][0])
+    assert query_catalog(catalog, unit="A", gps_status=gps_status)[0] == paths_a
+    assert query_catalog(catalog, unit="A", gps_status=gps_status + 1)[0] == []
+
+
+def test_catalog_conversion(sources):
+    tmp_path, files_a, files_b, catalog = sources
+    catalog.close()
+    run_script("HERMES_catalog.py", tmp_path / "catalog.sqlite", tmp_path / "A", "--unit", "A", "-q")
+    run_script("HERMES_catalog.py", tmp_path / "catalog.sqlite", tmp_path / "B", "--unit", "B", "-q")
+    times = file_times(files_a)
+    run_script("HERMES_LV0_FITSer.py", tmp_path / "A", "-q", "--outdir", tmp_path / "catalog", "--catalog", tmp_path / "catalog.sqlite",
+               "--unit", "A", "--start", times[1], "--stop", times[3])
+    # Same products as a directory of the selected files
+    os.makedirs(str(tmp_path / "subset" / "A"))
+    for filein in files_a[1:3]:
+        shutil.copy(filein, str(tmp_path / "subset" / "A"))
+    run_script("HERMES_LV0_FITSer.py", tmp_path / "subset" / "A", "-q", "--outdir", tmp_path / "directory")
+    for product in ["LV0d5", "LV0", "HK"]:
+        assert_same_fits(str(tmp_path / "directory" / ("A_" + product + ".fits")), str(tmp_path / "catalog" / ("A_" + product + ".fits")))
+    # No file of the other unit in this source: an error, no product
+    result = subprocess.run([sys.executable, os.path.join(REPOSITORY, "HERMES_LV0_FITSer.py"), str(tmp_path / "A"), "-q",
+                             "--outdir", str(tmp_path / "none"), "--catalog", str(tmp_path / "catalog.sqlite"), "--unit", "B"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode == 1
+    assert b"matches the selection" in result.stderr
+    assert not os.path.exists(str(tmp_path / "none" / "A_LV0.fits"))
@@ -0,0 +1,112 @@
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+import astropy.io.fits as pyfits
+
+from HERMES_FITSer import writeFITS_compressed, readFITS_compressed, parse_tform, TFORM_WIDTHS
+from raw_data import write_acquisition
+from products import run_script
+
+PRODUCTS = ["LV0d5", "LV0", "HK"]
+# Small tiles, so that the tables have several tiles and the row ranges cross them
+TILE_ROWS = 37
+
+
+@pytest.fixture(scope="module")
+def products(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("compress")
+    dirname = tmp_path / "acq"
+    write_acquisition(dirname, n_files=3, n_events=100)
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "out")
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "fz", "--compress")
+    return tmp_path
+
+
+def stored_rows(data, name, rows):
+    """
+    Values of a column as stored in the file: the bytes of the variable-length arrays
+    (astropy applies TZERO to the first one only), the raw fields otherwise
+    """
+    repeat, coltype, arraytype, width = parse_tform(data.columns[name].format)
+    if coltype in "PQ":
+        heap = data._get_heap_data()
+        itemsize = TFORM_WIDTHS[arraytype]
+        descriptors = data.view(np.ndarray)[name].reshape(-1, 2)
+        return [heap[offset:offset + n*itemsize].tobytes() for n, offset in descriptors[rows]]
+    return data.view(np.ndarray)[name][rows]
+
+
+def assert_same_rows(reference, other, first=0, last=None):
+    rows = np.arange(len(reference))[first:last]
+    assert len(other) == len(rows)
+    assert reference.columns.names == other.columns.names
+    for name in reference.columns.names:
+        expected = stored_rows(reference, name, rows)
+        found = stored_rows(other, name, np.arange(len(other)))
+        if isinstance(expected, list):
+            assert expected == found, name
+        else:
+            np.testing.assert_array_equal(expected, found, err_msg=name)
+
+
+def compressed_copy(products, product, tmp_path):
+    filename = products / "out" / ("acq_" + product + ".fits")
+    compressed = tmp_path / ("acq_" + product + ".fits.fz")
+    with pyfits.open(filename) as hdulist:
+        writeFITS_compressed(hdulist, compressed, tile_rows=TILE_ROWS, min_size=0)
+    return filename, compressed
+
+
+def table_names(filename):
+    with pyfits.open(filename) as hdulist:
+        return [hdu.name for hdu in hdulist[1:] if isinstance(hdu, pyfits.BinTableHDU)]
+
+
+@pytest.mark.parametrize("product", PRODUCTS)
+def test_round_trip(products, product, tmp_path):
+    filename, compressed = compressed_copy(products, product, tmp_path)
+    with pyfits.open(filename) as hdulist:
+        for extname in table_names(filename):
+            reference = hdulist[extname].data
+            assert_same_rows(reference, readFITS_compressed(compressed, extname), 0, None)
+            n_rows = len(reference)
+            # Row ranges inside a tile, across tile boundaries, at the end of the table
+            for first, last in [(0, 1), (TILE_ROWS - 1, TILE_ROWS + 1), (5, 3*TILE_ROWS + 2), (n_rows - 3, n_rows), (n_rows - 1, None)]:
+                first, last = max(first, 0), None if last is None else min(last, n_rows)
+                assert_same_rows(reference, readFITS_compressed(compressed, extname, first, last), first, last)
+
+
+def test_events_have_several_tiles(products, tmp_path):
+    filename, compressed = compressed_copy(products, "LV0", tmp_path)
+    with pyfits.open(compressed) as hdulist:
+        assert hdulist["EVENTS"].header["ZTABLE"]
+        assert hdulist["EVENTS"].header["NAXIS2"] > 2
+
+
+@pytest.mark.parametrize("product", PRODUCTS)
+def test_compressed_products(products, product):
+    # --compress writes the same tables as an uncompressed run
+    filename = products / "out" / ("acq_" + product + ".fits")
+    compressed = products / "fz" / ("acq_" + product + ".fits.fz")
+    with pyfits.open(filename) as hdulist:
+        for extname in table_names(compressed):
+            assert_same_rows(hdulist[extname].data, readFITS_compressed(compressed, extname))
+
+
+@pytest.mark.skipif(shutil.which("funpack") is None, reason="funpack is not installed")
+@pytest.mark.parametrize("product", PRODUCTS)
+def test_funpack(products, product, tmp_path):
+    filename, compressed = compressed_copy(products, product, tmp_path)
+    expanded = tmp_path / ("acq_" + product + ".fits")
+    subprocess.run(["funpack", "-O", str(expanded), str(compressed)], check=True)
+    # funpack adds the checksums to the HDUs written without them
+    with pyfits.open(filename) as reference, pyfits.open(expanded) as hdulist:
+        assert len(reference) == len(hdulist)
+        for hdu, other in zip(reference, hdulist):
+            cards = lambda header: [card for card in header.cards if card.keyword not in ("CHECKSUM", "DATASUM")]
+            assert [tuple(card) for card in cards(hdu.header)] == [tuple(card) for card in cards(other.header)]
+        for extname in table_names(filename):
+            assert_same_rows(reference[extname].data, hdulist[extname].data)
+
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from HERMES_FITSer import pack_container, RawContainer, list_raw_files
+from raw_data import write_acquisition
+from products import run_script, assert_same_fits
+
+
+def test_container_products(tmp_path):
+    files = write_acquisition(str(tmp_path / "raw"), n_files=4, n_events=100, buffers_per_file=2)
+    run_script("HERMES_pack.py", tmp_path / "raw", tmp_path / "raw.hrc", "-q")
+    container = RawContainer(str(tmp_path / "raw.hrc"))
+    assert [os.path.basename(x) for x in container.files] == [os.path.basename(x) for x in files]
+    for filein, name in zip(files, container.files):
+        with open(filein, "rb") as f:
+            assert container.read(name) == f.read()
+    container.close()
+
+    products = ["LV0d5", "LV0", "HK", "SPECTRUM"]
+    run_script("HERMES_LV0_FITSer.py", tmp_path / "raw", "-q", "--outdir", tmp_path / "dir", "--products", *products)
+    run_script("HERMES_LV0_FITSer.py", tmp_path / "raw.hrc", "-q", "--outdir", tmp_path / "hrc", "--products", *products)
+    for product in products:
+        assert_same_fits(str(tmp_path / "dir" / ("raw_" + product + ".fits")), str(tmp_path / "hrc" / ("raw_" + product + ".fits")))
+
+
+def test_long_names(tmp_path):
+    files = write_acquisition(str(tmp_path / "raw"), n_files=2, n_events=10)
+    long_name = str(tmp_path / "raw" / (os.path.basename(files[1]) + "." + "x"*64))
+    os.rename(files[1], long_name)
+    files, file_times = list_raw_files(str(tmp_path / "raw"))
+    with pytest.raises(ValueError):
+        pack_container(files, file_times, str(tmp_path / "raw.hrc"))
+    assert not os.path.exists(str(tmp_path / "raw.hrc"))
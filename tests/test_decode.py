@@ -0,0 +1,61 @@
+import collections
+import random
+import struct
+
+import pytest
+
+from HERMES_FITSer import parseRecordData, decodeRecordData, events_from_columns, EventFilter
+from raw_data import quadrant_records
+
+
+def event_key(events):
+    return [(event.time_mark, event.multiplicity, event.rejectedMap,
+             [(p.evtype, p.asicID, p.channel, p.adc, p.obt_s, p.obt_ns) for p in event.pixelEvents])
+            for event in events]
+
+
+def assert_same_decoding(buf):
+    parse_warnings = collections.Counter()
+    decode_warnings = collections.Counter()
+    events, parse_counters = parseRecordData(buf, warnings=parse_warnings)
+    columns, decode_counters = decodeRecordData(buf, warnings=decode_warnings)
+    assert decode_counters == parse_counters
+    assert +decode_warnings == +parse_warnings
+    assert event_key(events_from_columns(columns)) == event_key(events)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_quadrant_records(seed):
+    rng = random.Random(seed)
+    records, n_time = quadrant_records(rng, seed, 300, 1000)
+    assert_same_decoding(b''.join(records))
+
+
+def test_random_records():
+    # Any record sequence, including orphan PIXEL/ABT/REJ records and LSB mismatches
+    rng = random.Random(1)
+    for n in range(500):
+        records = [(rng.choice([0b101, 0b000, 0b011, 0b111, 0b100, 0b110, 0b001]) << 29) | rng.getrandbits(29)
+                   for k in range(rng.randint(0, 40))]
+        assert_same_decoding(b''.join(struct.pack('>I', r) for r in records))
+
+
+def test_empty_buffer():
+    assert_same_decoding(b'')
+
+
+def test_filtered_multiplicity():
+    # The events that lose pixels to the channel filter count the pixels left
+    rng = random.Random(7)
+    records, n_time = quadrant_records(rng, 1, 300, 1000)
+    buf = b''.join(records)
+    all_events = events_from_columns(decodeRecordData(buf)[0])
+    columns, counters = decodeRecordData(buf, event_filter=EventFilter(channels=range(8)), quadrant=1)
+    events = events_from_columns(columns)
+    n_pixels = [sum(p.evtype != 0 for p in event.pixelEvents) for event in events]
+    photons = [k for k, event in enumerate(events) if event.multiplicity > 0]
+    assert [events[k].multiplicity for k in photons] == [n_pixels[k] for k in photons]
+    assert all(p.evtype == (2 if events[k].multiplicity > 1 else 1)
+               for k in photons for p in events[k].pixelEvents if p.evtype != 0)
+    # Some events did lose pixels
+    assert sum(n_pixels) < sum(sum(p.evtype != 0 for p in event.pixelEvents) for event in all_events)
@@ -0,0 +1,181 @@
+import struct
+
+import numpy as np
+import astropy.io.fits as pyfits
+import pytest
+
+from HERMES_FITSer import compute_DQ, DQ_FLAGS, DQ_PARSED_FIELDS
+from raw_data import write_acquisition
+from products import run_script
+
+# Three buffers of four quadrants, consistent counters
+N_BUFFERS = 3
+EVENTS = np.full((N_BUFFERS, 4), 10)
+OBT_S = np.array([100, 105, 110])
+OBT_NS = np.array([0, 5000000, 9999999])
+
+
+def parsed(time=10, pixel=15, abt=1, rej=2, lsb=0):
+    counters = np.zeros((N_BUFFERS, 4, len(DQ_PARSED_FIELDS)), dtype=np.int64)
+    counters[...] = [time, pixel, abt, rej, lsb]
+    return counters
+
+
+RECORDS = np.full((N_BUFFERS, 4), 10 + 15 + 2*1 + 2*2)
+
+
+def dq(trigger=EVENTS, rejected=np.zeros_like(EVENTS), overflow=np.zeros_like(EVENTS), records=RECORDS,
+       obt_s=OBT_S, obt_ns=OBT_NS, parsed_counters=parsed()):
+    flags, quad_flags = compute_DQ(trigger, rejected, EVENTS, overflow, records, obt_s, obt_ns, parsed_counters=parsed_counters)
+    return flags.tolist(), quad_flags.tolist()
+
+
+def bit(name):
+    return 1 << [flag for flag, description in DQ_FLAGS].index(name)
+
+
+def test_good_buffers():
+    assert dq() == ([0]*N_BUFFERS, [[0]*4]*N_BUFFERS)
+    # Rejected and overflow events are triggers too
+    rejected = np.zeros_like(EVENTS)
+    rejected[1, 2] = 3
+    assert dq(trigger=EVENTS + rejected, rejected=rejected)[0] == [0]*N_BUFFERS
+
+
+def test_counters():
+    trigger = EVENTS.copy()
+    trigger[1, 2] += 1
+    trigger[1, 3] -= 1
+    flags, quad_flags = dq(trigger=trigger)
+    assert flags == [0, bit("COUNTERS"), 0]
+    assert quad_flags[1] == [0, 0, bit("COUNTERS"), bit("COUNTERS")]
+    overflow = np.zeros_like(EVENTS)
+    overflow[2, 0] = 1
+    assert dq(overflow=overflow)[1][2] == [bit("COUNTERS"), 0, 0, 0]
+
+
+def test_records():
+    records = RECORDS.copy()
+    records[0, 1] += 1
+    flags, quad_flags = dq(records=records)
+    assert flags == [bit("RECORDS"), 0, 0]
+    assert quad_flags[0] == [0, bit("RECORDS"), 0, 0]
+    # ABT and REJ events are two records
+    assert dq(records=RECORDS - 2, parsed_counters=parsed(abt=0))[0] == [0]*N_BUFFERS
+    assert dq(records=RECORDS - 2, parsed_counters=parsed(rej=1))[0] == [0]*N_BUFFERS
+    assert dq(records=RECORDS - 1, parsed_counters=parsed(abt=0))[0] == [bit("RECORDS")]*N_BUFFERS
+
+
+def test_timemark():
+    counters = parsed()
+    counters[2, 3, DQ_PARSED_FIELDS.index("LSBMISMATCH")] = 4
+    flags, quad_flags = dq(parsed_counters=counters)
+    assert flags == [0, 0, bit("TIMEMARK")]
+    assert quad_flags[2] == [0, 0, 0, bit("TIMEMARK")]
+
+
+def test_without_parsed_counters():
+    # Headers only: the checks of the parsed records are not done
+    records = RECORDS.copy()
+    records[0, 1] += 1
+    assert dq(records=records, parsed_counters=None) == ([0]*N_BUFFERS, [[0]*4]*N_BUFFERS)
+
+
+def test_obt_reset():
+    # Common to the four quadrants, on the buffer after the reset
+    flags, quad_flags = dq(obt_s=np.array([100, 5, 10]))
+    assert flags == [0, bit("OBTRESET"), 0]
+    assert quad_flags == [[0]*4]*N_BUFFERS
+    # An ABT unchanged is not a reset, nor a first buffer alone
+    assert dq(obt_s=np.array([100, 100, 110]))[0] == [0]*N_BUFFERS
+    flags, quad_flags = compute_DQ(EVENTS[:1], np.zeros((1, 4)), EVENTS[:1], np.zeros((1, 4)), RECORDS[:1], OBT_S[:1], OBT_NS[:1])
+    assert flags.tolist() == [0]
+
+
+def test_abt_counter():
+    flags, quad_flags = dq(obt_ns=np.array([10000000, 0, 9999999]))
+    assert flags == [bit("ABTCNT"), 0, 0]
+    assert quad_flags == [[0]*4]*N_BUFFERS
+
+
+def test_several_flags():
+    trigger = EVENTS.copy()
+    trigger[1, 0] += 1
+    flags, quad_flags = dq(trigger=trigger, obt_s=np.array([100, 5, 10]), obt_ns=np.array([0, 10**8, 0]))
+    assert flags == [0, bit("COUNTERS") | bit("OBTRESET") | bit("ABTCNT"), 0]
+
+
+def buffer_offsets(data):
+    """
+    Start of each buffer of a raw file
+    """
+    offsets = []
+    position = 0
+    while position < len(data):
+        offsets.append(position)
+        position += 128 + 4*sum(struct.unpack_from('4I', data, position + 111))
+    return offsets
+
+
+def first_pixel(data, position):
+    """
+    Offset of the first PIXEL record of quadrant 0 of the buffer at position
+    """
+    offset = position + 128
+    while True:
+        (value,) = struct.unpack_from(">I", data, offset)
+        if value >> 31 == 0:
+            return offset
+        offset += 8 if value >> 29 in (7, 4) else 4
+
+
+@pytest.fixture(scope="module")
+def flagged(tmp_path_factory):
+    """
+    Four files of two buffers: COUNTERS in quadrants 2 and 3 of buffer 1, ABTCNT in buffer 3,
+    TIMEMARK in quadrant 0 of buffer 5 and an OBT reset at buffer 4 (first buffer of the second shard)
+    """
+    directory = tmp_path_factory.mktemp("dq")
+    files = write_acquisition(str(directory / "raw"), n_files=4, n_events=50, buffers_per_file=2)
+    for n, filein in enumerate(files):
+        with open(filein, "rb") as f:
+            data = bytearray(f.read())
+        first, second = buffer_offsets(data)
+        if n == 0:
+            trigger = list(struct.unpack_from('4h', data, second + 32))
+            struct.pack_into('4h', data, second + 32, trigger[0], trigger[1], trigger[2] + 1, trigger[3] + 2)
+        elif n == 1:
+            struct.pack_into('I', data, second + 28, 10000000)
+        elif n == 2:
+            for position in (first, second):
+                obt = struct.unpack_from('I', data, position + 24)[0]
+                struct.pack_into('I', data, position + 24, obt - 100)
+            pixel = first_pixel(data, second)
+            data[pixel + 1] ^= 0xF0
+        with open(filein, "wb") as f:
+            f.write(bytes(data))
+    run_script("HERMES_LV0_FITSer.py", directory / "raw", "-q", "--outdir", directory / "full", "--products", "LV0")
+    for shard in ("0:2", "2:4"):
+        run_script("HERMES_LV0_FITSer.py", directory / "raw", "-q", "--outdir", directory / "shards", "--shard", shard, "--products", "LV0")
+    run_script("HERMES_merge.py", directory / "merged", directory / "shards" / "raw_shard0-2", directory / "shards" / "raw_shard2-4", "-q")
+    return directory
+
+
+@pytest.mark.parametrize("product", ["full/raw_LV0.fits", "merged_LV0.fits"])
+def test_dq_summary(flagged, product):
+    with pyfits.open(str(flagged / product)) as hdul:
+        dqflags = hdul["PACKETS"].data["DQFLAGS"]
+        dqquad = hdul["PACKETS"].data["DQQUAD"]
+        summary = hdul["DQSUMMARY"].data
+        header = hdul["DQSUMMARY"].header
+        assert dqflags.tolist() == [0, bit("COUNTERS"), 0, bit("ABTCNT"), bit("OBTRESET"), bit("TIMEMARK"), 0, 0]
+        assert dqquad[1].tolist() == [0, 0, bit("COUNTERS"), bit("COUNTERS")]
+        assert dqquad[5].tolist() == [bit("TIMEMARK"), 0, 0, 0]
+        assert summary["FLAG"].tolist() == [name for name, description in DQ_FLAGS]
+        assert summary["BIT"].tolist() == list(range(len(DQ_FLAGS)))
+        assert summary["NBUFFERS"].tolist() == [1, 0, 1, 1, 1]
+        assert summary["NQUADBUF"].tolist() == [2, 0, 1, 0, 0]
+        assert np.allclose(summary["FRACTION"], summary["NBUFFERS"]/8.)
+        assert header["NBUFFERS"] == 8 and header["NBADBUF"] == 4 and header["DQPARSED"]
+        for n, (name, description) in enumerate(DQ_FLAGS):
+            assert hdul["PACKETS"].header["DQBIT{:d}".format(n)] == name
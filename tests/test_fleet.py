@@ -0,0 +1,81 @@
+import json
+import os
+
+import pytest
+
+from HERMES_fleet import read_manifest, run_fleet
+from HERMES_LV0_FITSer import Conversion
+from raw_data import write_acquisition
+from products import run_script, assert_same_fits
+
+
+class LoggedConversion(Conversion):
+    """
+    Conversion logging the files added and the products written
+    """
+    def __init__(self, args, log):
+        Conversion.__init__(self, args)
+        self.log = log
+
+    def add(self, index, result):
+        self.log.append((self.args.fm, index))
+        Conversion.add(self, index, result)
+
+    def finish(self, writer=None, threads=None):
+        self.log.append((self.args.fm, "finish"))
+        Conversion.finish(self, writer=writer, threads=threads)
+
+
+def fleet(tmp_path, units, log):
+    """
+    Conversions of the manifest units (unit -> directory), products in tmp_path/fleet/UNIT
+    """
+    manifest = {"options": ["--outdir", str(tmp_path / "fleet"), "--products", "LV0", "HK", "-q"],
+                "units": {unit: {"dirname": str(dirname)} for unit, dirname in units}}
+    with open(str(tmp_path / "fleet.json"), "w") as f:
+        json.dump(manifest, f)
+    jobs, unit_args = read_manifest(str(tmp_path / "fleet.json"))
+    assert jobs is None and list(unit_args) == [unit for unit, dirname in units]
+    return type(unit_args)((unit, LoggedConversion(args, log)) for unit, args in unit_args.items())
+
+
+def test_fair_share(tmp_path):
+    write_acquisition(str(tmp_path / "A" / "raw"), n_files=6, n_events=50)
+    write_acquisition(str(tmp_path / "B" / "raw"), n_files=2, n_events=50, seed=2)
+    log = []
+    conversions = fleet(tmp_path, [("A", tmp_path / "A" / "raw"), ("B", tmp_path / "B" / "raw")], log)
+    assert run_fleet(conversions, 1) == []
+    # One file of each unit in turn: the smaller unit is written first
+    assert log == [("A", 0), ("B", 0), ("A", 1), ("B", 1), ("B", "finish"),
+                   ("A", 2), ("A", 3), ("A", 4), ("A", 5), ("A", "finish")]
+    # Same products as the units converted alone
+    for unit in "AB":
+        run_script("HERMES_LV0_FITSer.py", tmp_path / unit / "raw", "-q", "--outdir", tmp_path / unit / "out", "--products", "LV0", "HK",
+                   "--fm", unit)
+        for product in ["LV0", "HK"]:
+            assert_same_fits(str(tmp_path / unit / "out" / ("raw_" + product + ".fits")),
+                             str(tmp_path / "fleet" / unit / ("raw_" + product + ".fits")))
+
+
+def test_failed_unit(tmp_path):
+    write_acquisition(str(tmp_path / "A" / "raw"), n_files=4, n_events=50)
+    files = write_acquisition(str(tmp_path / "C" / "raw"), n_files=4, n_events=50, seed=2)
+    with open(files[1], "wb") as f:
+        f.write(b"\x00"*50)
+    log = []
+    conversions = fleet(tmp_path, [("A", tmp_path / "A" / "raw"), ("C", tmp_path / "C" / "raw")], log)
+    assert run_fleet(conversions, 2) == ["C"]
+    # The other files of the failed unit are dropped, and its products not written
+    assert ("C", "finish") not in log and ("A", "finish") in log
+    assert len([x for x in log if x[0] == "A"]) == 5
+    assert conversions["C"].outputs is None
+    assert os.listdir(str(tmp_path / "fleet" / "C")) == []
+    assert os.path.exists(str(tmp_path / "fleet" / "A" / "raw_LV0.fits"))
+
+
+def test_same_outputs(tmp_path):
+    write_acquisition(str(tmp_path / "A" / "raw"), n_files=2, n_events=10)
+    conversions = fleet(tmp_path, [("A", tmp_path / "A" / "raw"), ("B", tmp_path / "A" / "raw")], [])
+    conversions["B"].outputbase = conversions["A"].outputbase
+    with pytest.raises(ValueError):
+        run_fleet(conversions, 1)
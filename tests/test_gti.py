@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import astropy.io.fits as pyfits
+
+from HERMES_FITSer import compute_GTI
+from raw_data import write_acquisition
+from products import run_script
+
+# One quadrant, buffers every 10 s with one event 0.5 s after the buffer ABT
+N_BUFFERS = 4
+BUFFER_START = np.arange(N_BUFFERS)*10.
+BUFFER_INDEX = np.arange(N_BUFFERS)
+QUADID = np.zeros(N_BUFFERS, dtype=np.int64)
+TIMES = BUFFER_START + 0.5
+RECORD_COUNTERS = np.ones((N_BUFFERS, 1), dtype=np.int64)
+
+
+def gti(**kwargs):
+    options = dict(nquadrants=1, record_counters=RECORD_COUNTERS, buffer_start=BUFFER_START)
+    options.update(kwargs)
+    start, stop, quad_start, quad_stop, quad_id = compute_GTI(BUFFER_INDEX, QUADID, TIMES, N_BUFFERS, **options)
+    return start.tolist(), stop.tolist()
+
+
+def test_buffer_boundaries():
+    # Live from the first buffer ABT to the last event, whatever the event rate
+    assert gti() == ([0.], [30.5])
+
+
+def test_event_gap_cut_is_optional():
+    assert gti(max_gap=1.0) == ([0., 10., 20., 30.], [0.5, 10.5, 20.5, 30.5])
+    assert gti(max_gap=20.0) == ([0.], [30.5])
+
+
+def test_quadrant_without_records():
+    record_counters = RECORD_COUNTERS.copy()
+    record_counters[2] = 0
+    assert gti(record_counters=record_counters) == ([0., 30.], [20., 30.5])
+
+
+def test_records_lost():
+    # DQ RECORDS flag (bit 1): the quadrant is not live in that buffer
+    quad_flags = np.zeros((N_BUFFERS, 1), dtype=np.int32)
+    quad_flags[1] = 1 << 1
+    assert gti(quad_flags=quad_flags) == ([0., 20.], [10., 30.5])
+    # The other flags do not end the GTIs
+    quad_flags[1] = 1 << 0
+    assert gti(quad_flags=quad_flags) == ([0.], [30.5])
+
+
+def test_obt_reset():
+    buffer_obt = np.array([100, 110, 5, 15])
+    assert gti(buffer_obt=buffer_obt) == ([0., 20.], [10.5, 30.5])
+
+
+def test_missing_files():
+    # One buffer per file, the file between the second and the third is missing
+    file_times = np.array([0, 10, 30, 40])
+    assert gti(buffer_packet=np.arange(N_BUFFERS), file_times=file_times) == ([0., 20.], [10.5, 30.5])
+
+
+def test_packet_breaks():
+    packet_breaks = np.array([False, False, False, True])
+    assert gti(buffer_packet=np.arange(N_BUFFERS), packet_breaks=packet_breaks) == ([0., 30.], [20.5, 30.5])
+
+
+def test_events_without_buffer_times():
+    # Without the buffer headers, from the first to the last event
+    assert gti(record_counters=None, buffer_start=None) == ([0.5], [30.5])
+    assert gti(record_counters=None, buffer_start=None, max_gap=1.0) == (TIMES.tolist(), TIMES.tolist())
+
+
+def test_quadrants_without_events():
+    # A quadrant with records but no (selected) event is not in the GTIs
+    record_counters = np.ones((N_BUFFERS, 2), dtype=np.int64)
+    start, stop, quad_start, quad_stop, quad_id = compute_GTI(BUFFER_INDEX, QUADID, TIMES, N_BUFFERS, nquadrants=2,
+                                                              record_counters=record_counters, buffer_start=BUFFER_START)
+    assert quad_id.tolist() == [0]
+
+
+def test_ontime_with_missing_file(tmp_path):
+    dirname = tmp_path / "acq"
+    files = write_acquisition(dirname, n_files=5)
+    os.remove(files[2])
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "out", "--products", "LV0")
+    with pyfits.open(tmp_path / "out" / "acq_LV0.fits") as hdulist:
+        gti_table = hdulist['GTI'].data
+        quadgti = hdulist['QUADGTI'].data
+        ontime = hdulist['EVENTS'].header['ONTIME']
+    # Each quadrant is live before and after the missing file
+    assert np.bincount(quadgti['QUADID'], minlength=4).tolist() == [2, 2, 2, 2]
+    assert np.isclose(ontime, np.sum(gti_table['STOP'] - gti_table['START']))
@@ -0,0 +1,36 @@
+import numpy as np
+import astropy.io.fits as pyfits
+import pytest
+
+from HERMES_FITSer import ingest_buffer, scan_header_file, writeFITS_HK, writeFITS_HK_scan
+from raw_data import write_acquisition
+from products import run_script, assert_same_fits
+
+
+@pytest.fixture(scope="module")
+def acquisition(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("hk")
+    write_acquisition(str(directory / "raw"), n_files=4, n_events=100, buffers_per_file=2)
+    return directory
+
+
+def test_hk_only_dates(acquisition):
+    # HK alone (header scan, no event times) and HK with LV0
+    run_script("HERMES_LV0_FITSer.py", acquisition / "raw", "-q", "--outdir", acquisition / "hk", "--products", "HK")
+    run_script("HERMES_LV0_FITSer.py", acquisition / "raw", "-q", "--outdir", acquisition / "lv0", "--products", "HK", "LV0")
+    with pyfits.open(str(acquisition / "hk" / "raw_HK.fits")) as hk, pyfits.open(str(acquisition / "lv0" / "raw_HK.fits")) as lv0:
+        assert np.array_equal(hk["HK"].data, lv0["HK"].data)
+        # Buffer ABTs instead of the first and last events, on the same MET scale
+        assert hk[0].header["TSTART"] == pytest.approx(lv0[0].header["TSTART"], abs=1.)
+        assert hk[0].header["TSTOP"] == pytest.approx(lv0[0].header["TSTOP"], abs=5.)
+
+
+@pytest.mark.parametrize("aggregated", [False, True])
+def test_header_scan(tmp_path, aggregated):
+    files = write_acquisition(str(tmp_path / "raw"), n_files=3, n_events=50, buffers_per_file=2, aggregated=aggregated)
+    readouts = [ingest_buffer(filein, verbose=False, aggregated=aggregated) for filein in files]
+    header_tables = [scan_header_file(filein, aggregated=aggregated) for filein in files]
+    assert [len(x) for x in header_tables] == [2]*3
+    writeFITS_HK(readouts, str(tmp_path / "HK.fits"), gps_ok=True)
+    writeFITS_HK_scan(header_tables, str(tmp_path / "HK_scan.fits"), gps_ok=True)
+    assert_same_fits(str(tmp_path / "HK.fits"), str(tmp_path / "HK_scan.fits"))
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from HERMES_FITSer import ingest_buffer, share_readout, attach_readout, release_blocks, BUSY_BLOCKS
+
+from raw_data import write_acquisition
+from products import run_script, assert_same_fits
+
+PRODUCTS = ["LV0d5", "LV0", "HK", "RATE", "REJSTATS", "SPECTRUM", "TRIGGERS"]
+
+
+@pytest.mark.parametrize("transport", ["shm", "pickle"])
+def test_parallel_run_matches_serial(tmp_path, transport):
+    dirname = tmp_path / "acq"
+    write_acquisition(dirname, n_files=6, buffers_per_file=2)
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "serial", "--products", *PRODUCTS)
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "parallel", "--products", *PRODUCTS,
+               "-j", 3, "--transport", transport)
+    for product in PRODUCTS:
+        assert_same_fits(tmp_path / "serial" / ("acq_" + product + ".fits"), tmp_path / "parallel" / ("acq_" + product + ".fits"))
+
+
+def test_parallel_filters_match_serial(tmp_path):
+    dirname = tmp_path / "acq"
+    write_acquisition(dirname, n_files=4)
+    options = ["--channels", 3, 4, 5, "--max-multiplicity", 2, "--noisy-threshold", 50, "--mask-noisy"]
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "serial", *options)
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "parallel", "-j", 3, *options)
+    for product in ["LV0d5", "LV0", "HK"]:
+        assert_same_fits(tmp_path / "serial" / ("acq_" + product + ".fits"), tmp_path / "parallel" / ("acq_" + product + ".fits"))
+
+
+def test_attached_readout_is_not_copied(tmp_path):
+    files = write_acquisition(tmp_path / "acq", n_files=1, buffers_per_file=2)
+    readout = ingest_buffer(files[0], verbose=False, columnar=True)
+    blocks = []
+    attached = attach_readout(share_readout(readout), blocks)
+    assert len(blocks) == 1
+    block = np.frombuffer(blocks[0].buf, dtype=np.uint8)
+    for buf, attached_buf in zip(readout, attached):
+        for (header, columns), (attached_header, attached_columns) in zip(buf, attached_buf):
+            assert attached_header.headerBytes == header.headerBytes
+            for key, column in attached_columns.items():
+                np.testing.assert_array_equal(column, columns[key])
+                # Views of the shared memory block
+                assert len(column) == 0 or np.shares_memory(column, block)
+    del block, attached, column, attached_columns, attached_buf, buf
+    release_blocks(blocks)
+    assert blocks == [] and BUSY_BLOCKS == []
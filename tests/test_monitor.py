@@ -0,0 +1,103 @@
+import struct
+
+import numpy as np
+import astropy.io.fits as pyfits
+import pytest
+
+from HERMES_FITSer import scan_header_file
+from raw_data import write_acquisition
+from products import run_script
+
+# Channel 7 of quadrant 1 gets most of the pixels of its quadrant
+HOT = (1, 7)
+THRESHOLD = 100
+
+
+@pytest.fixture(scope="module")
+def acquisition(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("monitor")
+    files = write_acquisition(str(directory / "raw"), n_files=3, n_events=200, buffers_per_file=2, hot=HOT)
+    for name, options in [("plain", []), ("monitor", ["--noisy-threshold", THRESHOLD]),
+                          ("masked", ["--noisy-threshold", THRESHOLD, "--mask-noisy"])]:
+        run_script("HERMES_LV0_FITSer.py", directory / "raw", "-q", "--outdir", directory / name, "--products", "LV0", *options)
+    return directory, files
+
+
+def lv0_events(directory, name):
+    """
+    Photon events of the LV0 file: quadrant, time, NMULT and channels
+    """
+    with pyfits.open(str(directory / name / "raw_LV0.fits")) as hdul:
+        events = hdul["EVENTS"].data
+        photons = events["EVTTYPE"] > 0
+        return (events["QUADID"][photons], events["TIME"][photons], events["NMULT"][photons],
+                [np.array(x) for x in events["CHANNEL"][photons]])
+
+
+def raw_channel_counts(records):
+    """
+    PIXEL records of each (quadrant, channel) of the record lists of a buffer
+    (the second records of the ABT and REJ events are not pixels)
+    """
+    counts = np.zeros(4*32, dtype=np.int64)
+    second = False
+    for (value,) in struct.iter_unpack(">I", records):
+        if second:
+            second = False
+        elif value >> 29 in (7, 4):
+            second = True
+        elif value >> 31 == 0:
+            counts[(value >> 24) & 0x7F] += 1
+    return counts
+
+
+def test_chanmask(acquisition):
+    directory, files = acquisition
+    # PIXEL records of each (quadrant, channel), including those of the events dropped
+    counts = np.zeros(4*32, dtype=np.int64)
+    n_buffers = 0
+    for filein in files:
+        with open(filein, "rb") as f:
+            data = f.read()
+        position = 0
+        for header in scan_header_file(filein):
+            n_buffers += 1
+            size = 4*int(header["recordCounters"].sum())
+            counts += raw_channel_counts(data[position + 128:position + 128 + size])
+            position += 128 + size
+    with pyfits.open(str(directory / "monitor" / "raw_LV0.fits")) as hdul:
+        chanmask = hdul["CHANMASK"].data
+        header = hdul["CHANMASK"].header
+        hot = (chanmask["QUADID"] == HOT[0]) & (chanmask["CHANNEL"] == HOT[1])
+        assert np.array_equal(chanmask["COUNTS"], counts)
+        assert np.all(chanmask["EXPOSURE"] > 0)
+        assert np.allclose(chanmask["RATE"], chanmask["COUNTS"]/chanmask["EXPOSURE"])
+        assert np.all(chanmask["MAXRATE"] >= chanmask["RATE"]*(1 - 1e-6))
+        # The hot channel is noisy in every buffer and over the acquisition, and it is the only one
+        assert np.array_equal(chanmask["NOISY"], hot)
+        assert chanmask["NNOISY"][hot][0] == n_buffers
+        assert np.all(chanmask["NNOISY"][~hot] == 0)
+        assert header["NNOISY"] == 1 and header["NNOISYAC"] == 1
+        assert header["NOISYTHR"] == THRESHOLD and not header["NOISYMSK"]
+        assert not np.any(chanmask["MASKED"])
+        noisymap = hdul["PACKETS"].data["NOISYMAP"]
+        assert np.all(noisymap[:, HOT[0]] == 1 << HOT[1])
+
+
+def test_mask_noisy(acquisition):
+    directory, files = acquisition
+    with pyfits.open(str(directory / "masked" / "raw_LV0.fits")) as hdul:
+        chanmask = hdul["CHANMASK"].data
+        assert np.array_equal(chanmask["MASKED"], chanmask["NOISY"])
+        assert hdul["CHANMASK"].header["NOISYMSK"]
+    quadid, time, nmult, channel = lv0_events(directory, "masked")
+    plain_quadid, plain_time, plain_nmult, plain_channel = lv0_events(directory, "plain")
+    # No pixel of the hot channel left, and NMULT counts the pixels left
+    assert not any(np.any(c == HOT[1]) for q, c in zip(quadid, channel) if q == HOT[0])
+    assert any(np.any(c == HOT[1]) for q, c in zip(plain_quadid, plain_channel) if q == HOT[0])
+    assert np.array_equal(nmult, [len(c) for c in channel])
+    # The other quadrants are untouched
+    other, plain_other = quadid != HOT[0], plain_quadid != HOT[0]
+    assert np.array_equal(time[other], plain_time[plain_other])
+    assert all(np.array_equal(a, b) for a, b in zip(np.array(channel, dtype=object)[other],
+                                                    np.array(plain_channel, dtype=object)[plain_other]))
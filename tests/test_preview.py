@@ -0,0 +1,114 @@
+import os
+import shutil
+
+import numpy as np
+import astropy.io.fits as pyfits
+import pytest
+
+from HERMES_FITSer import preview_indices, preview_breaks, set_preview_keywords, PREVIEW_SIZE_SAMPLE
+from raw_data import write_acquisition
+from products import run_script
+
+N_FILES = 6
+STEP = 2
+
+
+def test_preview_step():
+    assert preview_indices(10, step=3).tolist() == [0, 3, 6, 9]
+    assert preview_indices(10, step=1).tolist() == list(range(10))
+    assert preview_indices(3, step=5).tolist() == [0]
+    assert len(preview_indices(0, step=2)) == 0
+
+
+def test_preview_budget():
+    calls = []
+
+    def file_size(i):
+        calls.append(i)
+        return 100
+
+    # As many files as fit in the budget, spread from the first to the last file
+    assert preview_indices(20, budget=450, file_size=file_size).tolist() == [0, 6, 13, 19]
+    # The sizes of a sample of the files only
+    calls[:] = []
+    assert len(preview_indices(1000, budget=10**4, file_size=file_size)) == 100
+    assert len(calls) == PREVIEW_SIZE_SAMPLE and calls[0] == 0 and calls[-1] == 999
+    # At least one file, at most all of them
+    assert preview_indices(20, budget=10, file_size=file_size).tolist() == [0]
+    assert preview_indices(20, budget=10**6, file_size=file_size).tolist() == list(range(20))
+    # Mean size of the sample
+    sizes = [50, 150]*10
+    assert len(preview_indices(20, budget=1000, file_size=lambda i: sizes[i])) == 10
+
+
+def test_preview_breaks():
+    assert preview_breaks(None) is None
+    assert preview_breaks((np.array([0, 1, 3, 6, 7]), 8)).tolist() == [False, False, True, True, False]
+    assert preview_breaks((np.array([2, 3]), 4)).tolist() == [True, False]
+
+
+def test_preview_keywords():
+    header = pyfits.Header()
+    assert set_preview_keywords(header, (np.array([0, 4, 8]), 12)) == 0.25
+    assert header["PREVIEW"] and header["PRVFILES"] == 3 and header["PRVTOTAL"] == 12 and header["PRVFRAC"] == 0.25
+
+
+@pytest.fixture(scope="module")
+def preview(tmp_path_factory):
+    """
+    Preview of one file every STEP, and each of its files converted alone
+    """
+    directory = tmp_path_factory.mktemp("preview")
+    files = write_acquisition(str(directory / "raw"), n_files=N_FILES, n_events=100, buffers_per_file=2)
+    run_script("HERMES_LV0_FITSer.py", directory / "raw", "-q", "--outdir", directory / "out", "--products", "LV0", "RATE",
+               "--preview", STEP)
+    for k in range(0, N_FILES, STEP):
+        os.makedirs(str(directory / ("solo%d" % k) / "raw"))
+        shutil.copy(files[k], str(directory / ("solo%d" % k) / "raw"))
+        run_script("HERMES_LV0_FITSer.py", directory / ("solo%d" % k) / "raw", "-q", "--outdir", directory / ("solo%d" % k),
+                   "--products", "LV0")
+    return directory, files
+
+
+def test_preview_products(preview):
+    directory, files = preview
+    with pyfits.open(str(directory / "out" / "raw_preview_LV0.fits")) as hdul:
+        header = hdul[0].header
+        events = hdul["EVENTS"].data
+        assert header["PREVIEW"] and header["PRVFILES"] == N_FILES//STEP and header["PRVTOTAL"] == N_FILES
+        assert header["PRVFRAC"] == pytest.approx(1./STEP)
+        # Exposure and photon events extrapolated to all the files
+        n_photons = np.count_nonzero((events["EVTTYPE"] > 0) & (events["NMULT"] > 0))
+        assert header["PRVONTIM"] == pytest.approx(header["ONTIME"]*STEP)
+        assert header["PRVNEVT"] == n_photons*STEP
+        assert header["PRVRATE"] == pytest.approx(n_photons/header["ONTIME"])
+        # One GTI for each file decoded
+        assert len(hdul["GTI"].data) == N_FILES//STEP
+    with pyfits.open(str(directory / "out" / "raw_preview_RATE.fits")) as hdul:
+        assert hdul[0].header["PREVIEW"] and hdul[0].header["PRVFILES"] == N_FILES//STEP
+
+
+def test_preview_abt_restart(preview):
+    # Each file decoded starts from the ABT of its header, as if converted alone
+    # (the time origin of the files converted alone is their own first event)
+    directory, files = preview
+    with pyfits.open(str(directory / "out" / "raw_preview_LV0.fits")) as hdul:
+        events = hdul["EVENTS"].data
+        for packet, k in enumerate(range(0, N_FILES, STEP)):
+            with pyfits.open(str(directory / ("solo%d" % k) / "raw_LV0.fits")) as solo:
+                reference = solo["EVENTS"].data
+                rows = events["PACKETID"] == packet
+                assert np.array_equal(events["EVTTYPE"][rows], reference["EVTTYPE"])
+                shift = events["TIME"][rows] - reference["TIME"]
+                assert np.allclose(shift, shift[0], rtol=0, atol=1e-6)
+
+
+def test_preview_megabytes(preview):
+    # Budget of two and a half files: the first and the last file
+    directory, files = preview
+    mean_size = np.mean([os.path.getsize(x) for x in files])
+    run_script("HERMES_LV0_FITSer.py", directory / "raw", "-q", "--outdir", directory / "mb", "--products", "HK",
+               "--preview-mb", 2.5*mean_size/2**20)
+    with pyfits.open(str(directory / "mb" / "raw_preview_HK.fits")) as hdul:
+        assert hdul[0].header["PRVFILES"] == 2 and hdul[0].header["PRVTOTAL"] == N_FILES
+        assert len(hdul["HK"].data) == 2*2
@@ -0,0 +1,49 @@
+import numpy as np
+import astropy.io.fits as pyfits
+
+from HERMES_FITSer import writeFITS_REJSTATS
+from raw_data import write_acquisition
+from products import run_script
+
+
+def rejmap_counts(quadid, rejmap):
+    """
+    Set bits of each (quadrant, channel), one event and one channel at a time
+    """
+    counts = np.zeros((4, 32), dtype=np.int64)
+    for q, m in zip(quadid, rejmap):
+        for c in range(32):
+            counts[q, c] += (int(m) >> c) & 1
+    return counts
+
+
+def test_rejstats_bins(tmp_path):
+    time = np.array([0.2, 0.7, 1.5, 3.9, 3.95])
+    quadid = np.array([0, 0, 3, 1, 1])
+    rejmap = np.array([0b1, 0b101, 1 << 31, 0xFFFFFFFF, 0], dtype=np.uint32)
+    writeFITS_REJSTATS(time, quadid, rejmap, str(tmp_path / "REJSTATS.fits"), 0., 4., binwidth=1.)
+    with pyfits.open(str(tmp_path / "REJSTATS.fits")) as hdul:
+        table = hdul["REJSTATS"].data
+        assert table["TIME"].tolist() == [0., 1., 2., 3., 4.]
+        assert table["NREJ"].tolist() == [[2, 0, 0, 0], [0, 0, 0, 1], [0]*4, [0, 2, 0, 0], [0]*4]
+        assert table["REJ_QA"][0].tolist() == [2, 0, 1] + [0]*29
+        assert table["REJ_QD"][1].tolist() == [0]*31 + [1]
+        assert table["REJ_QB"][3].tolist() == [1]*32
+        assert table["REJ_QC"].sum() == 0
+        assert hdul["REJSTATS"].header["NREJEVT"] == 5
+
+
+def test_rejstats_match_lv0(tmp_path):
+    write_acquisition(str(tmp_path / "raw"), n_files=3, n_events=200, buffers_per_file=2)
+    run_script("HERMES_LV0_FITSer.py", tmp_path / "raw", "-q", "--outdir", tmp_path / "out", "--products", "LV0", "REJSTATS",
+               "--rejstats-binwidth", 2.)
+    with pyfits.open(str(tmp_path / "out" / "raw_LV0.fits")) as lv0, pyfits.open(str(tmp_path / "out" / "raw_REJSTATS.fits")) as rej:
+        rejected = lv0["REJECTED"].data
+        table = rej["REJSTATS"].data
+        assert len(rejected) > 0
+        # Every rejected event in a bin, every bit of its REJMAP counted once
+        assert rej["REJSTATS"].header["NREJEVT"] == len(rejected)
+        assert rej["REJSTATS"].header["TIMEDEL"] == 2.
+        assert np.array_equal(table["NREJ"].sum(axis=0), np.bincount(rejected["QUADID"], minlength=4))
+        counts = np.stack([table["REJ_Q" + "ABCD"[q]].sum(axis=0) for q in range(4)])
+        assert np.array_equal(counts, rejmap_counts(rejected["QUADID"], rejected["REJMAP"].astype(np.int64) & 0xFFFFFFFF))
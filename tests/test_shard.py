@@ -0,0 +1,17 @@
+import pytest
+
+from raw_data import write_acquisition
+from products import run_script, assert_same_fits
+
+
+@pytest.mark.parametrize("options", [[], ["--time-sorted"], ["--gti-max-gap", "0.5"]])
+def test_merged_shards_match_single_run(tmp_path, options):
+    dirname = tmp_path / "acq"
+    write_acquisition(dirname, n_files=5, buffers_per_file=2)
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "full", *options)
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "shards", "--shard", "0:2", *options)
+    run_script("HERMES_LV0_FITSer.py", dirname, "-q", "--outdir", tmp_path / "shards", "--shard", "2:5", *options)
+    # The shards can be given in any order
+    run_script("HERMES_merge.py", tmp_path / "merged", tmp_path / "shards" / "acq_shard2-5", tmp_path / "shards" / "acq_shard0-2", "-q")
+    for product in ["LV0d5", "LV0", "HK"]:
+        assert_same_fits(tmp_path / "full" / ("acq_" + product + ".fits"), tmp_path / ("merged_" + product + ".fits"))
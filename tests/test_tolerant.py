@@ -0,0 +1,115 @@
+import json
+import os
+import random
+import struct
+
+import numpy as np
+import astropy.io.fits as pyfits
+import pytest
+
+from HERMES_FITSer import plausible_header, find_next_header, ingest_buffer, scan_header_file
+from raw_data import write_acquisition
+from products import run_script
+
+GARBAGE = 37
+
+
+@pytest.fixture
+def good_file(tmp_path):
+    """
+    File of two buffers, and its content
+    """
+    filein = write_acquisition(str(tmp_path / "raw"), n_files=1, n_events=50, buffers_per_file=2)[0]
+    with open(filein, "rb") as f:
+        return filein, f.read()
+
+
+def first_buffer_size(data):
+    return 128 + 4*sum(struct.unpack_from('4I', data, 111))
+
+
+def garbage(n, seed=3):
+    rng = random.Random(seed)
+    return bytes(rng.getrandbits(8) for k in range(n))
+
+
+def test_plausible_header(good_file):
+    filein, data = good_file
+    size = first_buffer_size(data)
+    assert plausible_header(data, 0)
+    assert plausible_header(data, size)
+    # Another header right after the record lists, or the end of the data
+    assert plausible_header(data[:size], 0)
+    assert not plausible_header(data[:size + 50], 0)
+    assert plausible_header(data[:size + 50], 0, check_next=False)
+    # ABT counter out of range, OBT too far from the previous buffer
+    bad = bytearray(data)
+    bad[28:32] = struct.pack('I', 10000000)
+    assert not plausible_header(bytes(bad), 0)
+    obt = struct.unpack_from('I', data, 24)[0]
+    assert plausible_header(data, 0, obt_reference=obt + 5)
+    assert not plausible_header(data, 0, obt_reference=obt + 10**6)
+    # Record lists beyond the end of the data
+    assert not plausible_header(data[:size - 4], 0)
+    assert not plausible_header(data, 1)
+
+
+def test_find_next_header(good_file):
+    filein, data = good_file
+    assert find_next_header(data, 0) == 0
+    assert find_next_header(data, 1) == first_buffer_size(data)
+    assert find_next_header(garbage(GARBAGE) + data, 0) == GARBAGE
+    assert find_next_header(garbage(500), 0) is None
+
+
+@pytest.mark.parametrize("case", ["garbage", "truncated", "tiny"])
+def test_skipped_ranges(good_file, tmp_path, case):
+    filein, data = good_file
+    size = first_buffer_size(data)
+    if case == "garbage":
+        content = garbage(GARBAGE) + data
+        expected = [(0, GARBAGE, "implausible header, resynchronized")]
+        n_buffers = 2
+    elif case == "truncated":
+        content = data[:-100]
+        expected = [(size, len(content), "no plausible header until the end of file")]
+        n_buffers = 1
+    else:
+        content = data[:50]
+        expected = [(0, 50, "file smaller than a header")]
+        n_buffers = 0
+    bad_file = str(tmp_path / case)
+    with open(bad_file, "wb") as f:
+        f.write(content)
+    expected = [(bad_file,) + x for x in expected]
+
+    skipped = []
+    readout = ingest_buffer(bad_file, verbose=False, tolerant=True, skipped=skipped)
+    assert skipped == expected
+    assert len(readout) == n_buffers
+    skipped = []
+    headers = scan_header_file(bad_file, tolerant=True, skipped=skipped)
+    assert skipped == expected
+    # The buffers left are those of the good file
+    assert np.array_equal(headers, scan_header_file(filein)[:n_buffers])
+    assert [buf[0][0].headerBytes for buf in readout] == [x.tobytes() for x in headers]
+
+
+def test_tolerant_run(tmp_path):
+    files = write_acquisition(str(tmp_path / "raw"), n_files=4, n_events=50, buffers_per_file=2)
+    with open(files[1], "rb") as f:
+        data = f.read()
+    with open(files[1], "wb") as f:
+        f.write(garbage(GARBAGE) + data)
+    with open(files[2], "wb") as f:
+        f.write(data[:50])
+    run_script("HERMES_LV0_FITSer.py", tmp_path / "raw", "-q", "--tolerant", "--outdir", tmp_path / "out", "--products", "LV0", "HK")
+    with open(str(tmp_path / "out" / "raw_skipped.json")) as f:
+        skipped = json.load(f)
+    assert [(os.path.basename(x["file"]), x["start"], x["stop"]) for x in skipped] == \
+           [(os.path.basename(files[1]), 0, GARBAGE), (os.path.basename(files[2]), 0, 50)]
+    with pyfits.open(str(tmp_path / "out" / "raw_LV0.fits")) as hdul:
+        assert list(hdul["SKIPPED"].data["START"]) == [0, 0]
+        assert list(hdul["SKIPPED"].data["STOP"]) == [GARBAGE, 50]
+        assert hdul["SKIPPED"].header["NSKIPPED"] == GARBAGE + 50
+        assert len(hdul["PACKETS"].data) == 6
@@ -0,0 +1,131 @@
+import numpy as np
+import astropy.io.fits as pyfits
+import pytest
+
+from HERMES_FITSer import ingest_buffer, EventClock, BurstTrigger, writeFITS_TRIGGERS
+from raw_data import write_acquisition
+from products import run_script
+
+
+RATE = 200.   # background counts/s of each quadrant
+PHA = 10000    # first energy band
+
+
+def poisson_events(rng, start, stop, rate=RATE):
+    """
+    Flat Poisson events of the four quadrants
+    """
+    times = []
+    quadids = []
+    for q in range(4):
+        n = rng.poisson(rate*(stop - start))
+        times.append(np.sort(rng.uniform(start, stop, n)))
+        quadids.append(np.full(n, q))
+    return np.concatenate(times), np.concatenate(quadids)
+
+
+def feed_buffers(trigger, times, quadids, length=1.):
+    """
+    Feed the events in buffers of the given length, the quadrants of a buffer
+    shifted by up to half a buffer from each other
+    """
+    shift = quadids*length/8
+    buffers = np.floor((times - shift)/length)
+    for b in np.unique(buffers):
+        rows = buffers == b
+        trigger.feed(times[rows], quadids[rows], np.full(np.count_nonzero(rows), PHA))
+    trigger.flush()
+
+
+def burst(rng, start, counts, duration=0.1):
+    """
+    counts events of each quadrant between start and start + duration
+    """
+    return rng.uniform(start, start + duration, 4*counts), np.repeat(np.arange(4), counts)
+
+
+def test_background_only():
+    rng = np.random.default_rng(1)
+    trigger = BurstTrigger()
+    feed_buffers(trigger, *poisson_events(rng, 0., 120.))
+    assert trigger.triggers == []
+    assert trigger.n_late == 0
+    assert trigger.n_restarts == 0
+
+
+def test_injected_bursts():
+    rng = np.random.default_rng(2)
+    times, quadids = poisson_events(rng, 0., 120.)
+    bursts = [50., 90.]
+    for start in bursts:
+        burst_times, burst_quadids = burst(rng, start, 60)
+        times = np.concatenate([times, burst_times])
+        quadids = np.concatenate([quadids, burst_quadids])
+    order = np.argsort(times)
+    trigger = BurstTrigger()
+    feed_buffers(trigger, times[order], quadids[order])
+    assert trigger.n_late == 0
+    # Every trigger covers a burst, and each burst triggers the shortest timescale
+    for t in trigger.triggers:
+        assert any(t["time"] <= start + 0.1 and start <= t["time"] + t["timescale"] for start in bursts)
+        assert t["band"] == 0 and t["quadrants"] >= 2
+    for start in bursts:
+        assert any(t["timescale"] == pytest.approx(0.1) and abs(t["time"] - start) < 0.1 for t in trigger.triggers)
+
+
+def test_restart_after_gap():
+    rng = np.random.default_rng(3)
+    before = poisson_events(rng, 0., 40.)
+    after = poisson_events(rng, 140., 200.)
+    # A burst without background just after the gap, and one with its background later on
+    bursts = [burst(rng, 145., 60), burst(rng, 180., 60)]
+    times, quadids = [np.concatenate(x) for x in zip(before, after, *bursts)]
+    order = np.argsort(times)
+    trigger = BurstTrigger()
+    feed_buffers(trigger, times[order], quadids[order])
+    assert trigger.n_restarts == 1
+    assert trigger.n_late == 0
+    assert len(trigger.triggers) > 0
+    assert all(180. - 4. <= t["time"] < 180.1 for t in trigger.triggers)
+
+
+def test_late_fraction_keywords(tmp_path):
+    rng = np.random.default_rng(4)
+    trigger = BurstTrigger()
+    feed_buffers(trigger, *poisson_events(rng, 0., 30.))
+    # A buffer of events in bins already closed
+    trigger.feed(np.full(10, 20.), np.zeros(10, dtype=np.int64), np.full(10, PHA))
+    filename = str(tmp_path / "TRIGGERS.fits")
+    writeFITS_TRIGGERS(trigger, filename)
+    header = pyfits.getheader(filename, "TRIGGERS")
+    assert header["TRGNLATE"] == 10
+    assert header["TRGNEVT"] == trigger.n_events
+    assert header["TRGLATE"] == pytest.approx(10/(trigger.n_events + 10))
+
+
+@pytest.fixture(scope="module")
+def acquisition(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("trigger")
+    files = write_acquisition(str(directory / "raw"), n_files=3, n_events=150)
+    run_script("HERMES_LV0_FITSer.py", directory / "raw", "-q", "--outdir", directory / "out", "--products", "LV0")
+    events = pyfits.getdata(str(directory / "out" / "raw_LV0.fits"), "EVENTS")
+    # Photon events (no ABT rows)
+    photons = events["EVTTYPE"] > 0
+    return files, events["TIME"][photons], events["QUADID"][photons]
+
+
+def clock_events(files, columnar):
+    clock = EventClock(gps_ok=True)
+    chunks = [clock.buffer_events(buf) for filein in files for buf in ingest_buffer(filein, verbose=False, columnar=columnar)]
+    return [np.concatenate(x) for x in zip(*chunks)]
+
+
+def test_clock_matches_lv0_time(acquisition):
+    files, lv0_time, lv0_quadid = acquisition
+    times, quadids, phas = clock_events(files, columnar=False)
+    # Same photon events as the LV0 EVENTS table, in the same order
+    assert np.array_equal(quadids, lv0_quadid)
+    assert np.array_equal(times, lv0_time)
+    # Same events from the decodeRecordData columns
+    for expected, values in zip([times, quadids, phas], clock_events(files, columnar=True)):
+        assert np.array_equal(values, expected)